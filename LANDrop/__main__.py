@@ -28,7 +28,17 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from LANDrop.main import main
+import sys
+
+
+def main():
+    # Subcommands run headless; anything else starts the tray app.
+    if len(sys.argv) > 1 and sys.argv[1] in ("send", "receive", "daemon", "peers", "-h", "--help"):
+        from LANDrop.cli import main as cliMain
+        sys.exit(cliMain(sys.argv[1:]))
+    from LANDrop.main import main as guiMain
+    guiMain()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,185 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import heapq
+import itertools
+import time
+from dataclasses import dataclass
+from enum import Enum, auto
+from typing import Dict, Generic, List, Tuple, TypeVar
+
+from LANDrop.capabilities import MAX_STREAMS
+
+DEFAULT_MAX_SESSIONS = 64
+DEFAULT_MAX_QUEUED = 64
+# Every stream of a transfer connects as a session of its own until it
+# joined the first one. This leaves room for a sender to start a transfer
+# with the most streams while its other transfers run or set up.
+DEFAULT_MAX_PER_PEER = 2 * MAX_STREAMS
+# Seconds a peer gets from connecting to having sent its file list, and
+# seconds a connection may wait in the queue.
+DEFAULT_HANDSHAKE_TIMEOUT = 30
+DEFAULT_QUEUE_TIMEOUT = 60
+
+T = TypeVar("T")
+
+
+@dataclass
+class AdmissionLimits:
+    # 0 means unlimited, except for maxQueued, where it disables queueing.
+    maxSessions: int = DEFAULT_MAX_SESSIONS
+    maxQueued: int = DEFAULT_MAX_QUEUED
+    maxPerPeer: int = DEFAULT_MAX_PER_PEER
+    handshakeTimeout: float = DEFAULT_HANDSHAKE_TIMEOUT
+    queueTimeout: float = DEFAULT_QUEUE_TIMEOUT
+
+
+@dataclass
+class AdmissionStats:
+    activeSessions: int = 0
+    queuedConnections: int = 0
+    peakActiveSessions: int = 0
+    peakQueuedConnections: int = 0
+    # Connections admitted in total, and those of them that had to wait.
+    admitted: int = 0
+    admittedFromQueue: int = 0
+    # Connections turned away because the queue was full, because their
+    # address had too many, or because they waited too long.
+    rejectedQueueFull: int = 0
+    rejectedPerPeer: int = 0
+    queueTimeouts: int = 0
+    # Sessions dropped for not finishing the handshake in time.
+    handshakeTimeouts: int = 0
+    totalWaitTime: float = 0.0
+    maxWaitTime: float = 0.0
+
+    def averageWaitTime(self) -> float:
+        return self.totalWaitTime / self.admittedFromQueue if self.admittedFromQueue else 0.0
+
+
+class Admission(Enum):
+    ADMITTED = auto()
+    QUEUED = auto()
+    REJECTED = auto()
+
+
+class AdmissionQueue(Generic[T]):
+    # Bookkeeping of the connections a server runs and holds back. Items
+    # wait by priority, highest first, and in arrival order within the
+    # same priority. Callers release every admitted item once its session
+    # is gone.
+
+    def __init__(self) -> None:
+        self.stats = AdmissionStats()
+        self.heap: List[Tuple[int, int, T]] = []
+        # Queued items: their address and when they arrived.
+        self.waiting: Dict[T, Tuple[str, float]] = {}
+        self.perPeer: Dict[str, int] = {}
+        self.counter = itertools.count()
+
+    def offer(self, item: T, address: str, priority: int, limits: AdmissionLimits) -> Admission:
+        stats = self.stats
+        if limits.maxPerPeer and self.perPeer.get(address, 0) >= limits.maxPerPeer:
+            stats.rejectedPerPeer += 1
+            return Admission.REJECTED
+        if not limits.maxSessions or (stats.activeSessions < limits.maxSessions and not self.waiting):
+            self.addPeer(address)
+            self.started()
+            return Admission.ADMITTED
+        if len(self.waiting) >= limits.maxQueued:
+            stats.rejectedQueueFull += 1
+            return Admission.REJECTED
+        self.addPeer(address)
+        self.waiting[item] = (address, time.monotonic())
+        heapq.heappush(self.heap, (-priority, next(self.counter), item))
+        stats.queuedConnections = len(self.waiting)
+        stats.peakQueuedConnections = max(stats.peakQueuedConnections, stats.queuedConnections)
+        return Admission.QUEUED
+
+    def takeAdmissible(self, limits: AdmissionLimits) -> List[T]:
+        # Items that may start now that sessions ended or limits changed.
+        items = []
+        while self.heap and (not limits.maxSessions or self.stats.activeSessions < limits.maxSessions):
+            item = heapq.heappop(self.heap)[2]
+            if item not in self.waiting:
+                continue
+            address, since = self.waiting.pop(item)
+            wait = time.monotonic() - since
+            self.stats.totalWaitTime += wait
+            self.stats.maxWaitTime = max(self.stats.maxWaitTime, wait)
+            self.stats.admittedFromQueue += 1
+            self.started()
+            items.append(item)
+        self.stats.queuedConnections = len(self.waiting)
+        return items
+
+    def takeExpired(self, limits: AdmissionLimits) -> List[T]:
+        if not limits.queueTimeout:
+            return []
+        deadline = time.monotonic() - limits.queueTimeout
+        items = [item for item, (_, since) in self.waiting.items() if since <= deadline]
+        for item in items:
+            self.remove(item)
+        self.stats.queueTimeouts += len(items)
+        return items
+
+    def remove(self, item: T) -> bool:
+        # Forgets a queued item, e.g. one whose peer hung up. Its heap entry
+        # is skipped when it comes up. Returns whether it was queued.
+        entry = self.waiting.pop(item, None)
+        if entry is None:
+            return False
+        self.removePeer(entry[0])
+        self.stats.queuedConnections = len(self.waiting)
+        if not self.waiting:
+            self.heap.clear()
+        return True
+
+    def release(self, address: str) -> None:
+        self.stats.activeSessions -= 1
+        self.removePeer(address)
+
+    def started(self) -> None:
+        self.stats.admitted += 1
+        self.stats.activeSessions += 1
+        self.stats.peakActiveSessions = max(self.stats.peakActiveSessions, self.stats.activeSessions)
+
+    def addPeer(self, address: str) -> None:
+        self.perPeer[address] = self.perPeer.get(address, 0) + 1
+
+    def removePeer(self, address: str) -> None:
+        count = self.perPeer.get(address, 0) - 1
+        if count > 0:
+            self.perPeer[address] = count
+        else:
+            self.perPeer.pop(address, None)
+
+    def __len__(self) -> int:
+        return len(self.waiting)
@@ -0,0 +1,673 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The transfer protocol on asyncio streams, for services without a Qt event
+# loop or a GUI. It drives the same protocol rules as FileTransferSender and
+# FileTransferReceiver, from transferprotocol, and interoperates with them;
+# features it doesn't implement, extra streams and deltas, are simply not
+# negotiated.
+#
+#     stats = await sendFiles("192.168.1.2", 52638, ["photo.jpg"])
+#     server = await serve("0.0.0.0", 52638, "/srv/incoming")
+#
+# Crypto and disk I/O run on options.executor when one is given, and on the
+# event loop's thread otherwise, which suits running one loop per core.
+
+import asyncio
+import inspect
+import json
+import os
+import platform
+import time
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from collections import deque
+from typing import (AsyncIterator, Awaitable, BinaryIO, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple,
+                    Union)
+
+from LANDrop.capabilities import Capabilities, PROTOCOL_VERSION
+from LANDrop.compressor import AdaptiveCompressor, availableCompression, decompress
+from LANDrop.crypto import Crypto, availableCiphers
+from LANDrop.filedigest import DigestCache, fileDigest
+from LANDrop.framing import (DEFAULT_WIDE_FRAME_SIZE, FrameFormat, LEGACY_MAX_FRAME_SIZE, MAX_CONTINUED_FRAMES,
+                             MAX_WIDE_FRAME_SIZE, MIN_WIDE_FRAME_SIZE, clampWideFrameSize, openFrame, sealFrame)
+from LANDrop.manifest import FileMetadata, manifestMessages
+from LANDrop.partfile import PartFile
+from LANDrop.ratelimit import TokenBucket
+from LANDrop.sendorder import (DEFAULT_SEND_ORDER, ORDER_ROUND_ROBIN, ROUND_ROBIN_FILES, ROUND_ROBIN_QUANTA,
+                               orderFiles)
+from LANDrop.sessionstats import SessionStats
+from LANDrop.sparse import SPARSE_MIN_SIZE, dataSegments, hasHoles
+from LANDrop.transferprogress import REPORT_INTERVAL, ProgressMeter, TransferProgress
+from LANDrop.transferprotocol import (ManifestReader, ReceiveLedger, RecordBatch, TransferResponse, dataRecord,
+                                      findResumeOffsets, matchingFiles, rawQuanta, recordQuanta, sendsHoles,
+                                      validRecord, zeroRecords)
+from LANDrop.transferrecord import RecordType, decodeRecords
+
+# Decides whether to accept files: called with the file list, their total
+# size, the sender's device name and the session code.
+AcceptCallback = Callable[[List[FileMetadata], int, str, str], Union[bool, Awaitable[bool]]]
+
+
+class TransferError(Exception):
+    pass
+
+
+class TransferRejected(TransferError):
+    pass
+
+
+@dataclass
+class TransferOptions:
+    deviceName: str = field(default_factory=platform.node)
+    deviceType: str = field(default_factory=lambda: platform.system().lower())
+    maxFrameSize: int = DEFAULT_WIDE_FRAME_SIZE
+    # Bytes the transport may buffer before sending waits for the socket.
+    sendWindow: int = 8 << 20
+    compression: bool = True
+    dedup: bool = True
+    # Where digests of hashed files are cached between sessions; "" for
+    # no cache.
+    digestCachePath: str = ""
+    # Runs crypto and disk I/O; None runs them on the event loop's thread.
+    executor: Optional[Executor] = None
+    # Called with a TransferProgress at most every REPORT_INTERVAL and once
+    # when the transfer is done.
+    progress: Optional[Callable[[TransferProgress], None]] = None
+    # Bytes per second all sessions using these options may send, and
+    # receive, together; 0 for no limit. Changes to the buckets' rates
+    # take effect right away.
+    rateLimit: int = 0
+    # One of SEND_ORDERS, and the file name patterns ORDER_PRIORITY sends
+    # first.
+    sendOrder: str = DEFAULT_SEND_ORDER
+    sendPriorities: List[str] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self.sendBucket = TokenBucket(self.rateLimit)
+        self.receiveBucket = TokenBucket(self.rateLimit)
+
+
+def computeDigests(paths: List[Optional[str]], cachePath: str) -> List[Optional[str]]:
+    cache = DigestCache(cachePath) if cachePath else None
+    digests = []
+    for path in paths:
+        digest = None
+        if path is not None and cache is not None:
+            digest = cache.digest(path)
+        elif path is not None:
+            try:
+                digest = fileDigest(path)
+            except OSError:
+                pass
+        digests.append(digest)
+    if cache is not None:
+        cache.save()
+    return digests
+
+
+def readAt(file: BinaryIO, offset: int, size: int) -> bytes:
+    if file.tell() != offset:
+        file.seek(offset)
+    return file.read(size)
+
+
+def listSegments(path: str, offset: int, end: int) -> List[Tuple[int, int, bool]]:
+    return list(dataSegments(path, offset, end))
+
+
+async def interleaveRecords(sources: Iterable[AsyncIterator[Tuple[bytes, int]]], width: int = ROUND_ROBIN_FILES,
+                            quanta: int = ROUND_ROBIN_QUANTA):
+    # Like sendorder.interleave(), for records read asynchronously.
+    sources = iter(sources)
+    active: Deque[AsyncIterator[Tuple[bytes, int]]] = deque()
+    while True:
+        while len(active) < width:
+            source = next(sources, None)
+            if source is None:
+                break
+            active.append(source)
+        if not active:
+            return
+        source = active.popleft()
+        covered = 0
+        while covered < quanta:
+            try:
+                record = await source.__anext__()
+            except StopAsyncIteration:
+                break
+            yield record
+            covered += record[1]
+        else:
+            active.append(source)
+
+
+class AsyncTransferSession:
+    # The parts of the protocol both directions share: key exchange,
+    # framing and encryption, JSON messages and statistics.
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 options: Optional[TransferOptions]) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.options = options or TransferOptions()
+        self.crypto = Crypto()
+        self.frameFormat = FrameFormat.LEGACY
+        self.maxFrameSize = LEGACY_MAX_FRAME_SIZE
+        self.capabilities = Capabilities()
+        self.stats = SessionStats()
+        self.meter = ProgressMeter()
+        self.lastReport = 0.0
+        self.transferQ: List[FileMetadata] = []
+        self.totalSize = 0
+        self.transferredSize = 0
+        self.writer.transport.set_write_buffer_limits(high=self.options.sendWindow)
+
+    def peerAddress(self) -> str:
+        peer = self.writer.get_extra_info("peername")
+        return peer[0] if peer else ""
+
+    async def offload(self, fn: Callable, *args):
+        if self.options.executor is None:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.options.executor, fn, *args)
+
+    def localCapabilities(self) -> Capabilities:
+        compression = availableCompression() if self.options.compression else []
+        return Capabilities(PROTOCOL_VERSION, clampWideFrameSize(self.options.maxFrameSize), availableCiphers(),
+                            compression, streams=1, resume=True, dedup=self.options.dedup, delta=False,
+                            sparse=True)
+
+    def applyCapabilities(self, capabilities: Capabilities) -> None:
+        self.capabilities = capabilities
+        self.crypto.setCipher(capabilities.cipher())
+        if MIN_WIDE_FRAME_SIZE <= capabilities.maxFrameSize <= MAX_WIDE_FRAME_SIZE:
+            self.frameFormat = FrameFormat.WIDE
+            self.maxFrameSize = capabilities.maxFrameSize
+
+    def maxPayloadSize(self) -> int:
+        return self.maxFrameSize - self.crypto.overhead()
+
+    async def exchangeKeys(self) -> None:
+        self.writer.write(self.crypto.localPublicKey())
+        publicKey = await self.readExactly(self.crypto.publicKeySize())
+        try:
+            self.crypto.setRemotePublicKey(publicKey)
+        except RuntimeError as e:
+            raise TransferError(str(e))
+
+    async def readExactly(self, size: int) -> bytes:
+        try:
+            data = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise TransferError("Connection closed by peer.")
+        self.stats.wireBytesReceived += len(data)
+        self.options.receiveBucket.consume(len(data))
+        return data
+
+    @staticmethod
+    async def throttle(bucket: TokenBucket) -> None:
+        wait = bucket.waitTime()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def sendFrame(self, data: bytes, prepare: Optional[Callable[[bytes], bytes]] = None) -> None:
+        if len(data) + self.crypto.overhead() > self.maxFrameSize:
+            raise TransferError("Frame too large.")
+        self.stats.payloadBytesSent += len(data)
+        header, sendData, compressTime, encryptTime = await self.offload(
+            sealFrame, self.crypto, self.crypto.cipher, self.frameFormat, data, prepare)
+        self.stats.wireBytesSent += len(header) + len(sendData)
+        self.stats.compressTime += compressTime
+        self.stats.encryptTime += encryptTime
+        await self.throttle(self.options.sendBucket)
+        self.options.sendBucket.consume(len(header) + len(sendData))
+        self.writer.write(header)
+        self.writer.write(sendData)
+        start = time.monotonic()
+        await self.writer.drain()
+        self.stats.socketStallTime += time.monotonic() - start
+
+    async def receiveFrame(self) -> bytes:
+        await self.throttle(self.options.receiveBucket)
+        size = self.frameFormat.decodeHeader(memoryview(await self.readExactly(self.frameFormat.headerSize())))
+        if size > self.maxFrameSize:
+            raise TransferError("Frame too large.")
+        frame = await self.readExactly(size)
+        try:
+            data, decryptTime = await self.offload(openFrame, self.crypto, self.crypto.cipher, frame)
+        except RuntimeError as e:
+            raise TransferError(str(e))
+        self.stats.decryptTime += decryptTime
+        self.stats.payloadBytesReceived += len(data)
+        return data
+
+    async def sendMessage(self, obj) -> None:
+        # Like FileTransferSession.sendMessage(): a message too large for
+        # one frame is announced with {"continued": n} and split over n.
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        limit = self.maxPayloadSize()
+        if len(data) <= limit:
+            await self.sendFrame(data)
+            return
+        parts = range(0, len(data), limit)
+        await self.sendFrame(json.dumps({"continued": len(parts)}).encode("utf-8"))
+        for start in parts:
+            await self.sendFrame(data[start:start + limit])
+
+    async def receiveMessage(self):
+        try:
+            obj = json.loads(await self.receiveFrame())
+            if isinstance(obj, dict) and "continued" in obj:
+                count = obj["continued"]
+                if not isinstance(count, int) or not 0 < count <= MAX_CONTINUED_FRAMES:
+                    raise ValueError("invalid continued message")
+                parts = [await self.receiveFrame() for _ in range(count)]
+                obj = json.loads(b"".join(parts))
+        except ValueError:
+            raise TransferError("Handshake failed.")
+        if not isinstance(obj, dict):
+            raise TransferError("Handshake failed.")
+        return obj
+
+    def startTransfer(self) -> None:
+        self.stats.transferStartTime = time.monotonic()
+        self.meter.start(self.totalSize, self.transferredSize)
+
+    def addTransferred(self, size: int) -> None:
+        self.transferredSize += size
+        self.meter.update(self.transferredSize)
+        now = time.monotonic()
+        if self.options.progress is not None and now - self.lastReport >= REPORT_INTERVAL / 1000:
+            self.lastReport = now
+            self.reportProgress()
+
+    def reportProgress(self) -> None:
+        progress = self.meter.sample()
+        if progress is not None and self.options.progress is not None:
+            self.options.progress(progress)
+
+    async def close(self) -> None:
+        self.stats.endTime = time.monotonic()
+        self.writer.close()
+        if not hasattr(self.writer, "wait_closed"):
+            return
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class AsyncFileSender(AsyncTransferSession):
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, paths: List[str],
+                 options: Optional[TransferOptions] = None) -> None:
+        super().__init__(reader, writer, options)
+        stats = [os.stat(path) for path in paths]
+        order = orderFiles(self.options.sendOrder, paths, [st.st_size for st in stats], self.options.sendPriorities)
+        self.paths = [paths[index] for index in order]
+        self.files: Dict[int, BinaryIO] = {}
+        self.offeredCapabilities = Capabilities()
+        self.skippedFiles: Set[int] = set()
+        self.resumeOffsets: Dict[int, int] = {}
+        self.compressor: Optional[AdaptiveCompressor] = None
+        for index in order:
+            st = stats[index]
+            self.totalSize += st.st_size
+            self.transferQ.append(FileMetadata(os.path.basename(paths[index]), st.st_size, st.st_mtime_ns // 1000000))
+
+    async def run(self) -> SessionStats:
+        # Raises TransferRejected if the receiver declines, and
+        # TransferError or OSError if the transfer fails.
+        self.stats.startTime = time.monotonic()
+        try:
+            await self.exchangeKeys()
+            await self.sendMetadata()
+            await self.receiveResponse()
+            await self.sendFiles()
+        finally:
+            for file in self.files.values():
+                file.close()
+            await self.close()
+        return self.stats
+
+    async def sendMetadata(self) -> None:
+        self.offeredCapabilities = self.localCapabilities()
+        if self.options.dedup:
+            digests = await self.offload(computeDigests, self.paths, self.options.digestCachePath)
+            for metadata, digest in zip(self.transferQ, digests):
+                metadata.digest = digest or ""
+        for path, metadata in zip(self.paths, self.transferQ):
+            if metadata.size >= SPARSE_MIN_SIZE:
+                metadata.sparse = await self.offload(hasHoles, path, metadata.size)
+        header = {"device_name": self.options.deviceName, "device_type": self.options.deviceType,
+                  "capabilities": self.offeredCapabilities.toJson()}
+        for message in manifestMessages(header, self.transferQ, self.maxPayloadSize()):
+            await self.sendFrame(message)
+
+    async def receiveResponse(self) -> None:
+        response = TransferResponse.fromJson(await self.receiveMessage(), self.offeredCapabilities, self.transferQ)
+        if response is None:
+            raise TransferError("Handshake failed.")
+        if not response.accepted:
+            raise TransferRejected("The receiving device rejected your file(s).")
+
+        # Receivers that predate capability negotiation keep getting the
+        # original protocol.
+        if response.capabilities is not None:
+            self.applyCapabilities(response.capabilities)
+            if response.capabilities.compressionMethod():
+                self.compressor = AdaptiveCompressor(response.capabilities.compressionMethod())
+        self.skippedFiles = response.haveFiles
+        self.resumeOffsets = response.resumeOffsets
+        for index in self.skippedFiles:
+            self.transferredSize += self.transferQ[index].size
+        self.transferredSize += sum(self.resumeOffsets.values())
+
+    async def sendFiles(self) -> None:
+        self.startTransfer()
+        prepare = self.compressor.compressFrame if self.compressor is not None else None
+        frames = self.batchFrames(self.recordFrames()) if self.capabilities.usesRecords() else self.rawFrames()
+        async for data, size in frames:
+            await self.sendFrame(data, prepare)
+            self.addTransferred(size)
+        self.reportProgress()
+
+    async def readFile(self, index: int, offset: int, size: int) -> bytes:
+        start = time.perf_counter()
+        try:
+            file = self.files.get(index)
+            if file is None:
+                file = self.files[index] = await self.offload(open, self.paths[index], "rb")
+            data = await self.offload(readAt, file, offset, size)
+        except OSError:
+            data = b""
+        self.stats.diskReadTime += time.perf_counter() - start
+        if not data:
+            raise TransferError("Unable to read file %s." % self.transferQ[index].filename)
+        return data
+
+    async def rawFrames(self):
+        # The original data phase: file contents back to back, in order.
+        quanta = rawQuanta(self.frameFormat, self.maxPayloadSize())
+        for index, metadata in enumerate(self.transferQ):
+            if index in self.skippedFiles:
+                continue
+            offset = self.resumeOffsets.get(index, 0)
+            self.meter.setCurrentFile(metadata.filename)
+            while offset < metadata.size:
+                data = await self.readFile(index, offset, min(quanta, metadata.size - offset))
+                offset += len(data)
+                yield data, len(data)
+            file = self.files.pop(index, None)
+            if file is not None:
+                file.close()
+
+    async def recordFrames(self):
+        sources = (self.remainingRecords(index) for index in range(len(self.transferQ))
+                   if index not in self.skippedFiles)
+        if self.options.sendOrder == ORDER_ROUND_ROBIN:
+            async for record in interleaveRecords(sources):
+                yield record
+        else:
+            for records in sources:
+                async for record in records:
+                    yield record
+
+    async def remainingRecords(self, index: int):
+        # What the receiver doesn't have of a file yet.
+        metadata = self.transferQ[index]
+        self.meter.setCurrentFile(metadata.filename)
+        offset = self.resumeOffsets.get(index, 0)
+        segments = [(offset, metadata.size, True)]
+        if sendsHoles(self.capabilities, metadata):
+            segments = await self.offload(listSegments, self.paths[index], offset, metadata.size)
+        for start, stop, isData in segments:
+            if isData:
+                async for record in self.dataRecords(index, start, stop):
+                    yield record
+                continue
+            # Holes of sparse files only take a header.
+            for record in zeroRecords(index, start, stop):
+                yield record
+        file = self.files.pop(index, None)
+        if file is not None:
+            file.close()
+
+    async def dataRecords(self, index: int, offset: int, end: int):
+        quanta = recordQuanta(self.maxPayloadSize())
+        while offset < end:
+            data = await self.readFile(index, offset, min(quanta, end - offset))
+            yield dataRecord(self.capabilities, index, offset, data)
+            offset += len(data)
+
+    async def batchFrames(self, records):
+        batch = RecordBatch(self.maxPayloadSize())
+        async for data, size in records:
+            frame = batch.add(data, size)
+            if frame is not None:
+                yield frame
+        frame = batch.take()
+        if frame is not None:
+            yield frame
+
+
+class AsyncFileReceiver(AsyncTransferSession):
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, downloadPath: str,
+                 accept: Optional[AcceptCallback] = None, options: Optional[TransferOptions] = None) -> None:
+        super().__init__(reader, writer, options)
+        self.downloadPath = downloadPath
+        # None accepts everything.
+        self.accept = accept
+        self.deviceName = ""
+        self.negotiatedCapabilities: Optional[Capabilities] = None
+        self.openFiles: Dict[int, PartFile] = {}
+        self.haveFiles: Set[int] = set()
+        self.resumeOffsets: Dict[int, int] = {}
+        self.ledger: Optional[ReceiveLedger] = None
+
+    async def run(self) -> SessionStats:
+        # Raises TransferRejected if the files were declined, and
+        # TransferError or OSError if the transfer fails. Files received in
+        # part are kept for a later session to resume.
+        self.stats.startTime = time.monotonic()
+        try:
+            await self.exchangeKeys()
+            await self.receiveMetadata()
+            accepted = await self.askAccept()
+            await self.respond(accepted)
+            if not accepted:
+                raise TransferRejected("The files were rejected.")
+            await self.receiveFiles()
+        except BaseException:
+            for file in self.openFiles.values():
+                try:
+                    await self.offload(file.abandon)
+                except OSError:
+                    pass
+            self.openFiles.clear()
+            raise
+        finally:
+            await self.close()
+        return self.stats
+
+    def filePath(self, index: int) -> str:
+        return os.path.join(self.downloadPath, self.transferQ[index].filename)
+
+    async def receiveMetadata(self) -> None:
+        manifest = ManifestReader()
+        obj = await self.receiveMessage()
+        if "join" in obj:
+            raise TransferError("Additional streams are not supported.")
+        # Long file lists follow in pages.
+        while True:
+            if not manifest.read(obj):
+                raise TransferError("Handshake failed.")
+            if manifest.isComplete():
+                break
+            obj = await self.receiveMessage()
+        self.transferQ = manifest.files
+        self.totalSize = manifest.totalSize
+        self.deviceName = manifest.deviceName
+        if manifest.offer is not None:
+            self.negotiatedCapabilities = self.localCapabilities().negotiate(manifest.offer)
+
+    async def askAccept(self) -> bool:
+        if self.accept is None:
+            return True
+        accepted = self.accept(self.transferQ, self.totalSize, self.deviceName, self.crypto.sessionKeyDigest())
+        if inspect.isawaitable(accepted):
+            accepted = await accepted
+        return bool(accepted)
+
+    async def respond(self, accepted: bool) -> None:
+        response = TransferResponse(accepted, self.negotiatedCapabilities)
+        negotiated = self.negotiatedCapabilities
+        if accepted and negotiated:
+            os.makedirs(self.downloadPath, exist_ok=True)
+            if negotiated.dedup:
+                await self.findHaveFiles()
+            if negotiated.resume:
+                self.resumeOffsets = findResumeOffsets(self.transferQ, self.filePath, self.haveFiles)
+            response = TransferResponse(accepted, negotiated, self.haveFiles, self.resumeOffsets)
+        await self.sendMessage(response.toJson(len(self.transferQ)))
+        if accepted and negotiated:
+            self.applyCapabilities(negotiated)
+
+    async def findHaveFiles(self) -> None:
+        paths = []
+        for index, metadata in enumerate(self.transferQ):
+            path = self.filePath(index)
+            paths.append(path if metadata.digest and os.path.isfile(path)
+                         and os.path.getsize(path) == metadata.size else None)
+        if any(paths):
+            digests = await self.offload(computeDigests, paths, self.options.digestCachePath)
+            self.haveFiles = matchingFiles(self.transferQ, digests)
+
+    async def receiveFiles(self) -> None:
+        os.makedirs(self.downloadPath, exist_ok=True)
+        self.ledger = ReceiveLedger(self.transferQ, self.haveFiles, self.resumeOffsets)
+        self.transferredSize += self.ledger.initialSize
+        self.startTransfer()
+        for index in self.ledger.completeFiles:
+            await self.openFile(index)
+            await self.closeFile(index)
+
+        while not self.ledger.isComplete():
+            data = await self.receiveFrame()
+            if self.capabilities.usesRecords():
+                await self.processRecords(data)
+            else:
+                await self.processRawData(data)
+        self.reportProgress()
+
+    async def processRawData(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            rawChunk = self.ledger.nextRawChunk(len(view))
+            if rawChunk is None:
+                raise TransferError("Received invalid data.")
+            index, offset, size = rawChunk
+            chunk = view[:size]
+            await self.storeFileData(index, offset, size, lambda file: file.write(offset, chunk))
+            view = view[size:]
+
+    async def processRecords(self, data, nested: bool = False) -> None:
+        method = self.capabilities.compressionMethod()
+        try:
+            for record in decodeRecords(data):
+                # COPY records are never valid here, as deltas aren't
+                # negotiated.
+                if not validRecord(record, self.capabilities, nested):
+                    raise TransferError("Received invalid data.")
+                index, offset, length, body = record.fileIndex, record.offset, record.length, record.body
+                if record.type == RecordType.DATA:
+                    await self.storeFileData(index, offset, length, lambda file: file.write(offset, body))
+                elif record.type == RecordType.COMPRESSED_RECORDS:
+                    await self.processRecords(await self.offload(decompress, method, body, length), True)
+                elif record.type == RecordType.COMPRESSED:
+                    body = await self.offload(decompress, method, body, length)
+                    await self.storeFileData(index, offset, len(body), lambda file: file.write(offset, body))
+                else:
+                    await self.storeFileData(index, offset, length, lambda file: file.zero(offset, length))
+        except ValueError:
+            raise TransferError("Received invalid data.")
+
+    async def openFile(self, index: int) -> PartFile:
+        file = self.openFiles.get(index)
+        if file is None:
+            metadata = self.transferQ[index]
+            file = PartFile(self.filePath(index), metadata.size, metadata.mtime, not metadata.sparse)
+            await self.offload(file.open, self.resumeOffsets.get(index, 0))
+            self.openFiles[index] = file
+            self.meter.setCurrentFile(metadata.filename)
+        return file
+
+    async def closeFile(self, index: int) -> None:
+        file = self.openFiles.pop(index, None)
+        if file is not None:
+            await self.offload(file.complete)
+
+    async def storeFileData(self, index: int, offset: int, length: int, store: Callable[[PartFile], None]) -> None:
+        if not self.ledger.claim(index, offset, length):
+            raise TransferError("Received invalid data.")
+        file = await self.openFile(index)
+        start = time.perf_counter()
+        await self.offload(store, file)
+        self.stats.diskWriteTime += time.perf_counter() - start
+        self.addTransferred(length)
+        if self.ledger.isFileComplete(index):
+            await self.closeFile(index)
+
+
+async def sendFiles(host: str, port: int, paths: List[str],
+                    options: Optional[TransferOptions] = None) -> SessionStats:
+    reader, writer = await asyncio.open_connection(host, port)
+    return await AsyncFileSender(reader, writer, paths, options).run()
+
+
+async def serve(host: str, port: int, downloadPath: str, accept: Optional[AcceptCallback] = None,
+                options: Optional[TransferOptions] = None,
+                sessionEnded: Optional[Callable[[AsyncFileReceiver, Optional[BaseException]], None]] = None
+                ) -> asyncio.AbstractServer:
+    # Receives into downloadPath on every connection until the server is
+    # closed. sessionEnded learns how each session went.
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        receiver = AsyncFileReceiver(reader, writer, downloadPath, accept, options)
+        error = None
+        try:
+            await receiver.run()
+        except (TransferError, OSError) as e:
+            error = e
+        if sessionEnded is not None:
+            sessionEnded(receiver, error)
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,143 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from LANDrop.crypto import DEFAULT_CIPHER
+from LANDrop.framing import LEGACY_MAX_FRAME_SIZE, MAX_WIDE_FRAME_SIZE
+
+LEGACY_PROTOCOL_VERSION = 1
+# Version 3 replaces the raw file byte stream of the data phase with
+# TransferRecords, which carry file offsets and allow several streams.
+RECORD_PROTOCOL_VERSION = 3
+PROTOCOL_VERSION = 3
+MAX_STREAMS = 16
+
+
+@dataclass
+class Capabilities:
+    # Defaults describe a peer that predates capability negotiation. Lists
+    # are ordered by preference, fastest first; after negotiation every list
+    # holds at most the single chosen entry.
+    version: int = LEGACY_PROTOCOL_VERSION
+    maxFrameSize: int = LEGACY_MAX_FRAME_SIZE
+    ciphers: List[str] = field(default_factory=lambda: [DEFAULT_CIPHER])
+    compression: List[str] = field(default_factory=list)
+    streams: int = 1
+    resume: bool = False
+    dedup: bool = False
+    delta: bool = False
+    sparse: bool = False
+
+    def cipher(self) -> str:
+        return self.ciphers[0] if self.ciphers else DEFAULT_CIPHER
+
+    def compressionMethod(self) -> str:
+        return self.compression[0] if self.compression else ""
+
+    def toJson(self) -> dict:
+        return {
+            "version": self.version,
+            "max_frame_size": self.maxFrameSize,
+            "ciphers": self.ciphers,
+            "compression": self.compression,
+            "streams": self.streams,
+            "resume": self.resume,
+            "dedup": self.dedup,
+            "delta": self.delta,
+            "sparse": self.sparse,
+        }
+
+    @staticmethod
+    def fromJson(obj) -> Optional['Capabilities']:
+        if not isinstance(obj, dict):
+            return None
+        version = obj.get("version")
+        maxFrameSize = obj.get("max_frame_size")
+        ciphers = obj.get("ciphers", [DEFAULT_CIPHER])
+        compression = obj.get("compression", [])
+        streams = obj.get("streams", 1)
+        resume = obj.get("resume", False)
+        dedup = obj.get("dedup", False)
+        delta = obj.get("delta", False)
+        sparse = obj.get("sparse", False)
+        if not isinstance(version, int) or version < LEGACY_PROTOCOL_VERSION:
+            return None
+        if not isinstance(maxFrameSize, int) or not 0 < maxFrameSize <= MAX_WIDE_FRAME_SIZE:
+            return None
+        if not isinstance(ciphers, list) or not all(isinstance(c, str) for c in ciphers):
+            return None
+        if not isinstance(compression, list) or not all(isinstance(c, str) for c in compression):
+            return None
+        if not isinstance(streams, int) or not 1 <= streams <= MAX_STREAMS:
+            return None
+        if not all(isinstance(flag, bool) for flag in (resume, dedup, delta, sparse)):
+            return None
+        return Capabilities(version, maxFrameSize, ciphers, compression, streams, resume, dedup, delta, sparse)
+
+    def negotiate(self, remote: 'Capabilities') -> 'Capabilities':
+        # Keeps our own preference order; the peer validates the result
+        # with acceptable().
+        version = min(self.version, remote.version, PROTOCOL_VERSION)
+        ciphers = [c for c in self.ciphers if c in remote.ciphers][:1]
+        compression = [c for c in self.compression if c in remote.compression][:1]
+        if version < RECORD_PROTOCOL_VERSION:
+            compression = []
+        streams = min(self.streams, remote.streams) if version >= RECORD_PROTOCOL_VERSION else 1
+        return Capabilities(
+            version,
+            min(self.maxFrameSize, remote.maxFrameSize),
+            ciphers or [DEFAULT_CIPHER],
+            compression,
+            streams,
+            self.resume and remote.resume,
+            self.dedup and remote.dedup,
+            self.delta and remote.delta and version >= RECORD_PROTOCOL_VERSION,
+            self.sparse and remote.sparse and version >= RECORD_PROTOCOL_VERSION,
+        )
+
+    def usesRecords(self) -> bool:
+        return self.version >= RECORD_PROTOCOL_VERSION
+
+    def acceptable(self, offer: 'Capabilities') -> bool:
+        return (self.version <= offer.version
+                and self.maxFrameSize <= offer.maxFrameSize
+                and len(self.ciphers) <= 1
+                and self.cipher() in offer.ciphers + [DEFAULT_CIPHER]
+                and len(self.compression) <= 1
+                and all(c in offer.compression for c in self.compression)
+                and self.streams <= offer.streams
+                and (self.streams == 1 or self.usesRecords())
+                and (offer.resume or not self.resume)
+                and (offer.dedup or not self.dedup)
+                and (offer.delta or not self.delta)
+                and (offer.sparse or not self.sparse)
+                and (self.usesRecords() or not (self.delta or self.sparse or self.compression)))
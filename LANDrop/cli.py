@@ -0,0 +1,424 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Headless subcommands for scripts, cron jobs and build servers:
+#
+#     landrop send FILE... --to HOST:PORT|DEVICE-NAME
+#     landrop receive [--dir DIR] [--auto-accept]
+#     landrop peers
+#
+# They run the asyncio engine and never create a QApplication, so they work
+# without a desktop session.
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PyQt5.QtCore import QLocale
+from PyQt5.QtNetwork import QNetworkInterface
+
+from LANDrop.asynctransfer import (AsyncFileReceiver, TransferError, TransferOptions, TransferRejected, serve,
+                                   sendFiles)
+from LANDrop.framing import DEFAULT_WIDE_FRAME_SIZE, clampWideFrameSize
+from LANDrop.manifest import FileMetadata
+from LANDrop.sendorder import ORDER_ADDED, ORDER_PRIORITY, SEND_ORDERS
+from LANDrop.sessionstats import SessionStats
+from LANDrop.transferprogress import TransferProgress, formatDuration
+
+# The GUI listens on a random port; scripts want one they can rely on.
+DEFAULT_PORT = 52638
+# Same as DiscoveryService, which can't be imported without QtWidgets.
+DISCOVERY_PORT = 52637
+DISCOVERY_TIMEOUT = 2.0
+
+
+def formatSize(size: float) -> str:
+    return QLocale().formattedDataSize(int(size), 2, QLocale.DataSizeTraditionalFormat)
+
+
+def parseSize(value: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    multiplier = units.get(value[-1:].upper(), 1)
+    try:
+        return int(value[:-1] if multiplier > 1 else value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: " + value)
+
+
+def parseFrameSize(value: str) -> int:
+    return clampWideFrameSize(parseSize(value))
+
+
+def parseNetwork(value: str):
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid network: " + value)
+
+
+def broadcastAddresses() -> List[str]:
+    addresses = {"255.255.255.255"}
+    for interface in QNetworkInterface.allInterfaces():
+        if interface.flags() & QNetworkInterface.CanBroadcast:
+            for entry in interface.addressEntries():
+                if not entry.broadcast().isNull():
+                    addresses.add(entry.broadcast().toString())
+    return sorted(addresses)
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    # Speaks DiscoveryService's protocol: asks peers to announce themselves
+    # and, given a port, answers their requests.
+
+    def __init__(self, deviceName: str = "", serverPort: int = 0) -> None:
+        self.deviceName = deviceName
+        self.serverPort = serverPort
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Device name to address and port.
+        self.peers: Dict[str, Tuple[str, int]] = {}
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def request(self) -> None:
+        data = json.dumps({"request": True}).encode("utf-8")
+        for address in broadcastAddresses():
+            try:
+                self.transport.sendto(data, (address, DISCOVERY_PORT))
+            except OSError:
+                pass
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        try:
+            obj = json.loads(data)
+        except ValueError:
+            return
+        if not isinstance(obj, dict) or not isinstance(obj.get("request"), bool):
+            return
+        if obj["request"]:
+            if self.serverPort:
+                info = {"request": False, "device_name": self.deviceName, "device_type": sys.platform,
+                        "port": self.serverPort}
+                self.transport.sendto(json.dumps(info, ensure_ascii=False).encode("utf-8"), addr)
+            return
+        deviceName = obj.get("device_name")
+        port = obj.get("port")
+        # Port 0 means the peer isn't discoverable.
+        if isinstance(deviceName, str) and isinstance(port, (int, float)) and port > 0:
+            self.peers[deviceName] = (addr[0], int(port))
+
+
+async def discoverPeers(timeout: float) -> Dict[str, Tuple[str, int]]:
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        DiscoveryProtocol, local_addr=("0.0.0.0", 0), allow_broadcast=True)
+    try:
+        protocol.request()
+        await asyncio.sleep(timeout)
+    finally:
+        transport.close()
+    return protocol.peers
+
+
+async def announce(deviceName: str, serverPort: int) -> Optional[asyncio.DatagramTransport]:
+    # Lets senders find us by name. The port may be taken, e.g. by the GUI
+    # running on the same machine; then we just aren't discoverable.
+    loop = asyncio.get_event_loop()
+    try:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: DiscoveryProtocol(deviceName, serverPort), local_addr=("0.0.0.0", DISCOVERY_PORT),
+            allow_broadcast=True)
+    except OSError as e:
+        print("Unable to bind to port %d, this device won't be discoverable: %s" % (DISCOVERY_PORT, e),
+              file=sys.stderr)
+        return None
+    return transport
+
+
+class ProgressPrinter:
+    # Keeps one status line up to date on a terminal; prints nothing
+    # otherwise, so logs of scripted runs stay clean.
+
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled and sys.stderr.isatty()
+        self.width = 0
+
+    def __call__(self, progress: TransferProgress) -> None:
+        if not self.enabled:
+            return
+        text = "%3d%%  %s/%s" % (progress.fraction() * 100, formatSize(progress.transferredSize),
+                                 formatSize(progress.totalSize))
+        if progress.averageThroughput > 0:
+            text += "  %s/s" % formatSize(progress.averageThroughput)
+        if progress.eta > 0:
+            text += "  %s left" % formatDuration(progress.eta)
+        if progress.currentFile:
+            text += "  " + progress.currentFile
+        self.width = max(self.width, len(text))
+        sys.stderr.write("\r" + text.ljust(self.width))
+        sys.stderr.flush()
+
+    def clear(self) -> None:
+        if self.enabled and self.width:
+            sys.stderr.write("\r" + " " * self.width + "\r")
+            sys.stderr.flush()
+            self.width = 0
+
+
+def summary(verb: str, files: int, stats: SessionStats, size: int) -> str:
+    elapsed = stats.transferTime()
+    text = "%s %d file(s), %s" % (verb, files, formatSize(size))
+    if elapsed > 0:
+        text += " in %.1fs (%s/s)" % (elapsed, formatSize(size / elapsed))
+    return text
+
+
+def transferOptions(args: argparse.Namespace, executor: ThreadPoolExecutor,
+                    progress: ProgressPrinter) -> TransferOptions:
+    options = TransferOptions(maxFrameSize=args.frame_size, compression=not args.no_compression,
+                              dedup=not args.no_dedup, executor=executor, progress=progress,
+                              rateLimit=args.limit_rate)
+    if args.name:
+        options.deviceName = args.name
+    return options
+
+
+async def resolvePeer(target: str, timeout: float) -> Tuple[str, int]:
+    host, sep, port = target.rpartition(":")
+    if sep and port.isdigit():
+        return host.strip("[]"), int(port)
+    peers = await discoverPeers(timeout)
+    if target not in peers:
+        raise TransferError("No device named %s found." % target)
+    return peers[target]
+
+
+async def runSend(args: argparse.Namespace) -> int:
+    for path in args.paths:
+        if not os.path.isfile(path):
+            print("Not a file: " + path, file=sys.stderr)
+            return 1
+    progress = ProgressPrinter(not args.quiet)
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        try:
+            host, port = await resolvePeer(args.to, args.discovery_timeout)
+            options = transferOptions(args, executor, progress)
+            # Patterns alone ask for them to go first.
+            options.sendOrder = args.order or (ORDER_PRIORITY if args.first else ORDER_ADDED)
+            options.sendPriorities = args.first
+            stats = await sendFiles(host, port, args.paths, options)
+        except (TransferError, OSError) as e:
+            progress.clear()
+            print(str(e), file=sys.stderr)
+            return 1
+    progress.clear()
+    if not args.quiet:
+        print(summary("Sent", len(args.paths), stats, sum(os.path.getsize(path) for path in args.paths)))
+    return 0
+
+
+async def askAccept(files: List[FileMetadata], totalSize: int, deviceName: str, code: str) -> bool:
+    if len(files) == 1:
+        question = '%s would like to share a file "%s" of size %s.' % (deviceName, files[0].filename,
+                                                                      formatSize(totalSize))
+    else:
+        question = "%s would like to share %d files of total size %s." % (deviceName, len(files),
+                                                                          formatSize(totalSize))
+    question += '\nConfirm that the code "%s" is shown on the sending device.\nReceive? [y/N] ' % code
+    loop = asyncio.get_event_loop()
+    try:
+        answer = await loop.run_in_executor(None, input, question)
+    except EOFError:
+        return False
+    return answer.strip().lower() in ("y", "yes")
+
+
+async def runReceive(args: argparse.Namespace) -> int:
+    if not args.auto_accept and not sys.stdin.isatty():
+        print("Nobody can answer transfer requests; use --auto-accept.", file=sys.stderr)
+        return 1
+    progress = ProgressPrinter(not args.quiet)
+    done = asyncio.Event()
+    failures = []
+    # Prompts would interleave, so sessions waiting for an answer queue up.
+    prompt = asyncio.Lock()
+
+    async def accept(files: List[FileMetadata], totalSize: int, deviceName: str, code: str) -> bool:
+        if args.auto_accept:
+            return True
+        async with prompt:
+            return await askAccept(files, totalSize, deviceName, code)
+
+    def sessionEnded(receiver: AsyncFileReceiver, error: Optional[BaseException]) -> None:
+        progress.clear()
+        peer = "%s (%s)" % (receiver.deviceName or "unknown device", receiver.peerAddress())
+        if error is None:
+            print(summary("Received", len(receiver.transferQ), receiver.stats, receiver.totalSize) + " from " + peer)
+        else:
+            failures.append(error)
+            print("Transfer from %s failed: %s" % (peer, error), file=sys.stderr)
+        if args.once:
+            done.set()
+
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        options = transferOptions(args, executor, progress)
+        try:
+            server = await serve(args.host, args.port, args.dir, accept, options, sessionEnded)
+        except OSError as e:
+            print(str(e), file=sys.stderr)
+            return 1
+        port = server.sockets[0].getsockname()[1]
+        discovery = await announce(options.deviceName, port) if args.discoverable else None
+        if not args.quiet:
+            print("Receiving into %s on port %d as %s" % (args.dir, port, options.deviceName))
+            sys.stdout.flush()
+        try:
+            await done.wait()
+        finally:
+            server.close()
+            if discovery is not None:
+                discovery.close()
+    return 1 if failures and not isinstance(failures[0], TransferRejected) else 0
+
+
+async def runPeers(args: argparse.Namespace) -> int:
+    peers = await discoverPeers(args.discovery_timeout)
+    for deviceName, (address, port) in sorted(peers.items()):
+        print("%s\t%s:%d" % (deviceName, address, port))
+    return 0
+
+
+def runDaemon(args: argparse.Namespace) -> int:
+    # Runs on the Qt event loop with the full-featured sessions of the GUI,
+    # and the settings the GUI saved.
+    from LANDrop.receiverdaemon import AcceptPolicy, run
+    logging.basicConfig(filename=args.log_file, level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    policy = AcceptPolicy(args.allow_from, args.allow_device, args.max_size, args.max_files, args.reject,
+                          args.reserve_space)
+    limits = {name: value for name, value in (("maxSessions", args.max_sessions), ("maxQueued", args.max_queued),
+                                              ("maxPerPeer", args.max_per_peer),
+                                              ("handshakeTimeout", args.handshake_timeout),
+                                              ("queueTimeout", args.queue_timeout)) if value is not None}
+    return run(args.dir, args.port, policy, args.crypto_threads, args.disk_threads, args.discoverable, limits)
+
+
+def defaultDownloadPath() -> str:
+    return os.path.join(os.path.expanduser("~"), "Downloads", "LANDrop")
+
+
+def addTransferArguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--name", help="device name shown to the peer (default: host name)")
+    parser.add_argument("--frame-size", type=parseFrameSize, default=DEFAULT_WIDE_FRAME_SIZE,
+                        help="largest frame to negotiate, e.g. 4M")
+    parser.add_argument("--no-compression", action="store_true", help="don't compress data")
+    parser.add_argument("--no-dedup", action="store_true", help="don't skip files the receiver has")
+    parser.add_argument("--limit-rate", type=parseSize, default=0, metavar="RATE",
+                        help="bytes per second to transfer at most, e.g. 10M")
+    parser.add_argument("-q", "--quiet", action="store_true", help="print errors only")
+
+
+def argumentParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="landrop", description="Transfer files to and from LANDrop devices "
+                                     "without a GUI. Run without a command to start the tray app.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    send = commands.add_parser("send", help="send files to a device")
+    send.add_argument("paths", nargs="+", metavar="FILE")
+    send.add_argument("--to", required=True, metavar="HOST:PORT|DEVICE-NAME",
+                      help="address of the receiver, or its name to find it on the local network")
+    send.add_argument("--discovery-timeout", type=float, default=DISCOVERY_TIMEOUT, metavar="SECONDS")
+    send.add_argument("--order", choices=SEND_ORDERS,
+                      help="order to send files in (default: as given, or priority with --first)")
+    send.add_argument("--first", action="append", default=[], metavar="PATTERN",
+                      help="send files whose name matches PATTERN before others; may be repeated")
+    addTransferArguments(send)
+
+    receive = commands.add_parser("receive", help="receive files until interrupted")
+    receive.add_argument("--dir", default=defaultDownloadPath(), help="where to save received files")
+    receive.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    receive.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on, 0 for any")
+    receive.add_argument("--auto-accept", action="store_true", help="accept every transfer without asking")
+    receive.add_argument("--once", action="store_true", help="exit after the first transfer")
+    receive.add_argument("--no-discovery", dest="discoverable", action="store_false",
+                         help="don't answer discovery requests")
+    addTransferArguments(receive)
+
+    daemon = commands.add_parser("daemon", help="receive from many devices at once, accepting by policy")
+    daemon.add_argument("--dir", default="", help="where to save received files (default: as in the GUI)")
+    daemon.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on, 0 for any")
+    daemon.add_argument("--allow-from", type=parseNetwork, action="append", default=[], metavar="NETWORK",
+                        help="accept only from this network, e.g. 10.0.0.0/8; repeatable")
+    daemon.add_argument("--allow-device", action="append", default=[], metavar="NAME",
+                        help="accept only from this device name; repeatable")
+    daemon.add_argument("--max-size", type=parseSize, default=0, help="reject larger transfers, e.g. 10G")
+    daemon.add_argument("--max-files", type=int, default=0, help="reject transfers of more files")
+    daemon.add_argument("--reject", action="append", default=[], metavar="PATTERN",
+                        help="reject transfers with a file matching this pattern, e.g. '*.exe'; repeatable")
+    daemon.add_argument("--reserve-space", type=parseSize, default=0, metavar="SIZE",
+                        help="reject transfers that would leave less free space")
+    daemon.add_argument("--max-sessions", type=int, help="sessions to run at once, 0 for no limit")
+    daemon.add_argument("--max-queued", type=int, help="connections to hold back beyond that")
+    daemon.add_argument("--max-per-peer", type=int, help="connections per sender address, 0 for no limit")
+    daemon.add_argument("--handshake-timeout", type=float, metavar="SECONDS",
+                        help="drop senders that haven't sent their file list by then")
+    daemon.add_argument("--queue-timeout", type=float, metavar="SECONDS",
+                        help="drop connections held back for longer")
+    daemon.add_argument("--crypto-threads", type=int, default=-1, help="threads for encryption, 0 for none")
+    daemon.add_argument("--disk-threads", type=int, default=0, help="threads for disk I/O")
+    daemon.add_argument("--no-discovery", dest="discoverable", action="store_false",
+                        help="don't answer discovery requests")
+    daemon.add_argument("--log-file", help="log here instead of to stderr")
+    daemon.add_argument("-v", "--verbose", action="store_true", help="also log statistics of every session")
+
+    peers = commands.add_parser("peers", help="list devices on the local network")
+    peers.add_argument("--discovery-timeout", type=float, default=DISCOVERY_TIMEOUT, metavar="SECONDS")
+    return parser
+
+
+def main(argv: List[str]) -> int:
+    args = argumentParser().parse_args(argv)
+    if args.command == "daemon":
+        return runDaemon(args)
+    run = {"send": runSend, "receive": runReceive, "peers": runPeers}[args.command]
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run(args))
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        loop.close()
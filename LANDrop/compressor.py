@@ -0,0 +1,169 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from LANDrop.transferrecord import RECORD_HEADER, RECORD_HEADER_SIZE, RecordType, encodeRecord
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Chunks smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 512
+# A chunk is only sent compressed if that saves at least this much of it.
+MIN_SAVING = 0.05
+# Before compressing a whole chunk, a sample of it is compressed.
+SAMPLE_SIZE = 64 << 10
+# After a chunk of a file didn't compress, this many chunks of that file
+# are sent as they are before the next attempt; the gap doubles with every
+# further failure up to MAX_BACKOFF.
+MAX_BACKOFF = 64
+# Backoff key for frames that hold several records.
+BATCH_KEY = -1
+
+_zstdLocal = threading.local()
+
+
+def _zstdCompress(data) -> bytes:
+    if not hasattr(_zstdLocal, "compressor"):
+        _zstdLocal.compressor = zstandard.ZstdCompressor(level=3)
+    return _zstdLocal.compressor.compress(data)
+
+
+def _zstdDecompress(data, size: int) -> bytes:
+    try:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    except zstandard.ZstdError as e:
+        raise ValueError(str(e))
+
+
+def _zlibCompress(data) -> bytes:
+    return zlib.compress(data, 1)
+
+
+def _zlibDecompress(data, size: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, size)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if not decompressor.eof or decompressor.unconsumed_tail:
+        raise ValueError("decompressed data too large")
+    return result
+
+
+@dataclass(frozen=True)
+class CompressionMethod:
+    name: str
+    compress: Callable
+    # Raises ValueError for corrupt data or data that would exceed size.
+    decompress: Callable
+
+
+COMPRESSION_METHODS = {
+    "zstd": CompressionMethod("zstd", _zstdCompress, _zstdDecompress),
+    "zlib": CompressionMethod("zlib", _zlibCompress, _zlibDecompress),
+}
+
+
+def availableCompression() -> List[str]:
+    # Fastest first.
+    methods = []
+    if zstandard is not None:
+        methods.append("zstd")
+    methods.append("zlib")
+    return methods
+
+
+def decompress(method: str, data, size: int) -> bytes:
+    result = COMPRESSION_METHODS[method].decompress(data, size)
+    if len(result) != size:
+        raise ValueError("decompressed size mismatch")
+    return result
+
+
+class AdaptiveCompressor:
+    # Compresses record frames on the crypto pool, backing off for files
+    # whose data doesn't compress (photos, videos, archives) so they cost
+    # next to nothing. The bookkeeping is shared by the pool threads; a lost
+    # update only changes when the next attempt is made.
+
+    def __init__(self, method: str) -> None:
+        self.method = COMPRESSION_METHODS[method]
+        self.skip: Dict[int, int] = {}
+        self.backoff: Dict[int, int] = {}
+
+    def compressFrame(self, frame: bytes) -> bytes:
+        # Returns the frame compressed, or unchanged if that wouldn't make
+        # it smaller. A frame holding one DATA record becomes a COMPRESSED
+        # record; a frame packed with several records is compressed as a
+        # whole into a COMPRESSED_RECORDS record.
+        recordType, fileIndex, offset, length, bodySize = RECORD_HEADER.unpack_from(frame)
+        if RECORD_HEADER_SIZE + bodySize < len(frame):
+            compressed = self.compress(BATCH_KEY, memoryview(frame))
+            if compressed is None:
+                return frame
+            return encodeRecord(RecordType.COMPRESSED_RECORDS, 0, 0, len(frame), compressed)
+        if recordType != RecordType.DATA:
+            return frame
+        compressed = self.compress(fileIndex, memoryview(frame)[RECORD_HEADER_SIZE:])
+        if compressed is None:
+            return frame
+        return encodeRecord(RecordType.COMPRESSED, fileIndex, offset, length, compressed)
+
+    def compress(self, key: int, data: memoryview) -> Optional[bytes]:
+        if len(data) < MIN_COMPRESS_SIZE:
+            return None
+        skip = self.skip.get(key, 0)
+        if skip > 0:
+            self.skip[key] = skip - 1
+            return None
+        if len(data) >= 2 * SAMPLE_SIZE and not self.worthIt(SAMPLE_SIZE, self.method.compress(data[:SAMPLE_SIZE])):
+            self.incompressible(key)
+            return None
+        compressed = self.method.compress(data)
+        if not self.worthIt(len(data), compressed):
+            self.incompressible(key)
+            return None
+        self.backoff.pop(key, None)
+        return compressed
+
+    @staticmethod
+    def worthIt(size: int, compressed: bytes) -> bool:
+        return len(compressed) <= size * (1 - MIN_SAVING)
+
+    def incompressible(self, key: int) -> None:
+        backoff = self.backoff.get(key, 1)
+        self.skip[key] = backoff
+        self.backoff[key] = min(backoff * 2, MAX_BACKOFF)
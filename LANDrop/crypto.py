@@ -28,10 +28,47 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from dataclasses import dataclass
+from typing import Callable, List, Optional
 from PyQt5.QtCore import QObject
 from LANDrop.sodium import *
 
 
+@dataclass(frozen=True)
+class CipherSuite:
+    name: str
+    encrypt: Callable
+    decrypt: Callable
+    nonceSize: int
+    tagSize: int
+
+
+DEFAULT_CIPHER = "chacha20poly1305-ietf"
+
+CIPHER_SUITES = {
+    DEFAULT_CIPHER: CipherSuite(DEFAULT_CIPHER, crypto_aead_chacha20poly1305_ietf_encrypt,
+                                crypto_aead_chacha20poly1305_ietf_decrypt,
+                                crypto_aead_chacha20poly1305_ietf_NPUBBYTES,
+                                crypto_aead_chacha20poly1305_ietf_ABYTES),
+    "aes256gcm": CipherSuite("aes256gcm", crypto_aead_aes256gcm_encrypt, crypto_aead_aes256gcm_decrypt,
+                             crypto_aead_aes256gcm_NPUBBYTES, crypto_aead_aes256gcm_ABYTES),
+    "aegis256": CipherSuite("aegis256", crypto_aead_aegis256_encrypt, crypto_aead_aegis256_decrypt,
+                            crypto_aead_aegis256_NPUBBYTES, crypto_aead_aegis256_ABYTES),
+}
+
+
+def availableCiphers() -> List[str]:
+    # Fastest first. Both AES based suites are only worth it with hardware
+    # AES, which is what crypto_aead_aes256gcm_is_available() reports.
+    ciphers = []
+    if crypto_aead_aes256gcm_is_available():
+        if crypto_aead_aegis256_encrypt is not None:
+            ciphers.append("aegis256")
+        ciphers.append("aes256gcm")
+    ciphers.append(DEFAULT_CIPHER)
+    return ciphers
+
+
 class Crypto:
     _inited: bool = False
 
@@ -45,6 +82,7 @@ class Crypto:
 
     def __init__(self) -> None:
         self.sessionKey: bytes = b""
+        self.cipher: CipherSuite = CIPHER_SUITES[DEFAULT_CIPHER]
         self.init()
         self.secretKey = randombytes(crypto_scalarmult_SCALARBYTES)
         self.publicKey = crypto_scalarmult_base(self.secretKey)
@@ -60,6 +98,12 @@ class Crypto:
     def publicKeySize(self) -> int:
         return crypto_aead_chacha20poly1305_ietf_KEYBYTES
 
+    def overhead(self) -> int:
+        return self.cipher.nonceSize + self.cipher.tagSize
+
+    def setCipher(self, name: str) -> None:
+        self.cipher = CIPHER_SUITES[name]
+
     def localPublicKey(self) -> bytes:
         return self.publicKey
 
@@ -80,25 +124,29 @@ class Crypto:
             hash_ |= h[i] << (i * 8)
         return f"{hash_ % 1000000:0>6}"
 
-    def encrypt(self, data: bytes) -> bytes:
+    # encrypt() and decrypt() may run on CryptoPool threads; callers pass the
+    # cipher that was current when the frame was queued.
+    def encrypt(self, data: bytes, cipher: Optional[CipherSuite] = None) -> bytes:
+        cipher = cipher or self.cipher
         if not isinstance(data, bytes):
             data = bytes(data)
-        nonce = randombytes(crypto_aead_chacha20poly1305_ietf_NPUBBYTES)
-        cipherText = crypto_aead_chacha20poly1305_ietf_encrypt(
+        nonce = randombytes(cipher.nonceSize)
+        cipherText = cipher.encrypt(
             data, None, nonce, self.sessionKey)
         return nonce + cipherText
 
-    def decrypt(self, data: bytes) -> bytes:
+    def decrypt(self, data: bytes, cipher: Optional[CipherSuite] = None) -> bytes:
+        cipher = cipher or self.cipher
         if not isinstance(data, bytes):
             data = bytes(data)
-        if len(data) < crypto_aead_chacha20poly1305_ietf_NPUBBYTES:
+        if len(data) < cipher.nonceSize:
             raise RuntimeError(QObject().tr(b"Cipher text too short."))
-        nonce = data[:crypto_aead_chacha20poly1305_ietf_NPUBBYTES]
-        cipherText = data[crypto_aead_chacha20poly1305_ietf_NPUBBYTES:]
+        nonce = data[:cipher.nonceSize]
+        cipherText = data[cipher.nonceSize:]
         try:
-            plainText = crypto_aead_chacha20poly1305_ietf_decrypt(
+            plainText = cipher.decrypt(
                 cipherText, None, nonce, self.sessionKey)
-        except (TypeError, ValueError) as e:
+        except (TypeError, ValueError, CryptoError) as e:
             raise RuntimeError(QObject().tr(
                 b"Decryption failed.") + " Error: " + str(e))
         return plainText
@@ -0,0 +1,101 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterator, Optional, Tuple
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+
+class CryptoPool:
+    # Process-wide worker threads for AEAD work. libsodium calls made
+    # through cffi release the GIL, so frames are encrypted and decrypted in
+    # parallel while the GUI thread keeps serving the event loop.
+    _instance: Optional['CryptoPool'] = None
+
+    def __init__(self, threads: int) -> None:
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="LANDropCrypto")
+
+    @classmethod
+    def instance(cls, threads: int) -> Optional['CryptoPool']:
+        # A size of 0 disables the pool and keeps crypto on the caller's
+        # thread. The first non-zero size wins for the life of the process.
+        if threads <= 0:
+            return None
+        if cls._instance is None:
+            cls._instance = CryptoPool(threads)
+        return cls._instance
+
+    @staticmethod
+    def defaultThreads() -> int:
+        return os.cpu_count() or 1
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.executor.submit(fn, *args)
+
+
+class FrameSequencer(QObject):
+    # Hands out results of pool jobs strictly in submission order, on the
+    # thread that owns the sequencer.
+    ready = pyqtSignal()
+
+    def __init__(self, parent: Optional[QObject], pool: CryptoPool, callback: Callable[[], None]) -> None:
+        super().__init__(parent)
+        self.pool = pool
+        self.pending: Deque[Tuple[Future, Any]] = deque()
+        self.ready.connect(callback, Qt.QueuedConnection)
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def submit(self, context: Any, fn: Callable, *args) -> None:
+        future = self.pool.submit(fn, *args)
+        self.pending.append((future, context))
+        future.add_done_callback(self._jobDone)
+
+    def takeReady(self) -> Iterator[Tuple[Any, Any]]:
+        # Yields (context, result) pairs; a failed job raises here, in order.
+        while self.pending and self.pending[0][0].done():
+            future, context = self.pending.popleft()
+            yield context, future.result()
+
+    def clear(self) -> None:
+        while self.pending:
+            self.pending.popleft()[0].cancel()
+
+    def _jobDone(self, future: Future) -> None:
+        try:
+            self.ready.emit()
+        except RuntimeError:
+            # The owning session was deleted while the job was running.
+            pass
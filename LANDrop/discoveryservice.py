@@ -32,7 +32,6 @@
 import json
 from typing import List, Optional
 from PyQt5.QtCore import QObject, pyqtSignal, QSysInfo
-from PyQt5.QtWidgets import QMessageBox, QApplication
 from PyQt5.QtNetwork import QHostAddress, QUdpSocket, QNetworkInterface
 from LANDrop.settings import Settings
 
@@ -41,6 +40,8 @@ DISCOVERY_PORT = 52637
 
 class DiscoveryService(QObject):
     newHost = pyqtSignal(str, QHostAddress, int)  # deviceName,addr,port
+    # Carries a message for the user; the service still works for sending.
+    bindFailed = pyqtSignal(str)
 
     def __init__(self, parent: Optional['QObject'] = None) -> None:
         super().__init__(parent)
@@ -51,11 +52,9 @@ class DiscoveryService(QObject):
     def start(self, serverPort: int) -> None:
         self.serverPort = serverPort
         if not self.socket.bind(QHostAddress.Any, DISCOVERY_PORT):
-            QMessageBox.warning(None, QApplication.applicationName(),
-                                self.tr(
-                                    "Unable to bind to port %1.\nYour device won't be discoverable."
-            ).replace(
-                                    "%1", str(DISCOVERY_PORT)))
+            self.bindFailed.emit(self.tr(
+                "Unable to bind to port %1.\nYour device won't be discoverable."
+            ).replace("%1", str(DISCOVERY_PORT)))
         for addr in self.broadcastAddresses():
             self.sendInfo(addr, DISCOVERY_PORT)
 
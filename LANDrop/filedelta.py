@@ -0,0 +1,214 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import math
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from LANDrop.sodium import crypto_generichash
+
+# Files smaller than this are always sent in full.
+DELTA_MIN_SIZE = 1 << 20
+MIN_BLOCK_SIZE = 2 << 10
+MAX_BLOCK_SIZE = 1 << 20
+STRONG_SIZE = 16
+# weak checksum, strong checksum
+SIGNATURE = struct.Struct(">I%ds" % STRONG_SIZE)
+# Bytes the sender slides its window over byte by byte per file. Past this
+# only block aligned matches are looked for, which still finds in place
+# edits and appended data without the cost of rolling through a file that
+# changed completely.
+ROLL_LIMIT = 4 << 20
+READ_SIZE = 1 << 20
+ADLER_MOD = 65521
+
+# Signatures and deltas are disk bound; one thread serves every session.
+_executor = ThreadPoolExecutor(1, thread_name_prefix="LANDropDelta")
+
+# (offset in the new file, length, offset in the old file or -1 for literal data)
+DeltaInstruction = Tuple[int, int, int]
+
+
+def integerSqrt(n: int) -> int:
+    # math.isqrt needs Python 3.8. The float root may be off by one for
+    # large n; both ends must agree exactly, so it is corrected.
+    root = int(math.sqrt(n))
+    while root * root > n:
+        root -= 1
+    while (root + 1) * (root + 1) <= n:
+        root += 1
+    return root
+
+
+def deltaBlockSize(size: int) -> int:
+    # Both ends derive the block size from the size of the old file.
+    blockSize = 1 << (max(1, integerSqrt(size)) - 1).bit_length()
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, blockSize))
+
+
+def strongChecksum(data) -> bytes:
+    return crypto_generichash(bytes(data), digest_size=STRONG_SIZE)
+
+
+def computeSignatures(path: str) -> Tuple[int, bytes]:
+    # Signatures of the whole blocks of the old copy of a file. A trailing
+    # partial block is never matched and has no signature.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        blockSize = deltaBlockSize(size)
+        signatures = bytearray()
+        for _ in range(size // blockSize):
+            block = f.read(blockSize)
+            if len(block) != blockSize:
+                raise OSError("file changed while reading")
+            signatures += SIGNATURE.pack(zlib.adler32(block), strongChecksum(block))
+    return size, bytes(signatures)
+
+
+def computeDelta(path: str, size: int, basisSize: int, signatures: bytes) -> List[DeltaInstruction]:
+    # Describes the file at path in terms of blocks of the old copy, given
+    # their signatures; whatever doesn't match is sent as literal data.
+    blockSize = deltaBlockSize(basisSize)
+    weakIndex: Dict[int, List[int]] = {}
+    strongIndex: Dict[bytes, int] = {}
+    for block, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+        weakIndex.setdefault(weak, []).append(block)
+        strongIndex.setdefault(strong, block)
+
+    instructions: List[DeltaInstruction] = []
+
+    def add(offset: int, length: int, basisOffset: int) -> None:
+        if instructions:
+            lastOffset, lastLength, lastBasisOffset = instructions[-1]
+            if basisOffset < 0 and lastBasisOffset < 0:
+                instructions[-1] = (lastOffset, lastLength + length, -1)
+                return
+            if basisOffset >= 0 and lastBasisOffset >= 0 and lastBasisOffset + lastLength == basisOffset:
+                instructions[-1] = (lastOffset, lastLength + length, lastBasisOffset)
+                return
+        instructions.append((offset, length, basisOffset))
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size != size:
+            raise OSError("file changed while reading")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            pos = 0
+            literalStart = 0
+            rollBudget = ROLL_LIMIT
+            while pos + blockSize <= size:
+                # Try the block right at pos first; that is all an unchanged
+                # region needs.
+                block = strongIndex.get(strongChecksum(data[pos:pos + blockSize]))
+                if block is None:
+                    if rollBudget <= 0:
+                        pos += blockSize
+                        continue
+                    end = min(size - blockSize, pos + rollBudget)
+                    block, found = rollSearch(data, pos, end, blockSize, weakIndex, signatures)
+                    if block is None:
+                        rollBudget -= end + 1 - pos
+                        pos = end + 1
+                        continue
+                    rollBudget -= found - pos
+                    pos = found
+                if literalStart < pos:
+                    add(literalStart, pos - literalStart, -1)
+                add(pos, blockSize, block * blockSize)
+                pos += blockSize
+                literalStart = pos
+            if literalStart < size:
+                add(literalStart, size - literalStart, -1)
+    return instructions
+
+
+def rollSearch(data, pos: int, end: int, blockSize: int, weakIndex: Dict[int, List[int]],
+               signatures: bytes) -> Tuple[Optional[int], int]:
+    # Slides an Adler-32 window from pos up to end until it lines up with a
+    # block of the old copy. Returns the block and where it was found.
+    window = zlib.adler32(data[pos:pos + blockSize])
+    a = window & 0xFFFF
+    b = window >> 16
+    while True:
+        candidates = weakIndex.get(a | (b << 16))
+        if candidates is not None:
+            strong = strongChecksum(data[pos:pos + blockSize])
+            for block in candidates:
+                if SIGNATURE.unpack_from(signatures, block * SIGNATURE.size)[1] == strong:
+                    return block, pos
+        if pos >= end:
+            return None, pos
+        out = data[pos]
+        new = data[pos + blockSize]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - blockSize * out + a - 1) % ADLER_MOD
+        pos += 1
+
+
+class DeltaJob(QObject):
+    # Runs a signature or delta computation on the delta thread. finished is
+    # emitted on the thread that owns the job; result() is None if the file
+    # couldn't be read.
+    finished = pyqtSignal()
+    _done = pyqtSignal()
+
+    def __init__(self, parent: Optional[QObject], fn, *args) -> None:
+        super().__init__(parent)
+        self.fn = fn
+        self.args = args
+        self.future: Optional[Future] = None
+        self._done.connect(self.finished, Qt.QueuedConnection)
+
+    def start(self) -> None:
+        self.future = _executor.submit(self.run)
+        self.future.add_done_callback(self._jobDone)
+
+    def isFinished(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def run(self):
+        try:
+            return self.fn(*self.args)
+        except (OSError, ValueError):
+            return None
+
+    def _jobDone(self, future: Future) -> None:
+        try:
+            self._done.emit()
+        except RuntimeError:
+            # The owning session was deleted meanwhile.
+            pass
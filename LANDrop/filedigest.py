@@ -0,0 +1,166 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from LANDrop.sodium import generichash_blake2b_init, generichash_blake2b_update, generichash_blake2b_final
+
+DIGEST_SIZE = 32
+READ_SIZE = 1 << 20
+MAX_CACHE_ENTRIES = 100000
+
+# Hashing is disk bound, so one thread serves every session; it is also the
+# only thread that touches the digest cache.
+_executor = ThreadPoolExecutor(1, thread_name_prefix="LANDropDigest")
+
+
+def fileDigest(path: str) -> str:
+    state = generichash_blake2b_init(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            generichash_blake2b_update(state, data)
+    return generichash_blake2b_final(state).hex()
+
+
+def encodeBitmap(indices: Iterable[int], count: int) -> str:
+    bitmap = bytearray((count + 7) // 8)
+    for i in indices:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    return base64.b64encode(bytes(bitmap)).decode("ascii")
+
+
+def decodeBitmap(encoded: str, count: int) -> Optional[Set[int]]:
+    try:
+        bitmap = base64.b64decode(encoded, validate=True)
+    except ValueError:
+        return None
+    if len(bitmap) != (count + 7) // 8:
+        return None
+    return {i for i in range(count) if bitmap[i >> 3] & (1 << (i & 7))}
+
+
+class DigestCache:
+    # Digests of files we hashed before, keyed by path and invalidated by a
+    # change of size or modification time.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Optional[Dict[str, list]] = None
+
+    def load(self) -> None:
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        self.entries = entries if isinstance(entries, dict) else {}
+
+    def digest(self, path: str) -> Optional[str]:
+        self.load()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self.entries.get(path)
+        if isinstance(entry, list) and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        try:
+            digest = fileDigest(path)
+        except OSError:
+            return None
+        self.entries.pop(path, None)
+        self.entries[path] = [st.st_size, st.st_mtime_ns, digest]
+        while len(self.entries) > MAX_CACHE_ENTRIES:
+            del self.entries[next(iter(self.entries))]
+        return digest
+
+    def save(self) -> None:
+        if self.entries is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmpPath = self.path + ".tmp"
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmpPath, self.path)
+        except OSError:
+            pass
+
+
+class FileDigester(QObject):
+    # Hashes a list of files on the digest thread; None entries and files
+    # that can't be read get a None digest. finished is emitted on the thread
+    # that owns the digester.
+    finished = pyqtSignal()
+    _done = pyqtSignal()
+
+    _cache: Optional[DigestCache] = None
+
+    def __init__(self, parent: Optional[QObject], paths: List[Optional[str]], cachePath: str) -> None:
+        super().__init__(parent)
+        self.paths = paths
+        self.future: Optional[Future] = None
+        if FileDigester._cache is None or FileDigester._cache.path != cachePath:
+            FileDigester._cache = DigestCache(cachePath)
+        self.cache = FileDigester._cache
+        self._done.connect(self.finished, Qt.QueuedConnection)
+
+    def start(self) -> None:
+        self.future = _executor.submit(self.run)
+        self.future.add_done_callback(self._jobDone)
+
+    def isFinished(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self) -> List[Optional[str]]:
+        return self.future.result()
+
+    def run(self) -> List[Optional[str]]:
+        digests = [self.cache.digest(path) if path else None for path in self.paths]
+        self.cache.save()
+        return digests
+
+    def _jobDone(self, future: Future) -> None:
+        try:
+            self._done.emit()
+        except RuntimeError:
+            # The owning session was deleted while hashing.
+            pass
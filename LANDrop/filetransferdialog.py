@@ -33,6 +33,7 @@ from PyQt5.QtCore import Qt, QLocale
 from PyQt5.QtWidgets import QWidget, QDialog, QMessageBox, QApplication
 from LANDrop.ui_filetransferdialog import Ui_FileTransferDialog
 from LANDrop.filetransfersession import FileTransferSession
+from LANDrop.transferprogress import TransferProgress, formatDuration
 
 
 class FileTransferDialog(QDialog):
@@ -66,8 +67,15 @@ class FileTransferDialog(QDialog):
         if not response:
             self.hide()
 
-    def sessionUpdateProgress(self, progress: float) -> None:
-        self.ui.progressBar.setValue(self.ui.progressBar.maximum() * progress)
+    def sessionUpdateProgress(self, progress: TransferProgress) -> None:
+        self.ui.progressBar.setValue(int(self.ui.progressBar.maximum() * progress.fraction()))
+        text = "%p%"
+        if progress.averageThroughput > 0:
+            text += " - " + self.tr("%1/s").replace("%1", self.locale().formattedDataSize(
+                int(progress.averageThroughput), 1, QLocale.DataSizeTraditionalFormat))
+        if progress.eta > 0:
+            text += " - " + self.tr("%1 left").replace("%1", formatDuration(progress.eta))
+        self.ui.progressBar.setFormat(text)
 
     def sessionErrorOccurred(self, msg: str) -> None:
         if self.errored:
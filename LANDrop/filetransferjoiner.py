@@ -0,0 +1,78 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+from typing import Optional
+
+from PyQt5.QtCore import QObject
+from PyQt5.QtNetwork import QTcpSocket
+
+from LANDrop.filetransfersession import FileTransferSession, State
+
+
+class FileTransferJoiner(FileTransferSession):
+    # Opens an additional connection for a sender whose receiver agreed to
+    # several streams. It runs the usual key exchange, proves it belongs to
+    # the session with the token from the receiver's response, and then
+    # hands its connection over to the sender.
+
+    def __init__(self, parent: Optional[QObject], socket: QTcpSocket, sender: FileTransferSession,
+                 token: str) -> None:
+        super().__init__(parent, socket)
+        self.sender = sender
+        self.token = token
+
+        self.socket.connected.connect(self.start)
+        self.errorOccurred.connect(self.deleteLater)
+
+    def handshake1Finished(self) -> None:
+        obj = {"join": self.token}
+        self.encryptAndSend(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    def processReceivedData(self, data: bytes) -> None:
+        if self.state != State.HANDSHAKE2:
+            return
+        try:
+            obj = json.loads(data)
+        except json.JSONDecodeError:
+            self.errorOccurred.emit(self.tr("Handshake failed."))
+            return
+
+        if obj.get("joined") != 1 or self.sender.state != State.TRANSFERRING:
+            self.errorOccurred.emit(self.tr("Handshake failed."))
+            return
+
+        self.sender.adoptStream(self.streams.pop())
+        self.state = State.FINISHED
+        self.sender.socketBytesWritten()
+        self.deleteLater()
+
+    def respond(self, accepted: bool) -> None:
+        raise RuntimeError("respond not implemented")
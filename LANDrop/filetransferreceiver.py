@@ -29,27 +29,59 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import json
-from typing import Optional
-from PyQt5.QtCore import QDir, QFileInfo, QFile, QIODevice, QObject, QUrl, QTimer
+from typing import BinaryIO, Callable, Dict, List, Optional, Set
+from PyQt5.QtCore import QDir, QFileInfo, QObject, QUrl, QTimer
 from PyQt5.QtGui import QDesktopServices
 from PyQt5.QtNetwork import QTcpSocket
 from LANDrop.filetransfersession import FileTransferSession, State
+from LANDrop.transferrecord import RecordType, RECORD_HEADER_SIZE, COPY_BODY, encodeRecord, decodeRecords
 from LANDrop.settings import Settings
+from LANDrop.sodium import randombytes
+from LANDrop.partfile import PartFile
+from LANDrop.filedigest import FileDigester, READ_SIZE
+from LANDrop.filedelta import DeltaJob, DELTA_MIN_SIZE, SIGNATURE, computeSignatures
+from LANDrop.compressor import decompress
+from LANDrop.filewriter import DiskPool, FileWriter
+from LANDrop.transferprotocol import (ManifestReader, ReceiveLedger, TransferResponse, findResumeOffsets,
+                                      matchingFiles, validRecord)
 
 
 class FileTransferReceiver(FileTransferSession):
+    # Sessions that accepted extra streams, by the token given to the sender.
+    joinableSessions: Dict[str, 'FileTransferReceiver'] = {}
 
     def __init__(self, parent: Optional['QObject'], socket: QTcpSocket) -> None:
         super().__init__(parent, socket)
-        self.writingFile = None
         self.downloadPath = Settings.downloadPath()
+        # Whether the download path is shown in the file manager once the
+        # files are in.
+        self.openDownloadPath = True
+        self.negotiatedCapabilities = None
+        self.streamToken = ""
+        self.openFiles: Dict[int, PartFile] = {}
+        # Set once the session failed. Frames already in flight are dropped
+        # rather than reopening, and truncating, the files left to resume.
+        self.filesAbandoned = False
+        self.writer = FileWriter(self, Settings.durability(), DiskPool.instance(Settings.diskThreads()))
+        self.writer.failed.connect(self.errorOccurred)
+        self.writer.drained.connect(self.resumeReading)
+        self.resumeOffsets: Dict[int, int] = {}
+        self.haveFiles: Set[int] = set()
+        self.digester: Optional[FileDigester] = None
+        # Files rebuilt from a delta against the version already in the
+        # download path, and that version opened for reading.
+        self.deltaFiles: Set[int] = set()
+        self.signatureJobs: List[DeltaJob] = []
+        self.basisFiles: Dict[int, BinaryIO] = {}
+        self.manifest = ManifestReader()
+        self.ledger: Optional[ReceiveLedger] = None
+
+        self.errorOccurred.connect(self.abandonFiles)
 
     def respond(self, accepted: bool) -> None:
-        obj = {
-            "response": int(accepted)
-        }
-        self.encryptAndSend(json.dumps(
-            obj, ensure_ascii=False).encode("utf-8"))
+        if accepted and self.digester is not None and not self.digester.isFinished():
+            self.digester.finished.connect(lambda: self.respond(True))
+            return
 
         if accepted:
             if not QDir().mkpath(self.downloadPath):
@@ -62,102 +94,316 @@ class FileTransferReceiver(FileTransferSession):
                     self.tr("Download path is not writable: ") + self.downloadPath)
                 return
 
+        response = TransferResponse(accepted, self.negotiatedCapabilities)
+        if accepted and self.negotiatedCapabilities:
+            if self.negotiatedCapabilities.streams > 1:
+                self.streamToken = randombytes(16).hex()
+            if self.negotiatedCapabilities.dedup and self.digester is not None:
+                self.haveFiles = matchingFiles(self.transferQ, self.digester.result())
+            if self.negotiatedCapabilities.resume:
+                self.resumeOffsets = findResumeOffsets(self.transferQ, self.filePath, self.haveFiles)
+            if self.negotiatedCapabilities.delta:
+                self.findDeltaFiles()
+            response = TransferResponse(accepted, self.negotiatedCapabilities, self.haveFiles, self.resumeOffsets,
+                                        self.deltaFiles, self.streamToken)
+        self.sendMessage(response.toJson(len(self.transferQ)))
+
+        if accepted:
+            if self.negotiatedCapabilities:
+                self.applyCapabilities(self.negotiatedCapabilities)
+
+            if self.streamToken:
+                FileTransferReceiver.joinableSessions[self.streamToken] = self
+                self.destroyed.connect(
+                    lambda _=None, token=self.streamToken: FileTransferReceiver.joinableSessions.pop(token, None))
+
             self.state = State.TRANSFERRING
-            self.createNextFile()
+            self.progress.start(self.totalSize, self.transferredSize)
+            self.startStats()
+            self.startSignatures()
+            self.startTransfer()
         else:
             self.socket.bytesWritten.connect(self.ended)
 
+    def startDigester(self) -> None:
+        # Hash the files in the download path that could be identical to
+        # announced ones, while the user decides whether to accept.
+        paths = []
+        for index, metadata in enumerate(self.transferQ):
+            path = None
+            if metadata.digest and QFileInfo(self.filePath(index)).size() == metadata.size:
+                path = self.filePath(index)
+            paths.append(path)
+        if any(paths):
+            self.digester = FileDigester(self, paths, Settings.digestCachePath())
+            self.digester.start()
+
+    def findDeltaFiles(self) -> None:
+        for index, metadata in enumerate(self.transferQ):
+            if metadata.size < DELTA_MIN_SIZE or index in self.haveFiles or index in self.resumeOffsets:
+                continue
+            info = QFileInfo(self.filePath(index))
+            if info.isFile() and info.size() >= DELTA_MIN_SIZE:
+                self.deltaFiles.add(index)
+
+    def startSignatures(self) -> None:
+        for index in sorted(self.deltaFiles):
+            job = DeltaJob(self, computeSignatures, self.filePath(index))
+            job.finished.connect(lambda index=index, job=job: self.sendSignatures(index, job))
+            self.signatureJobs.append(job)
+            job.start()
+
+    def sendSignatures(self, index: int, job: DeltaJob) -> None:
+        if self.state != State.TRANSFERRING:
+            return
+        result = job.result()
+        basisSize, signatures = result if result is not None else (0, b"")
+        if basisSize > 0:
+            try:
+                self.basisFiles[index] = open(self.filePath(index), "rb")
+            except OSError:
+                basisSize, signatures = 0, b""
+        if basisSize == 0:
+            self.deltaFiles.discard(index)
+
+        perRecord = (self.maxPayloadSize() - RECORD_HEADER_SIZE) // SIGNATURE.size
+        block = 0
+        while True:
+            body = signatures[block * SIGNATURE.size:(block + perRecord) * SIGNATURE.size]
+            self.encryptAndSend(encodeRecord(RecordType.SIGNATURES, index, block, basisSize, body))
+            block += perRecord
+            if block * SIGNATURE.size >= len(signatures):
+                break
+
     def processReceivedData(self, data: bytes) -> None:
         if self.state == State.HANDSHAKE2:
             try:
                 obj = json.loads(data)
-            except json.JSONDecodeError:
+            except ValueError:
                 self.ended.emit()
                 return
-
-            deviceName = obj["device_name"]
-            if not isinstance(deviceName, str):
+            if not isinstance(obj, dict):
                 self.ended.emit()
                 return
 
-            filesJson = obj["files"]
-            if not isinstance(filesJson, list):
-                self.ended.emit()
+            # An additional stream of a session that is already running.
+            if "join" in obj:
+                self.joinSession(obj["join"])
                 return
 
-            filesJsonArray = filesJson
-            if not filesJsonArray:
+            if not self.manifest.read(obj):
                 self.ended.emit()
                 return
+            if self.manifest.isComplete():
+                self.manifestReceived()
+        elif self.state == State.TRANSFERRING and not self.filesAbandoned:
+            if self.capabilities.usesRecords():
+                self.processRecords(data)
+            else:
+                self.processRawData(data)
 
-            for v in filesJsonArray:
-                if not isinstance(v, dict):
-                    self.ended.emit()
-                    return
-                o = v
-
-                filename = o["filename"]
-                if not isinstance(filename, str):
-                    self.ended.emit()
-                    return
-
-                size = o["size"]
-                if not isinstance(size, (int, float)):
-                    self.ended.emit()
-                    return
-
-                sizeInt = int(size)
-                self.totalSize += sizeInt
-                self.transferQ.append(FileTransferSession.FileMetadata(
-                    filename, sizeInt))
-
-            self.fileMetadataReady.emit(self.transferQ, self.totalSize, deviceName,
-                                        self.crypto.sessionKeyDigest())
-        elif self.state == State.TRANSFERRING:
-            self.transferredSize += len(data)
-            self.updateProgress.emit(
-                float(self.transferredSize) / self.totalSize)
-            tmpData = data
-            while len(tmpData) > 0:
-                curFile = self.transferQ[0]
-                writeSize = min(curFile.size, len(tmpData))
-                written = self.writingFile.write(tmpData[:writeSize])
-                curFile.size -= written
-                tmpData = tmpData[written:]
-                if curFile.size == 0:
-                    self.transferQ = self.transferQ[1:]
-                    self.createNextFile()
-
-    def createNextFile(self) -> None:
-        while self.transferQ:
-            curFile = self.transferQ[0]
-            filename = self.downloadPath + QDir.separator() + curFile.filename
-            if self.writingFile:
-                self.writingFile.deleteLater()
-                self.writingFile = None
-            self.writingFile = QFile(filename, self)
-            if not self.writingFile.open(QIODevice.WriteOnly):
-                self.errorOccurred.emit(
-                    self.tr("Unable to open file %1.").replace("%1", filename))
+    def manifestReceived(self) -> None:
+        self.transferQ = self.manifest.files
+        self.totalSize = self.manifest.totalSize
+        # Only senders that support negotiation offer capabilities.
+        if self.manifest.offer is not None:
+            self.negotiatedCapabilities = self.localCapabilities().negotiate(self.manifest.offer)
+        if self.negotiatedCapabilities and self.negotiatedCapabilities.dedup:
+            self.startDigester()
+        self.fileMetadataReady.emit(self.transferQ, self.totalSize, self.manifest.deviceName,
+                                    self.crypto.sessionKeyDigest())
+
+    def joinSession(self, token) -> None:
+        session = None
+        if isinstance(token, str):
+            session = FileTransferReceiver.joinableSessions.get(token)
+        if (session is None or session.state != State.TRANSFERRING
+                or len(session.streams) >= session.capabilities.streams):
+            self.ended.emit()
+            return
+
+        obj = {"joined": 1}
+        self.encryptAndSend(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+        session.adoptStream(self.streams.pop())
+        self.state = State.FINISHED
+        self.ended.emit()
+
+    def processRawData(self, data: bytes) -> None:
+        # The original data phase: file contents back to back, in order.
+        view = memoryview(data)
+        while view:
+            chunk = self.ledger.nextRawChunk(len(view))
+            if chunk is None:
+                self.errorOccurred.emit(self.tr("Received invalid data."))
+                return
+            index, offset, size = chunk
+            if not self.writeFileData(index, offset, view[:size]):
                 return
+            view = view[size:]
 
-            if curFile.size > 0:
-                self.printMessage.emit(
-                    self.tr("Receiving file %1...").replace("%1", curFile.filename))
-                break
+    def processRecords(self, data: bytes, nested: bool = False) -> bool:
+        try:
+            for record in decodeRecords(data):
+                if not validRecord(record, self.capabilities, nested):
+                    self.errorOccurred.emit(self.tr("Received invalid data."))
+                    return False
+                if record.type == RecordType.DATA:
+                    if not self.writeFileData(record.fileIndex, record.offset, record.body):
+                        return False
+                elif record.type == RecordType.COMPRESSED_RECORDS:
+                    records = decompress(self.capabilities.compressionMethod(), record.body, record.length)
+                    if not self.processRecords(records, True):
+                        return False
+                elif record.type == RecordType.COMPRESSED:
+                    body = decompress(self.capabilities.compressionMethod(), record.body, record.length)
+                    if not self.writeFileData(record.fileIndex, record.offset, body):
+                        return False
+                elif record.type == RecordType.ZERO:
+                    if not self.zeroFileData(record.fileIndex, record.offset, record.length):
+                        return False
+                else:
+                    basisOffset, = COPY_BODY.unpack(record.body)
+                    if not self.copyFileData(record.fileIndex, record.offset, record.length, basisOffset):
+                        return False
+        except ValueError:
+            self.errorOccurred.emit(self.tr("Received invalid data."))
+            return False
+        return True
+
+    def startTransfer(self) -> None:
+        self.ledger = ReceiveLedger(self.transferQ, self.haveFiles, self.resumeOffsets)
+        self.transferredSize += self.ledger.initialSize
+        for index in self.ledger.completeFiles:
+            self.openFile(index)
+            self.closeFile(index)
+        self.checkFinished()
+
+    def filePath(self, index: int) -> str:
+        return self.downloadPath + QDir.separator() + self.transferQ[index].filename
+
+    def openFile(self, index: int) -> PartFile:
+        # Like all file I/O of the session, opening happens on the writer
+        # thread; failures are reported from there.
+        file = self.openFiles.get(index)
+        if file is not None:
+            return file
+        metadata = self.transferQ[index]
+        file = PartFile(self.filePath(index), metadata.size, metadata.mtime, not metadata.sparse)
+        self.writer.submit(self.tr("Unable to open file %1.").replace("%1", file.path), 0,
+                           file.open, self.resumeOffsets.get(index, 0))
+        if metadata.size > 0:
+            self.printMessage.emit(
+                self.tr("Receiving file %1...").replace("%1", metadata.filename))
+            self.progress.setCurrentFile(metadata.filename)
+        self.openFiles[index] = file
+        return file
+
+    def copyFileData(self, index: int, offset: int, length: int, basisOffset: int) -> bool:
+        # Data the file shares with the version we already have.
+        basis = self.basisFiles.get(index)
+        if basis is None:
+            self.errorOccurred.emit(self.tr("Received invalid data."))
+            return False
+        return self.storeFileData(index, offset, length,
+                                  lambda file: copyRange(basis, basisOffset, file, offset, length))
+
+    def closeBasisFile(self, index: int) -> None:
+        basis = self.basisFiles.pop(index, None)
+        if basis is not None:
+            self.writer.submitAlways(basis.close)
+
+    def closeFile(self, index: int) -> bool:
+        self.closeBasisFile(index)
+        file = self.openFiles.pop(index, None)
+        if file is not None:
+            self.writer.complete(self.tr("Unable to write file %1.").replace("%1", file.path), file)
+        return True
+
+    def abandonFiles(self) -> None:
+        # Keep what was received so far so the transfer can be resumed.
+        self.filesAbandoned = True
+        for file in self.openFiles.values():
+            self.writer.submitAlways(file.abandon)
+        self.openFiles.clear()
+        for index in list(self.basisFiles):
+            self.closeBasisFile(index)
+
+    def writeFileData(self, index: int, offset: int, data: memoryview) -> bool:
+        return self.storeFileData(index, offset, len(data), lambda file: file.write(offset, data))
 
-            self.transferQ = self.transferQ[1:]
+    def zeroFileData(self, index: int, offset: int, length: int) -> bool:
+        return self.storeFileData(index, offset, length, lambda file: file.zero(offset, length))
 
-        if not self.transferQ:
-            if self.writingFile:
-                self.writingFile.deleteLater()
-                self.writingFile = None
+    def storeFileData(self, index: int, offset: int, length: int, store: Callable[[PartFile], None]) -> bool:
+        if self.filesAbandoned:
+            return False
+        if not self.ledger.claim(index, offset, length):
+            self.errorOccurred.emit(self.tr("Received invalid data."))
+            return False
+        file = self.openFile(index)
+        self.writer.submit(self.tr("Unable to write file %1.").replace("%1", file.path), length, store, file)
+        self.stats.updateWriteQueueBytes(self.writer.pendingBytes)
 
-            self.state = State.FINISHED
+        self.transferredSize += length
+        self.progress.update(self.transferredSize)
+        if self.ledger.isFileComplete(index):
+            if not self.closeFile(index):
+                return False
+            self.checkFinished()
+        return True
+
+    def checkFinished(self) -> None:
+        if self.state != State.TRANSFERRING or not self.ledger.isComplete():
+            return
+
+        self.state = State.FINISHED
+        self.progress.finish()
+        FileTransferReceiver.joinableSessions.pop(self.streamToken, None)
+        self.writer.finished.connect(self.writesFinished)
+        self.writer.finish()
+
+    def writesFinished(self) -> None:
+        if self.writer.hasFailed():
+            return
+        self.endStats()
+        if self.openDownloadPath:
             QDesktopServices.openUrl(QUrl.fromLocalFile(self.downloadPath))
-            self.printMessage.emit(self.tr("Done!"))
-            self.socket.disconnectFromHost()
-            QTimer.singleShot(5000, self.ended)
+        self.printMessage.emit(self.tr("Done!"))
+        self.disconnectFromHost()
+        QTimer.singleShot(5000, self.ended)
+
+    def collectStats(self) -> None:
+        self.stats.diskWriteTime = self.writer.writeTime
+        self.stats.writeQueueBytes = self.writer.pendingBytes
+
+    def readingPaused(self) -> bool:
+        # Received data waits in the sockets while the disk catches up or
+        # the rate limit is used up; TCP then slows the sender down.
+        if self.writer.isFull():
+            return True
+        if self.state != State.TRANSFERRING:
+            return False
+        self.refreshRateLimits()
+        return self.rateLimited(self.receiveLimit)
+
+    def rateLimitPassed(self) -> None:
+        self.resumeReading()
+
+    def resumeReading(self) -> None:
+        for stream in self.streams:
+            stream.socketReadyRead()
 
     def handshake1Finished(self):
         pass
+
+
+def copyRange(basis: BinaryIO, basisOffset: int, file: PartFile, offset: int, length: int) -> None:
+    end = offset + length
+    while offset < end:
+        basis.seek(basisOffset)
+        data = basis.read(min(READ_SIZE, end - offset))
+        if not data:
+            raise OSError("unexpected end of file")
+        file.write(offset, data)
+        offset += len(data)
+        basisOffset += len(data)
@@ -27,91 +27,373 @@
 # CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-import json
-from typing import Optional, List
+import time
+from typing import Dict, Iterator, Optional, List, Set, Tuple
 
 from PyQt5.QtCore import QSysInfo, QFileInfo, QTimer, QObject, QFile
 from PyQt5.QtNetwork import QTcpSocket
 
 from LANDrop.filetransfersession import FileTransferSession, State
+from LANDrop.filetransferjoiner import FileTransferJoiner
+from LANDrop.filedigest import FileDigester
+from LANDrop.filedelta import DeltaJob, SIGNATURE, computeDelta, deltaBlockSize
+from LANDrop.transferstream import TransferStream
+from LANDrop.transferrecord import RecordType, COPY_BODY, encodeRecord, decodeRecords
 from LANDrop.settings import Settings
+from LANDrop.capabilities import Capabilities
+from LANDrop.compressor import AdaptiveCompressor
+from LANDrop.sparse import SPARSE_MIN_SIZE, dataSegments, hasHoles
+from LANDrop.manifest import manifestMessages
+from LANDrop.transferprotocol import (RecordBatch, TransferResponse, dataRecord, rawQuanta, recordQuanta, sendsHoles,
+                                      zeroRecords)
+from LANDrop.sendorder import ORDER_ROUND_ROBIN, interleave, orderFiles
 
-TRANSFER_QUANTA = 64000
+# Transfers smaller than this don't offer extra streams; setting up the
+# connections would take longer than it saves.
+STRIPE_MIN_SIZE = 32 << 20
+# Copies are cheap to send but the receiver does the reading and writing;
+# splitting them keeps each step short.
+COPY_QUANTA = 16 << 20
+# Manifest pages queued at a time while the file list is sent.
+MANIFEST_WINDOW = 1 << 20
 
 
 class FileTransferSender(FileTransferSession):
 
     def __init__(self, parent: Optional[QObject], socket: QTcpSocket, files: List[QFile]) -> None:
         super().__init__(parent, socket)
-        self.files = files
-        self.socket.bytesWritten.connect(self.socketBytesWritten)
+        self.sendOrder = Settings.sendOrder()
+        order = orderFiles(self.sendOrder, [file.fileName() for file in files], [file.size() for file in files],
+                           Settings.sendPriorities())
+        self.files = [files[index] for index in order]
+        self.offeredCapabilities = None
+        self.frames: Optional[Iterator[Optional[Tuple[bytes, int]]]] = None
+        self.resumeOffsets: Dict[int, int] = {}
+        self.skippedFiles: Set[int] = set()
+        self.digester: Optional[FileDigester] = None
+        # Files sent as deltas: signatures received so far, the size of the
+        # receiver's copy, and the delta computation once they are complete.
+        self.deltaSignatures: Dict[int, bytearray] = {}
+        self.deltaBasisSizes: Dict[int, int] = {}
+        self.deltaJobs: Dict[int, DeltaJob] = {}
+        self.compressor: Optional[AdaptiveCompressor] = None
+        self.manifestPages: Optional[Iterator[bytes]] = None
+        # The next frame, while the rate limit holds it back.
+        self.heldFrame: Optional[Tuple[bytes, int]] = None
+        self.stats.sendWindow = Settings.sendWindow()
 
         for file in self.files:
-            filename = QFileInfo(file).fileName()
+            info = QFileInfo(file)
+            filename = info.fileName()
             size = file.size()
             self.totalSize += size
             self.transferQ.append(
-                FileTransferSession.FileMetadata(filename, size))
+                FileTransferSession.FileMetadata(filename, size, info.lastModified().toMSecsSinceEpoch()))
+
+    def localCapabilities(self) -> Capabilities:
+        capabilities = super().localCapabilities()
+        if self.totalSize < STRIPE_MIN_SIZE:
+            capabilities.streams = 1
+        return capabilities
 
     def handshake1Finished(self) -> None:
-        jsonFiles = []
-        for metadata in self.transferQ:
-            jsonFile = {"filename": metadata.filename, "size": metadata.size}
-            jsonFiles.append(jsonFile)
+        # Digests let the receiver skip files it already has. They are
+        # computed off the GUI thread before the metadata goes out.
+        if Settings.dedup():
+            self.digester = FileDigester(self, [file.fileName() for file in self.files],
+                                         Settings.digestCachePath())
+            self.digester.finished.connect(self.sendMetadata)
+            self.digester.start()
+        else:
+            self.sendMetadata()
+
+    def sendMetadata(self) -> None:
+        if self.digester is not None:
+            for metadata, digest in zip(self.transferQ, self.digester.result()):
+                metadata.digest = digest or ""
 
-        obj = {"device_name": Settings.deviceName(
-        ), "device_type": QSysInfo.productType(), "files": jsonFiles}
-        self.encryptAndSend(json.dumps(
-            obj, ensure_ascii=False).encode("utf-8"))
+        self.offeredCapabilities = self.localCapabilities()
+        self.offeredCapabilities.dedup = self.digester is not None
+        if self.offeredCapabilities.sparse:
+            for file, metadata in zip(self.files, self.transferQ):
+                if metadata.size >= SPARSE_MIN_SIZE:
+                    metadata.sparse = hasHoles(file.fileName(), metadata.size)
+        header = {"device_name": Settings.deviceName(), "device_type": QSysInfo.productType(),
+                  "capabilities": self.offeredCapabilities.toJson()}
+        # Pages of a long file list follow as the socket drains.
+        messages = manifestMessages(header, self.transferQ, self.maxPayloadSize())
+        self.encryptAndSend(next(messages))
+        self.manifestPages = messages
+        self.socketBytesWritten()
 
     def processReceivedData(self, data: bytes) -> None:
         if self.state == State.HANDSHAKE2:
             try:
-                obj = json.loads(data)
+                obj = self.receiveMessage(data)
             except:
                 self.errorOccurred.emit(self.tr("Handshake failed."))
                 return
+            if obj is None:
+                return
 
-            response = obj["response"]
-            if not isinstance(response, (float, int)):
+            response = TransferResponse.fromJson(obj, self.offeredCapabilities, self.transferQ)
+            if response is None:
                 self.errorOccurred.emit(self.tr("Handshake failed."))
                 return
 
-            if int(response) == 0:
+            if not response.accepted:
                 self.errorOccurred.emit(
                     self.tr("The receiving device rejected your file(s)."))
                 return
+
+            # Receivers that predate capability negotiation don't answer with
+            # capabilities and keep getting the original protocol.
+            if response.capabilities is not None:
+                self.applyCapabilities(response.capabilities)
+                if response.capabilities.compressionMethod():
+                    self.compressor = AdaptiveCompressor(response.capabilities.compressionMethod())
+            self.setSkippedFiles(response.haveFiles)
+            if not self.setResumeOffsets(response.resumeOffsets):
+                self.errorOccurred.emit(self.tr("Handshake failed."))
+                return
+            self.setDeltaFiles(response.deltaFiles)
             self.state = State.TRANSFERRING
+            self.progress.start(self.totalSize, self.transferredSize)
+            self.startStats()
+
+            if self.capabilities.usesRecords():
+                self.frames = self.batchFrames(self.recordFrames())
+            else:
+                self.frames = self.rawFrames()
+
+            if self.capabilities.streams > 1 and response.streamToken:
+                self.openStreams(response.streamToken)
             self.socketBytesWritten()
+        elif self.state == State.TRANSFERRING:
+            self.processSignatures(data)
+
+    def setSkippedFiles(self, skippedFiles: Set[int]) -> None:
+        # The receiver already has identical copies of these files.
+        self.skippedFiles = skippedFiles
+        for index in skippedFiles:
+            self.transferredSize += self.transferQ[index].size
+
+    def setResumeOffsets(self, offsets: Dict[int, int]) -> bool:
+        # The receiver already holds these leading bytes of some files.
+        for index, offset in offsets.items():
+            if not self.files[index].seek(offset):
+                return False
+            self.resumeOffsets[index] = offset
+            self.transferredSize += offset
+        return True
+
+    def setDeltaFiles(self, deltaFiles: Set[int]) -> None:
+        # The receiver has an older version of these files and sends block
+        # signatures for them; only what changed is sent.
+        for index in deltaFiles:
+            self.deltaSignatures[index] = bytearray()
+
+    def processSignatures(self, data: bytes) -> None:
+        try:
+            for record in decodeRecords(data):
+                signatures = self.deltaSignatures.get(record.fileIndex)
+                if (record.type != RecordType.SIGNATURES or signatures is None
+                        or record.offset * SIGNATURE.size != len(signatures)
+                        or len(record.body) % SIGNATURE.size != 0):
+                    self.errorOccurred.emit(self.tr("Received invalid data."))
+                    return
+                signatures += record.body
+                count = record.length // deltaBlockSize(record.length) if record.length else 0
+                if len(signatures) > count * SIGNATURE.size:
+                    self.errorOccurred.emit(self.tr("Received invalid data."))
+                    return
+                self.deltaBasisSizes[record.fileIndex] = record.length
+                if len(signatures) == count * SIGNATURE.size:
+                    self.startDelta(record.fileIndex)
+        except ValueError:
+            self.errorOccurred.emit(self.tr("Received invalid data."))
+
+    def startDelta(self, index: int) -> None:
+        job = DeltaJob(self, computeDelta, self.files[index].fileName(), self.transferQ[index].size,
+                       self.deltaBasisSizes[index], bytes(self.deltaSignatures.pop(index)))
+        job.finished.connect(self.socketBytesWritten)
+        self.deltaJobs[index] = job
+        job.start()
+
+    def openStreams(self, token: str) -> None:
+        # Extra streams join while data already flows on the first one.
+        for _ in range(self.capabilities.streams - 1):
+            socket = QTcpSocket()
+            FileTransferJoiner(self, socket, self, token)
+            socket.connectToHost(self.socket.peerAddress(), self.socket.peerPort())
+
+    def readFile(self, index: int, size: int) -> bytes:
+        start = time.perf_counter()
+        data = self.files[index].read(size)
+        self.stats.diskReadTime += time.perf_counter() - start
+        if not data:
+            raise RuntimeError(
+                self.tr("Unable to read file %1.").replace("%1", self.transferQ[index].filename))
+        return data
+
+    def rawFrames(self) -> Iterator[Tuple[bytes, int]]:
+        # The original data phase: file contents back to back, in order.
+        quanta = rawQuanta(self.frameFormat, self.maxPayloadSize())
+        for index, metadata in enumerate(self.transferQ):
+            if index in self.skippedFiles:
+                continue
+            remaining = metadata.size - self.resumeOffsets.get(index, 0)
+            if remaining > 0:
+                self.printMessage.emit(
+                    self.tr("Sending file %1...").replace("%1", metadata.filename))
+                self.progress.setCurrentFile(metadata.filename)
+            while remaining > 0:
+                data = self.readFile(index, min(quanta, remaining))
+                remaining -= len(data)
+                yield data, len(data)
+
+    def recordFrames(self) -> Iterator[Optional[Tuple[bytes, int]]]:
+        # Deltas go last, giving the receiver time to send signatures. None
+        # means the next frame is waiting for them.
+        deltaFiles = sorted(self.deltaSignatures)
+        sources = (self.remainingRecords(index) for index in range(len(self.transferQ))
+                   if index not in self.skippedFiles and index not in self.deltaSignatures)
+        if self.sendOrder == ORDER_ROUND_ROBIN:
+            yield from interleave(sources)
+        else:
+            for records in sources:
+                yield from records
+        for index in deltaFiles:
+            while index not in self.deltaJobs or not self.deltaJobs[index].isFinished():
+                yield None
+            instructions = self.deltaJobs.pop(index).result()
+            if instructions is None:
+                # Our file couldn't be read as announced; send all of it.
+                instructions = [(0, self.transferQ[index].size, -1)]
+            self.printMessage.emit(
+                self.tr("Sending file %1...").replace("%1", self.transferQ[index].filename))
+            self.progress.setCurrentFile(self.transferQ[index].filename)
+            yield from self.deltaRecords(index, instructions)
+
+    def remainingRecords(self, index: int) -> Iterator[Tuple[bytes, int]]:
+        # What the receiver doesn't have of a file yet.
+        metadata = self.transferQ[index]
+        offset = self.resumeOffsets.get(index, 0)
+        if offset < metadata.size:
+            self.printMessage.emit(
+                self.tr("Sending file %1...").replace("%1", metadata.filename))
+            self.progress.setCurrentFile(metadata.filename)
+        yield from self.fileRecords(index, offset, metadata.size)
+
+    def batchFrames(self, frames: Iterator[Optional[Tuple[bytes, int]]]) -> Iterator[Optional[Tuple[bytes, int]]]:
+        batch = RecordBatch(self.maxPayloadSize())
+        for frame in frames:
+            full = batch.take() if frame is None else batch.add(*frame)
+            if full is not None:
+                yield full
+            if frame is None:
+                yield None
+        last = batch.take()
+        if last is not None:
+            yield last
+
+    def fileRecords(self, index: int, offset: int, end: int) -> Iterator[Tuple[bytes, int]]:
+        if not sendsHoles(self.capabilities, self.transferQ[index]):
+            yield from self.dataRecords(index, offset, end)
+            return
+        # Holes of sparse files and chunks of zeros only take a header.
+        for start, stop, isData in dataSegments(self.files[index].fileName(), offset, end):
+            if isData:
+                yield from self.dataRecords(index, start, stop)
+            else:
+                yield from zeroRecords(index, start, stop)
+
+    def dataRecords(self, index: int, offset: int, end: int) -> Iterator[Tuple[bytes, int]]:
+        quanta = recordQuanta(self.maxPayloadSize())
+        if offset < end and self.files[index].pos() != offset and not self.files[index].seek(offset):
+            raise RuntimeError(
+                self.tr("Unable to read file %1.").replace("%1", self.transferQ[index].filename))
+        while offset < end:
+            data = self.readFile(index, min(quanta, end - offset))
+            yield dataRecord(self.capabilities, index, offset, data)
+            offset += len(data)
+
+    def deltaRecords(self, index: int, instructions) -> Iterator[Tuple[bytes, int]]:
+        for offset, length, basisOffset in instructions:
+            if basisOffset < 0:
+                yield from self.fileRecords(index, offset, offset + length)
+                continue
+            end = offset + length
+            while offset < end:
+                size = min(COPY_QUANTA, end - offset)
+                yield encodeRecord(RecordType.COPY, index, offset, size, COPY_BODY.pack(basisOffset)), size
+                offset += size
+                basisOffset += size
 
     def socketBytesWritten(self) -> None:
-        if self.state != State.TRANSFERRING or self.socket.bytesToWrite() > 0:
+        if self.state == State.HANDSHAKE2 and self.manifestPages is not None:
+            self.sendManifestPages()
+            return
+        if self.state != State.TRANSFERRING:
             return
 
-        while self.transferQ:
-            curFile = self.transferQ[0]
-            if curFile.size == 0:
-                self.transferQ = self.transferQ[1:]
-                self.files = self.files[1:]
-            else:
-                self.printMessage.emit(
-                    self.tr("Sending file %1...").replace("%1", curFile.filename))
+        # Keep up to sendWindow bytes queued across the streams so no socket
+        # drains between chunks. Each chunk goes to the least loaded stream.
+        self.stats.stallEnded()
+        self.refreshRateLimits()
+        streamWindow = self.stats.sendWindow // len(self.streams)
+        while self.frames is not None:
+            stream = min(self.streams, key=TransferStream.bytesInFlight)
+            if stream.bytesInFlight() >= streamWindow:
+                self.stats.stallStarted()
+                break
+            try:
+                frame = self.heldFrame if self.heldFrame is not None else next(self.frames)
+            except StopIteration:
+                self.frames = None
+                break
+            except RuntimeError as e:
+                self.frames = None
+                self.errorOccurred.emit(str(e))
+                return
+            self.heldFrame = None
+            if frame is None:
+                break
+            if self.rateLimited(self.sendLimit):
+                # Fetching the frame first lets the session finish as soon
+                # as the last one is out.
+                self.heldFrame = frame
                 break
 
-        if not self.transferQ:
-            self.state = State.FINISHED
-            self.printMessage.emit(self.tr("Done!"))
-            self.socket.disconnectFromHost()
-            QTimer.singleShot(5000, self.ended)
+            data, size = frame
+            prepare = self.compressor.compressFrame if self.compressor is not None else None
+            if not stream.encryptAndSend(data, prepare):
+                return
+            self.sendLimit.consume(len(data))
+            self.transferredSize += size
+            self.progress.update(self.transferredSize)
+
+        self.stats.updateBytesInFlight(self.bytesInFlight())
+        if self.frames is not None or self.bytesInFlight() > 0:
             return
 
-        curFile = self.files[0]
-        curMetadata = self.transferQ[0]
-        data = curFile.read(TRANSFER_QUANTA)
-        self.encryptAndSend(data)
-        curMetadata.size -= len(data)
-        self.transferredSize += len(data)
-        self.updateProgress.emit(float(self.transferredSize) / self.totalSize)
+        self.state = State.FINISHED
+        self.progress.finish()
+        self.endStats()
+        self.printMessage.emit(self.tr("Done!"))
+        self.disconnectFromHost()
+        QTimer.singleShot(5000, self.ended)
+
+    def rateLimitPassed(self) -> None:
+        self.socketBytesWritten()
+
+    def sendManifestPages(self) -> None:
+        while self.manifestPages is not None and self.bytesInFlight() < MANIFEST_WINDOW:
+            page = next(self.manifestPages, None)
+            if page is None:
+                self.manifestPages = None
+            elif not self.streams[0].encryptAndSend(page):
+                self.manifestPages = None
 
     def respond(self, accepted: bool) -> None:
         raise RuntimeError("respond not implemented")
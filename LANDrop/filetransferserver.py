@@ -29,22 +29,41 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-from PyQt5.QtCore import QObject,Qt
-from PyQt5.QtNetwork import QTcpServer, QHostAddress
-from typing import Optional
+import dataclasses
+from PyQt5.QtCore import QObject, Qt, QTimer, pyqtSignal
+from PyQt5.QtNetwork import QTcpServer, QTcpSocket, QHostAddress
+from typing import List, Optional
 from LANDrop.settings import Settings
+from LANDrop.admission import Admission, AdmissionLimits, AdmissionQueue, AdmissionStats
 from LANDrop.filetransferreceiver import FileTransferReceiver
+from LANDrop.filetransfersession import State, socketPeerAddress
 from LANDrop.filetransferdialog import FileTransferDialog
 
+# Milliseconds between checks for queued connections that waited too long.
+QUEUE_CHECK_INTERVAL = 1000
+
 
 class FileTransferServer(QObject):
+    # Carries the address of a connection that was turned away, and why.
+    connectionRefused = pyqtSignal(str, str)
+
     def __init__(self, parent: Optional['QObject'] = None) -> None:
         super().__init__(parent)
         self.server = QTcpServer()
-        self._d = None
+        self._dialogs: List[FileTransferDialog] = []
+        # Overrides the limits in Settings, which are otherwise read anew
+        # for every connection.
+        self.limits: Optional[AdmissionLimits] = None
+        # Connections beyond the session limit wait here before any key
+        # exchange, so they cost a socket only.
+        self.admission: AdmissionQueue[QTcpSocket] = AdmissionQueue()
+        self.queueTimer = QTimer(self)
+        self.queueTimer.setInterval(QUEUE_CHECK_INTERVAL)
+        self.queueTimer.timeout.connect(self.checkQueue)
 
-    def start(self) -> None:
-        port = Settings.serverPort()
+    def start(self, port: Optional[int] = None) -> None:
+        if port is None:
+            port = Settings.serverPort()
         if not self.server.listen(QHostAddress.Any, port):
             raise RuntimeError(self.tr("Unable to listen on port %1.").replace("%1", str(port)))
 
@@ -53,8 +72,75 @@ class FileTransferServer(QObject):
     def port(self) -> int:
         return self.server.serverPort()
 
+    def admissionLimits(self) -> AdmissionLimits:
+        return self.limits if self.limits is not None else Settings.admissionLimits()
+
+    def admissionStats(self) -> AdmissionStats:
+        return dataclasses.replace(self.admission.stats)
+
     def serverNewConnection(self) -> None:
+        limits = self.admissionLimits()
         while self.server.hasPendingConnections():
-            receiver = FileTransferReceiver(None, self.server.nextPendingConnection())
-            self._d = FileTransferDialog(None, receiver)
-            self._d.setAttribute(Qt.WA_DeleteOnClose)
+            socket = self.server.nextPendingConnection()
+            address = socketPeerAddress(socket)
+            result = self.admission.offer(socket, address, Settings.peerPriority(address), limits)
+            if result == Admission.ADMITTED:
+                self.startSession(socket, address, limits)
+            elif result == Admission.QUEUED:
+                socket.setParent(self)
+                socket.disconnected.connect(lambda socket=socket: self.queuedSocketClosed(socket))
+                self.queueTimer.start()
+            else:
+                self.connectionRefused.emit(address, self.tr("Too many connections."))
+                socket.abort()
+                socket.deleteLater()
+
+    def startSession(self, socket: QTcpSocket, address: str, limits: AdmissionLimits) -> None:
+        receiver = FileTransferReceiver(None, socket)
+        # The session's slot is free once whoever handles it deleted it.
+        receiver.destroyed.connect(lambda _=None, address=address: self.sessionDestroyed(address))
+        if limits.handshakeTimeout > 0:
+            # The peer must have sent its file list in time; waiting for
+            # the user's answer after that doesn't count.
+            deadline = QTimer(receiver)
+            deadline.setSingleShot(True)
+            deadline.timeout.connect(lambda receiver=receiver: self.handshakeTimedOut(receiver))
+            receiver.fileMetadataReady.connect(deadline.stop)
+            deadline.start(int(limits.handshakeTimeout * 1000))
+        self.handleSession(receiver)
+
+    def handleSession(self, receiver: FileTransferReceiver) -> None:
+        # Asks the user about every transfer in a dialog of its own.
+        d = FileTransferDialog(None, receiver)
+        d.setAttribute(Qt.WA_DeleteOnClose)
+        # Keep every dialog alive until it closes; a sender may hold
+        # several connections open to us at once.
+        self._dialogs.append(d)
+        d.finished.connect(lambda _=None, d=d: self._dialogs.remove(d))
+
+    def handshakeTimedOut(self, receiver: FileTransferReceiver) -> None:
+        if receiver.state not in (State.HANDSHAKE1, State.HANDSHAKE2):
+            return
+        self.admission.stats.handshakeTimeouts += 1
+        receiver.errorOccurred.emit(self.tr("Handshake timed out."))
+
+    def sessionDestroyed(self, address: str) -> None:
+        self.admission.release(address)
+        # Not from within the destructor of the session.
+        QTimer.singleShot(0, self.checkQueue)
+
+    def queuedSocketClosed(self, socket: QTcpSocket) -> None:
+        if self.admission.remove(socket):
+            socket.deleteLater()
+
+    def checkQueue(self) -> None:
+        limits = self.admissionLimits()
+        for socket in self.admission.takeExpired(limits):
+            self.connectionRefused.emit(socketPeerAddress(socket), self.tr("Waited too long for a free session."))
+            socket.abort()
+            socket.deleteLater()
+        for socket in self.admission.takeAdmissible(limits):
+            socket.disconnected.disconnect()
+            self.startSession(socket, socketPeerAddress(socket), limits)
+        if not len(self.admission):
+            self.queueTimer.stop()
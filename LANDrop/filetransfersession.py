@@ -28,15 +28,42 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import dataclasses
+import json
+import time
 from abc import abstractmethod
-from dataclasses import dataclass
 from enum import Enum, auto
-from typing import List
-from PyQt5.QtCore import QObject, pyqtSignal
-from PyQt5.QtNetwork import QTcpSocket, QAbstractSocket
+from typing import Any, List
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtNetwork import QTcpSocket, QHostAddress
 from typing import Optional
 
-from LANDrop.crypto import Crypto
+from LANDrop.crypto import Crypto, availableCiphers
+from LANDrop.compressor import availableCompression
+from LANDrop.capabilities import Capabilities, PROTOCOL_VERSION
+from LANDrop.settings import Settings
+from LANDrop.sessionstats import SessionStats
+from LANDrop.transferprogress import ProgressReporter
+from LANDrop.cryptopool import CryptoPool
+from LANDrop.ratelimit import RateLimit, RateLimiter, waitMilliseconds
+from LANDrop.manifest import FileMetadata
+from LANDrop.transferstream import TransferStream
+from LANDrop.framing import (FrameFormat, LEGACY_MAX_FRAME_SIZE, MIN_WIDE_FRAME_SIZE, MAX_WIDE_FRAME_SIZE,
+                             MAX_CONTINUED_FRAMES)
+
+
+def socketPeerAddress(socket: QTcpSocket) -> str:
+    # IPv4 peers of dual-stack sockets are reported as plain IPv4.
+    address = socket.peerAddress()
+    ipv4 = address.toIPv4Address()
+    if ipv4:
+        address = QHostAddress(ipv4)
+    return address.toString()
+
+
+# Seconds between looking up rate limits in the settings, which may change
+# while transfers run.
+RATE_LIMIT_REFRESH = 1.0
 
 
 class State(Enum):
@@ -48,15 +75,15 @@ class State(Enum):
 
 class FileTransferSession(QObject):
     printMessage = pyqtSignal(str)
-    updateProgress = pyqtSignal(float)
+    # Carries a TransferProgress, at most every REPORT_INTERVAL.
+    updateProgress = pyqtSignal(object)
     errorOccurred = pyqtSignal(str)
     fileMetadataReady = pyqtSignal(list, int, str, str)
     ended = pyqtSignal()
+    # Carries the final SessionStats once the session finished or failed.
+    statsSummaryReady = pyqtSignal(object)
 
-    @dataclass
-    class FileMetadata:
-        filename: str
-        size: int
+    FileMetadata = FileMetadata
 
     def __init__(self, parent: Optional['QObject'], socket: QTcpSocket) -> None:
         super().__init__(parent)
@@ -65,15 +92,29 @@ class FileTransferSession(QObject):
         self.totalSize = 0
         self.transferredSize = 0
         self.crypto = Crypto()
-        self.readBuffer = b""
+        self.frameFormat = FrameFormat.LEGACY
+        self.maxFrameSize = LEGACY_MAX_FRAME_SIZE
+        self.capabilities = Capabilities()
+        self.stats = SessionStats()
+        self.progress = ProgressReporter(self)
+        self.progress.reported.connect(self.updateProgress)
+        self.errorOccurred.connect(self.progress.stop)
+        self.errorOccurred.connect(self.endStats)
         self.transferQ: List[FileTransferSession.FileMetadata] = []
-
-        self.socket.setParent(self)
-        self.socket.setSocketOption(QAbstractSocket.LowDelayOption, 1)
-        self.socket.readyRead.connect(self.socketReadyRead)
-        self.socket.error.connect(self.socketErrorOccurred)
+        self.pool = CryptoPool.instance(Settings.cryptoThreads())
+        self.streams: List[TransferStream] = [TransferStream(self, socket, self.pool)]
+        self.continuedParts: Optional[List[bytes]] = None
+        self.continuedCount = 0
+        # Created once the peer's address is known.
+        self.sendLimit: Optional[RateLimit] = None
+        self.receiveLimit: Optional[RateLimit] = None
+        self.rateLimitsRefreshed = 0.0
+        self.rateTimer = QTimer(self)
+        self.rateTimer.setSingleShot(True)
+        self.rateTimer.timeout.connect(self.rateLimitPassed)
 
     def start(self):
+        self.stats.startTime = time.monotonic()
         self.printMessage.emit(self.tr("Handshaking..."))
         self.socket.write(self.crypto.localPublicKey())
 
@@ -81,12 +122,142 @@ class FileTransferSession(QObject):
     def respond(self, accepted: bool):
         raise RuntimeError("respond not implemented")
 
+    def maxPayloadSize(self) -> int:
+        return self.maxFrameSize - self.crypto.overhead()
+
+    def peerAddress(self) -> str:
+        return socketPeerAddress(self.socket)
+
+    def localCapabilities(self) -> Capabilities:
+        compression = availableCompression() if Settings.compression() else []
+        return Capabilities(PROTOCOL_VERSION, Settings.maxFrameSize(), availableCiphers(), compression,
+                            streams=Settings.transferStreams(self.peerAddress()), resume=True,
+                            dedup=Settings.dedup(), delta=Settings.delta(), sparse=True)
+
+    def statsSnapshot(self) -> SessionStats:
+        # A copy of the statistics so far, safe to keep while the session
+        # goes on.
+        self.collectStats()
+        return dataclasses.replace(self.stats)
+
+    def collectStats(self) -> None:
+        # Brings statistics kept elsewhere, e.g. on other threads, into
+        # self.stats.
+        pass
+
+    def startStats(self) -> None:
+        self.stats.transferStartTime = time.monotonic()
+
+    def endStats(self) -> None:
+        if self.stats.endTime or not self.stats.startTime:
+            return
+        self.stats.endTime = time.monotonic()
+        self.stats.stallEnded()
+        self.statsSummaryReady.emit(self.statsSnapshot())
+
+    def refreshRateLimits(self) -> None:
+        now = time.monotonic()
+        if self.sendLimit is not None and now - self.rateLimitsRefreshed < RATE_LIMIT_REFRESH:
+            return
+        peer = self.peerAddress()
+        if self.sendLimit is None:
+            self.sendLimit = RateLimiter.sending().sessionLimit(peer)
+            self.receiveLimit = RateLimiter.receiving().sessionLimit(peer)
+        self.rateLimitsRefreshed = now
+        rates = (Settings.rateLimit(), Settings.peerRateLimit(peer), Settings.sessionRateLimit())
+        self.sendLimit.setRates(*rates)
+        self.receiveLimit.setRates(*rates)
+
+    def rateLimited(self, limit: RateLimit) -> bool:
+        # Whether limit allows no traffic for now; rateLimitPassed() is
+        # called once it does again.
+        wait = limit.waitTime()
+        if wait <= 0:
+            return False
+        if not self.rateTimer.isActive():
+            self.rateTimer.start(waitMilliseconds(wait))
+        return True
+
+    def rateLimitPassed(self) -> None:
+        pass
+
+    def applyCapabilities(self, capabilities: Capabilities) -> None:
+        self.capabilities = capabilities
+        self.crypto.setCipher(capabilities.cipher())
+        if MIN_WIDE_FRAME_SIZE <= capabilities.maxFrameSize <= MAX_WIDE_FRAME_SIZE:
+            self.frameFormat = FrameFormat.WIDE
+            self.maxFrameSize = capabilities.maxFrameSize
+
+    def expectsPublicKey(self) -> bool:
+        return self.state == State.HANDSHAKE1
+
+    def isTransferring(self) -> bool:
+        return self.state == State.TRANSFERRING
+
+    def publicKeyReceived(self, publicKey: bytes) -> bool:
+        try:
+            self.crypto.setRemotePublicKey(publicKey)
+        except Exception as e:
+            self.errorOccurred.emit(str(e))
+            return False
+        self.printMessage.emit(self.tr("Handshaking... Code: %1"
+                                       ).replace(
+            "%1", self.crypto.sessionKeyDigest()
+        ))
+        self.state = State.HANDSHAKE2
+
+        self.handshake1Finished()
+        return True
+
     def encryptAndSend(self, data: bytes) -> None:
-        sendData: bytes = self.crypto.encrypt(data)
-        size = len(sendData)
-        sendData = bytes([size & 0xFF]) + sendData
-        sendData = bytes([(size >> 8) & 0xFF]) + sendData
-        self.socket.write(sendData)
+        self.streams[0].encryptAndSend(data)
+
+    def sendMessage(self, obj: Any) -> None:
+        # A message too large for one frame is announced with
+        # {"continued": n} and follows split over n frames. Only peers that
+        # negotiate capabilities get such large messages.
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        limit = self.maxPayloadSize()
+        if len(data) <= limit:
+            self.encryptAndSend(data)
+            return
+        parts = range(0, len(data), limit)
+        self.encryptAndSend(json.dumps({"continued": len(parts)}).encode("utf-8"))
+        for start in parts:
+            self.encryptAndSend(data[start:start + limit])
+
+    def receiveMessage(self, data: bytes) -> Optional[Any]:
+        # Returns the next complete message, or None while parts of a
+        # continued one are outstanding. Raises ValueError for malformed
+        # messages.
+        if self.continuedParts is not None:
+            self.continuedParts.append(bytes(data))
+            if len(self.continuedParts) < self.continuedCount:
+                return None
+            data = b"".join(self.continuedParts)
+            self.continuedParts = None
+            return json.loads(data)
+        obj = json.loads(data)
+        if isinstance(obj, dict) and "continued" in obj:
+            count = obj["continued"]
+            if not isinstance(count, int) or not 0 < count <= MAX_CONTINUED_FRAMES:
+                raise ValueError("invalid continued message")
+            self.continuedParts = []
+            self.continuedCount = count
+            return None
+        return obj
+
+    def adoptStream(self, stream: TransferStream) -> None:
+        # Takes over the connection of a session that joined this one.
+        stream.moveToSession(self)
+        self.streams.append(stream)
+
+    def bytesInFlight(self) -> int:
+        return sum(stream.bytesInFlight() for stream in self.streams)
+
+    def disconnectFromHost(self) -> None:
+        for stream in self.streams:
+            stream.disconnectFromHost()
 
     @abstractmethod
     def handshake1Finished(self) -> None:
@@ -96,48 +267,26 @@ class FileTransferSession(QObject):
     def processReceivedData(self, data: bytes) -> None:
         pass
 
-    def socketReadyRead(self) -> None:
+    def socketBytesWritten(self) -> None:
+        pass
 
-        self.readBuffer += bytes(self.socket.readAll())
-        if self.state == State.HANDSHAKE1:
-            if len(self.readBuffer) < self.crypto.publicKeySize():
-                self.errorOccurred.emit(self.tr("Handshake failed."))
-                return
-            publicKey = self.readBuffer[:self.crypto.publicKeySize()]
-            self.readBuffer = self.readBuffer[self.crypto.publicKeySize():]
-            try:
-                self.crypto.setRemotePublicKey(publicKey)
-            except Exception as e:
-                self.errorOccurred.emit(str(e))
-                return
-            self.printMessage.emit(self.tr("Handshaking... Code: %1"
-                                           ).replace(
-                "%1", self.crypto.sessionKeyDigest()
-            ))
-            self.state = State.HANDSHAKE2
-
-            self.handshake1Finished()
-
-        while self.readBuffer:
-            if len(self.readBuffer) < 2:
-                break
-
-            size = self.readBuffer[0] << 8
-            size |= self.readBuffer[1]
-            if len(self.readBuffer) < size + 2:
-                break
-
-            data = self.readBuffer[2: size+2]
-            self.readBuffer = self.readBuffer[size + 2:]
-
-            try:
-                data = self.crypto.decrypt(data)
-            except RuntimeError as e:
-                self.errorOccurred.emit(str(e))
-                return
+    def readingPaused(self) -> bool:
+        # Streams leave incoming data in their sockets while this is true.
+        return False
 
-            self.processReceivedData(data)
+    def updateReceiveStats(self) -> None:
+        self.stats.updateBufferedBytes(sum(stream.bufferedBytes() for stream in self.streams))
+
+    def checkRemoteClosed(self) -> None:
+        # A closed stream is only an error once every stream is closed and
+        # nothing received is left to process.
+        if self.state == State.FINISHED:
+            return
+        for stream in self.streams:
+            if not stream.remoteClosed or not stream.isIdle():
+                return
+        self.errorOccurred.emit(self.socket.errorString())
 
-    def socketErrorOccurred(self) -> None:
+    def streamErrorOccurred(self, stream: TransferStream, message: str) -> None:
         if self.state != State.FINISHED:
-            self.errorOccurred.emit(self.socket.errorString())
+            self.errorOccurred.emit(message)
@@ -0,0 +1,216 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, List, Optional, Tuple
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+from LANDrop.partfile import PartFile
+
+# When received files are forced to disk: never, each before it is renamed
+# into place, or all of them once the session has received everything.
+DURABILITY_NONE = "none"
+DURABILITY_FILE = "file"
+DURABILITY_SESSION = "session"
+DURABILITY_POLICIES = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_SESSION)
+DEFAULT_DURABILITY = DURABILITY_NONE
+
+# Bytes queued for the disk at which the receiver stops reading from its
+# sockets, and the level at which it starts again.
+WRITE_BEHIND_LIMIT = 64 << 20
+WRITE_BEHIND_RESUME = 16 << 20
+# Jobs a writer runs before it lets other writers have the thread.
+DRAIN_BATCH = 16
+
+
+def syncFile(path: str) -> None:
+    # Windows only flushes handles opened for writing.
+    fd = os.open(path, os.O_RDWR if os.name == "nt" else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncDirectory(path: str) -> None:
+    # Makes renames into the directory durable; not possible on Windows.
+    if os.name == "nt":
+        return
+    syncFile(path)
+
+
+class DiskPool:
+    # Process-wide threads for the disk I/O of receiving sessions, so many
+    # concurrent sessions share a few threads rather than one each.
+    _instance: Optional['DiskPool'] = None
+
+    def __init__(self, threads: int) -> None:
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="LANDropWrite")
+
+    @classmethod
+    def instance(cls, threads: int) -> 'DiskPool':
+        # The first size wins for the life of the process.
+        if cls._instance is None:
+            cls._instance = DiskPool(max(1, threads))
+        return cls._instance
+
+    @staticmethod
+    def defaultThreads() -> int:
+        return 4
+
+    def submit(self, fn: Callable, *args) -> None:
+        self.executor.submit(fn, *args)
+
+
+class FileWriter(QObject):
+    # Performs the disk I/O of a receiving session in order on the disk
+    # pool, so a slow disk stalls neither the sockets nor the UI. Only the
+    # owning thread submits work and sees the queued byte count.
+    drained = pyqtSignal()
+    failed = pyqtSignal(str)
+    finished = pyqtSignal()
+    _done = pyqtSignal(int, float)
+    _failed = pyqtSignal(str)
+    _finished = pyqtSignal()
+
+    def __init__(self, parent: Optional[QObject], durability: str, pool: DiskPool) -> None:
+        super().__init__(parent)
+        self.durability = durability if durability in DURABILITY_POLICIES else DEFAULT_DURABILITY
+        self.pool = pool
+        # Jobs not yet started; at most one pool thread runs them at a time.
+        self.jobs: Deque[Tuple[Callable, tuple]] = deque()
+        self.jobsLock = threading.Lock()
+        self.draining = False
+        self.pendingBytes = 0
+        # Seconds spent on completed jobs.
+        self.writeTime = 0.0
+        self.full = False
+        self.error = ""
+        # Files renamed into place, touched by the writer thread only.
+        self.completedPaths: List[str] = []
+        self._done.connect(self.jobDone, Qt.QueuedConnection)
+        self._failed.connect(self.failed, Qt.QueuedConnection)
+        self._finished.connect(self.finished, Qt.QueuedConnection)
+
+    def isFull(self) -> bool:
+        if self.pendingBytes >= WRITE_BEHIND_LIMIT:
+            self.full = True
+        return self.full
+
+    def hasFailed(self) -> bool:
+        return bool(self.error)
+
+    def submit(self, errorMessage: str, size: int, fn: Callable, *args) -> None:
+        # Runs fn(*args) after everything submitted before. Once a job has
+        # failed with errorMessage, later jobs are skipped.
+        self.pendingBytes += size
+        self.enqueue(self.run, errorMessage, size, fn, args, False)
+
+    def submitAlways(self, fn: Callable, *args) -> None:
+        # Like submit(), but also runs after a failure, e.g. to clean up.
+        self.enqueue(self.run, "", 0, fn, args, True)
+
+    def complete(self, errorMessage: str, file: PartFile) -> None:
+        self.submit(errorMessage, 0, self.completeFile, file)
+
+    def finish(self) -> None:
+        # finished is emitted once everything submitted so far is done and,
+        # with the session policy, on disk.
+        self.enqueue(self.runFinish)
+
+    def enqueue(self, fn: Callable, *args) -> None:
+        with self.jobsLock:
+            self.jobs.append((fn, args))
+            if self.draining:
+                return
+            self.draining = True
+        self.pool.submit(self.drain)
+
+    def drain(self) -> None:
+        # Runs queued jobs in order. After a batch the writer goes to the
+        # back of the pool's queue, so busy sessions can't starve others.
+        for _ in range(DRAIN_BATCH):
+            with self.jobsLock:
+                if not self.jobs:
+                    self.draining = False
+                    return
+                fn, args = self.jobs.popleft()
+            fn(*args)
+        self.pool.submit(self.drain)
+
+    def completeFile(self, file: PartFile) -> None:
+        file.complete(self.durability == DURABILITY_FILE)
+        self.completedPaths.append(file.path)
+
+    def run(self, errorMessage: str, size: int, fn: Callable, args, always: bool) -> None:
+        start = time.perf_counter()
+        if always or not self.error:
+            try:
+                fn(*args)
+            except Exception:
+                # Not just OSError: on the pool thread anything else would
+                # go unnoticed.
+                if not always:
+                    self.error = errorMessage
+                    self.emitSafely(self._failed, errorMessage)
+        self.emitSafely(self._done, size, time.perf_counter() - start)
+
+    def runFinish(self) -> None:
+        if not self.error and self.durability != DURABILITY_NONE:
+            try:
+                if self.durability == DURABILITY_SESSION:
+                    for path in self.completedPaths:
+                        syncFile(path)
+                for directory in {os.path.dirname(path) for path in self.completedPaths}:
+                    syncDirectory(directory)
+            except Exception as e:
+                self.error = str(e)
+                self.emitSafely(self._failed, self.error)
+        self.emitSafely(self._finished)
+
+    @staticmethod
+    def emitSafely(signal, *args) -> None:
+        try:
+            signal.emit(*args)
+        except RuntimeError:
+            # The owning session was deleted meanwhile.
+            pass
+
+    def jobDone(self, size: int, elapsed: float) -> None:
+        self.pendingBytes -= size
+        self.writeTime += elapsed
+        if self.full and self.pendingBytes <= WRITE_BEHIND_RESUME:
+            self.full = False
+            self.drained.emit()
@@ -0,0 +1,82 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+from enum import Enum
+from typing import Callable, Optional, Tuple
+
+from LANDrop.crypto import Crypto, CipherSuite
+
+LEGACY_MAX_FRAME_SIZE = 0xFFFF
+MIN_WIDE_FRAME_SIZE = 1 << 20
+MAX_WIDE_FRAME_SIZE = 16 << 20
+DEFAULT_WIDE_FRAME_SIZE = 4 << 20
+# File data per frame of the original protocol's data phase.
+TRANSFER_QUANTA = 64000
+# Most frames a continued message may be split over.
+MAX_CONTINUED_FRAMES = 4096
+
+
+class FrameFormat(Enum):
+    # The value is the size of the big-endian length prefix in bytes.
+    LEGACY = 2
+    WIDE = 4
+
+    def headerSize(self) -> int:
+        return self.value
+
+    def encodeHeader(self, size: int) -> bytes:
+        return size.to_bytes(self.value, "big")
+
+    def decodeHeader(self, header: memoryview) -> int:
+        return int.from_bytes(header[:self.value], "big")
+
+
+def clampWideFrameSize(size: int) -> int:
+    return max(MIN_WIDE_FRAME_SIZE, min(MAX_WIDE_FRAME_SIZE, size))
+
+
+def sealFrame(crypto: Crypto, cipher: CipherSuite, frameFormat: FrameFormat, data: bytes,
+              prepare: Optional[Callable[[bytes], bytes]]) -> Tuple[bytes, bytes, float, float]:
+    # Returns the header, the encrypted frame and the seconds spent in
+    # prepare and in encryption.
+    start = time.perf_counter()
+    if prepare is not None:
+        data = prepare(data)
+    prepared = time.perf_counter()
+    sendData = crypto.encrypt(data, cipher)
+    return frameFormat.encodeHeader(len(sendData)), sendData, prepared - start, time.perf_counter() - prepared
+
+
+def openFrame(crypto: Crypto, cipher: CipherSuite, data: bytes) -> Tuple[bytes, float]:
+    # Returns the decrypted frame and the seconds spent decrypting it.
+    start = time.perf_counter()
+    data = crypto.decrypt(data, cipher)
+    return data, time.perf_counter() - start
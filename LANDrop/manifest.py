@@ -0,0 +1,136 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Set
+
+# The file list of a transfer, as the sender announces it during the
+# handshake. Shared by the Qt sessions and the asyncio engine.
+
+
+@dataclass
+class FileMetadata:
+    filename: str
+    size: int
+    mtime: int = 0
+    digest: str = ""
+    # Has holes, so the receiver shouldn't allocate all of it.
+    sparse: bool = False
+
+
+def manifestMessages(header: dict, files: List[FileMetadata], limit: int) -> Iterator[bytes]:
+    # The handshake message with header's fields and the file list. A list
+    # that fits in one frame is sent the way every receiver understands. A
+    # longer one is announced with file_count and follows in pages of
+    # [filename, size, mtime, blake2b] entries, with a trailing 1 for sparse
+    # files, built as they are needed so the whole list never exists as
+    # JSON at once; receivers that can't take pages reject the empty list.
+    obj = dict(header, files=[])
+    size = len(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+    jsonFiles = []
+    for metadata in files:
+        jsonFile = {"filename": metadata.filename, "size": metadata.size, "mtime": metadata.mtime}
+        if metadata.digest:
+            jsonFile["blake2b"] = metadata.digest
+        if metadata.sparse:
+            jsonFile["sparse"] = True
+        size += len(json.dumps(jsonFile, ensure_ascii=False).encode("utf-8")) + 2
+        if size > limit:
+            break
+        jsonFiles.append(jsonFile)
+    else:
+        obj["files"] = jsonFiles
+        yield json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        return
+
+    obj["file_count"] = len(files)
+    yield json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    entries = []
+    size = 0
+    for metadata in files:
+        entry = [metadata.filename, metadata.size, metadata.mtime, metadata.digest]
+        if metadata.sparse:
+            entry.append(1)
+        entry = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if entries and size + len(entry) + 16 > limit:
+            yield b'{"files":[' + b",".join(entries) + b"]}"
+            entries = []
+            size = 0
+        entries.append(entry)
+        size += len(entry) + 1
+    if entries:
+        yield b'{"files":[' + b",".join(entries) + b"]}"
+
+
+def isSafeFilename(filename: str) -> bool:
+    # Received files go straight into the download directory.
+    return (filename not in ("", ".", "..") and "/" not in filename and "\\" not in filename
+            and "\0" not in filename)
+
+
+def uniqueFile(metadata: FileMetadata, names: Set[str]) -> Optional[FileMetadata]:
+    # Rejects names that would leave the download directory or that an
+    # earlier entry of the same list already took. Names are compared the
+    # way case-insensitive file systems do.
+    name = metadata.filename.casefold()
+    if not isSafeFilename(metadata.filename) or name in names:
+        return None
+    names.add(name)
+    return metadata
+
+
+def fileFromJson(obj, names: Set[str]) -> Optional[FileMetadata]:
+    # An entry of the files list of the handshake message; names holds the
+    # names of the entries before it.
+    if not isinstance(obj, dict):
+        return None
+    filename = obj.get("filename")
+    size = obj.get("size")
+    mtime = obj.get("mtime", 0)
+    digest = obj.get("blake2b", "")
+    sparse = obj.get("sparse", False)
+    if (not isinstance(filename, str) or not isinstance(size, int) or size < 0 or not isinstance(mtime, int)
+            or not isinstance(digest, str) or not isinstance(sparse, bool)):
+        return None
+    return uniqueFile(FileMetadata(filename, size, mtime, digest, sparse), names)
+
+
+def fileFromPageEntry(entry, names: Set[str]) -> Optional[FileMetadata]:
+    # An entry of a manifest page; names as for fileFromJson().
+    if not isinstance(entry, list) or len(entry) not in (4, 5):
+        return None
+    filename, size, mtime, digest = entry[:4]
+    sparse = entry[4] if len(entry) == 5 else 0
+    if (not isinstance(filename, str) or not isinstance(size, int) or size < 0
+            or not isinstance(mtime, int) or not isinstance(digest, str) or sparse not in (0, 1)):
+        return None
+    return uniqueFile(FileMetadata(filename, size, mtime, digest, bool(sparse)), names)
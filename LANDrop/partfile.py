@@ -0,0 +1,165 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import errno
+import json
+import os
+from typing import BinaryIO, List, Optional
+
+PART_SUFFIX = ".part"
+JOURNAL_SUFFIX = ".part.journal"
+# Bytes written to a file between two journal checkpoints.
+JOURNAL_INTERVAL = 32 << 20
+
+
+class PartFile:
+    # A file being received. Data goes to "<name>.part"; "<name>.part.journal"
+    # records which byte ranges of it have been written and flushed, together
+    # with the size and modification time the sender announced, so a later
+    # session for the same file can pick up where this one stopped.
+
+    def __init__(self, path: str, size: int, mtime: int = 0, preallocate: bool = True) -> None:
+        self.path = path
+        self.partPath = path + PART_SUFFIX
+        self.journalPath = path + JOURNAL_SUFFIX
+        self.size = size
+        self.mtime = mtime
+        self.preallocate = preallocate
+        self.ranges: List[List[int]] = []
+        self.file: Optional[BinaryIO] = None
+        self.uncheckpointed = 0
+
+    def resumeOffset(self) -> int:
+        # Length of the verified prefix a previous session left behind.
+        try:
+            with open(self.journalPath, "r", encoding="utf-8") as f:
+                journal = json.load(f)
+            partSize = os.path.getsize(self.partPath)
+        except (OSError, ValueError):
+            return 0
+        if not isinstance(journal, dict) or journal.get("size") != self.size or journal.get("mtime") != self.mtime:
+            return 0
+        ranges = journal.get("ranges")
+        if not isinstance(ranges, list) or not ranges:
+            return 0
+        first = ranges[0]
+        if not isinstance(first, list) or len(first) != 2 or first[0] != 0 or not isinstance(first[1], int):
+            return 0
+        return max(0, min(first[1], partSize, self.size))
+
+    def open(self, offset: int = 0) -> None:
+        if offset > 0:
+            self.file = open(self.partPath, "r+b")
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            self.ranges = [[0, offset]]
+        else:
+            self.file = open(self.partPath, "wb")
+            self.ranges = []
+        if self.preallocate:
+            self.allocate()
+
+    def allocate(self) -> None:
+        # Reserves the whole file up front: it can't run out of space
+        # halfway and is laid out in one piece. Not for files with holes.
+        if self.size == 0 or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, self.size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    def write(self, offset: int, data) -> None:
+        if self.file.tell() != offset:
+            self.file.seek(offset)
+        self.file.write(data)
+        self.addRange(offset, offset + len(data))
+        self.uncheckpointed += len(data)
+        if self.uncheckpointed >= JOURNAL_INTERVAL:
+            self.checkpoint()
+
+    def zero(self, offset: int, length: int) -> None:
+        # A range of zeros. Nothing is written: the range is either beyond
+        # the end of the file so far, which becomes a hole once the file is
+        # extended, or a hole left by an earlier extension.
+        end = offset + length
+        self.file.flush()
+        if os.fstat(self.file.fileno()).st_size < end:
+            self.file.truncate(end)
+        self.addRange(offset, end)
+
+    def addRange(self, start: int, end: int) -> None:
+        ranges = self.ranges
+        i = 0
+        while i < len(ranges) and ranges[i][1] < start:
+            i += 1
+        j = i
+        while j < len(ranges) and ranges[j][0] <= end:
+            start = min(start, ranges[j][0])
+            end = max(end, ranges[j][1])
+            j += 1
+        ranges[i:j] = [[start, end]]
+
+    def checkpoint(self) -> None:
+        # The journal only ever covers data that has reached the disk.
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        journal = {"size": self.size, "mtime": self.mtime, "ranges": self.ranges}
+        tmpPath = self.journalPath + ".tmp"
+        with open(tmpPath, "w", encoding="utf-8") as f:
+            json.dump(journal, f)
+        os.replace(tmpPath, self.journalPath)
+        self.uncheckpointed = 0
+
+    def abandon(self) -> None:
+        # Keeps the partial data and its journal for a later session.
+        try:
+            self.checkpoint()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def complete(self, sync: bool = False) -> None:
+        if sync and self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.close()
+        os.replace(self.partPath, self.path)
+        try:
+            os.remove(self.journalPath)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,136 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import math
+import time
+import weakref
+from typing import List, Optional
+
+# Seconds of traffic a bucket saves up while the link is idle, and the
+# least it saves, so a low rate still lets whole frames through.
+BURST_TIME = 0.25
+MIN_BURST = 64 << 10
+
+
+class TokenBucket:
+    # Allows rate bytes per second on average, 0 meaning no limit. A
+    # transfer may overdraw the bucket by one write or read; it then waits
+    # until the debt is paid off, which keeps large frames simple.
+
+    def __init__(self, rate: float = 0) -> None:
+        self.rate = 0.0
+        self.capacity = float(MIN_BURST)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.setRate(rate)
+
+    def setRate(self, rate: float) -> None:
+        # Takes effect right away, also for transfers that are running.
+        rate = max(0.0, float(rate))
+        if rate == self.rate:
+            return
+        self.refill()
+        self.rate = rate
+        self.capacity = max(rate * BURST_TIME, MIN_BURST)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, size: int) -> None:
+        if self.rate:
+            self.refill()
+            self.tokens -= size
+
+    def waitTime(self) -> float:
+        # Seconds until more may be transferred.
+        if not self.rate:
+            return 0.0
+        self.refill()
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimit:
+    # The buckets one session's traffic in one direction is subject to:
+    # the budget of the whole process, the cap of its peer and its own.
+
+    def __init__(self, processBucket: TokenBucket, peerBucket: TokenBucket) -> None:
+        self.buckets: List[TokenBucket] = [processBucket, peerBucket, TokenBucket()]
+
+    def setRates(self, processRate: float, peerRate: float, sessionRate: float) -> None:
+        for bucket, rate in zip(self.buckets, (processRate, peerRate, sessionRate)):
+            bucket.setRate(rate)
+
+    def consume(self, size: int) -> None:
+        for bucket in self.buckets:
+            bucket.consume(size)
+
+    def waitTime(self) -> float:
+        return max(bucket.waitTime() for bucket in self.buckets)
+
+    def isLimited(self) -> bool:
+        return any(bucket.rate for bucket in self.buckets)
+
+
+class RateLimiter:
+    # Hands out the buckets of one direction. The process bucket and the
+    # bucket of a peer are shared by every session using them; a peer's
+    # bucket goes away with its last session.
+    _sending: Optional['RateLimiter'] = None
+    _receiving: Optional['RateLimiter'] = None
+
+    def __init__(self) -> None:
+        self.processBucket = TokenBucket()
+        self.peerBuckets: 'weakref.WeakValueDictionary[str, TokenBucket]' = weakref.WeakValueDictionary()
+
+    @classmethod
+    def sending(cls) -> 'RateLimiter':
+        if cls._sending is None:
+            cls._sending = RateLimiter()
+        return cls._sending
+
+    @classmethod
+    def receiving(cls) -> 'RateLimiter':
+        if cls._receiving is None:
+            cls._receiving = RateLimiter()
+        return cls._receiving
+
+    def sessionLimit(self, peer: str) -> RateLimit:
+        peerBucket = self.peerBuckets.get(peer)
+        if peerBucket is None:
+            peerBucket = self.peerBuckets[peer] = TokenBucket()
+        return RateLimit(self.processBucket, peerBucket)
+
+
+def waitMilliseconds(seconds: float) -> int:
+    return max(1, math.ceil(seconds * 1000))
@@ -0,0 +1,99 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import Union
+
+INITIAL_CAPACITY = 1 << 20
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+
+class ReceiveBuffer:
+    # A reusable receive buffer with a read cursor. Frames are parsed in
+    # place through memoryviews; consumed bytes are reclaimed by moving the
+    # unread tail to the front only when there is no room left at the end,
+    # so every received byte is copied a bounded number of times.
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY) -> None:
+        self._buffer = bytearray(capacity)
+        self._readPos = 0
+        self._writePos = 0
+
+    def __len__(self) -> int:
+        return self._writePos - self._readPos
+
+    def capacity(self) -> int:
+        return len(self._buffer)
+
+    def append(self, data: BytesLike) -> None:
+        size = len(data)
+        if size == 0:
+            return
+        self._reserve(size)
+        self._buffer[self._writePos:self._writePos + size] = data
+        self._writePos += size
+
+    def peek(self, size: int) -> memoryview:
+        if size > len(self):
+            raise IndexError("not enough buffered data")
+        return memoryview(self._buffer)[self._readPos:self._readPos + size]
+
+    def consume(self, size: int) -> None:
+        if size > len(self):
+            raise IndexError("not enough buffered data")
+        self._readPos += size
+        if self._readPos == self._writePos:
+            self._readPos = 0
+            self._writePos = 0
+
+    def take(self, size: int) -> bytes:
+        data = bytes(self.peek(size))
+        self.consume(size)
+        return data
+
+    def clear(self) -> None:
+        self._readPos = 0
+        self._writePos = 0
+
+    def _reserve(self, size: int) -> None:
+        if self._writePos + size <= len(self._buffer):
+            return
+        pending = len(self)
+        if pending + size <= len(self._buffer):
+            self._buffer[:pending] = self._buffer[self._readPos:self._writePos]
+        else:
+            capacity = len(self._buffer)
+            while capacity < pending + size:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:pending] = self._buffer[self._readPos:self._writePos]
+            self._buffer = buffer
+        self._readPos = 0
+        self._writePos = pending
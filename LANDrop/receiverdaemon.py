@@ -0,0 +1,242 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Unattended receiving for machines many senders push to: every incoming
+# session runs at once, transfers are accepted or rejected by policy and
+# the outcome of each is logged instead of shown in a window.
+
+import dataclasses
+import fnmatch
+import ipaddress
+import logging
+import os
+import shutil
+import signal
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+from PyQt5.QtCore import QCoreApplication, QLocale, QObject, QTimer
+
+from LANDrop.admission import AdmissionStats
+from LANDrop.cryptopool import CryptoPool
+from LANDrop.discoveryservice import DiscoveryService
+from LANDrop.filetransferreceiver import FileTransferReceiver
+from LANDrop.filetransferserver import FileTransferServer
+from LANDrop.filetransfersession import FileTransferSession, State
+from LANDrop.filewriter import DiskPool
+from LANDrop.sessionstats import SessionStats
+from LANDrop.settings import Settings
+
+logger = logging.getLogger("LANDrop.daemon")
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def formatSize(size: float) -> str:
+    return QLocale().formattedDataSize(int(size), 2, QLocale.DataSizeTraditionalFormat)
+
+
+def freeSpace(path: str) -> int:
+    # The download path may not exist until the first transfer.
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return -1
+
+
+@dataclass
+class AcceptPolicy:
+    # Decides about transfers without asking anyone. Empty lists and zero
+    # limits don't restrict anything. Device names are chosen by senders,
+    # so only addresses are a security boundary.
+    allowFrom: List[IPNetwork] = field(default_factory=list)
+    allowDevices: List[str] = field(default_factory=list)
+    maxTotalSize: int = 0
+    maxFiles: int = 0
+    # Filename patterns, like "*.exe", matched regardless of case.
+    rejectPatterns: List[str] = field(default_factory=list)
+    # Space that must remain free in the download path afterwards.
+    reserveSpace: int = 0
+
+    def rejectReason(self, address: str, files: List[FileTransferSession.FileMetadata], totalSize: int,
+                     deviceName: str, downloadPath: str) -> str:
+        # Returns why the transfer is rejected, or "" to accept it.
+        if self.allowFrom:
+            try:
+                ip = ipaddress.ip_address(address)
+            except ValueError:
+                return "address not allowed"
+            if not any(ip in network for network in self.allowFrom):
+                return "address not allowed"
+        if self.allowDevices and deviceName not in self.allowDevices:
+            return "device not allowed"
+        if self.maxFiles and len(files) > self.maxFiles:
+            return "more than %d files" % self.maxFiles
+        if self.maxTotalSize and totalSize > self.maxTotalSize:
+            return "larger than " + formatSize(self.maxTotalSize)
+        for metadata in files:
+            for pattern in self.rejectPatterns:
+                if fnmatch.fnmatch(metadata.filename.lower(), pattern.lower()):
+                    return "%s matches %s" % (metadata.filename, pattern)
+        free = freeSpace(downloadPath)
+        if free >= 0 and free - totalSize < self.reserveSpace:
+            return "not enough free space"
+        return ""
+
+
+class ReceiverDaemon(FileTransferServer):
+    # Runs any number of receiving sessions side by side. They share the
+    # process-wide crypto and disk pools, so concurrency costs sockets and
+    # buffers rather than threads.
+
+    def __init__(self, parent: Optional[QObject], downloadPath: str, policy: AcceptPolicy) -> None:
+        super().__init__(parent)
+        self.downloadPath = downloadPath
+        self.policy = policy
+        # Live sessions and who they are with, for the log.
+        self.sessions: Dict[FileTransferReceiver, str] = {}
+        self.connectionRefused.connect(
+            lambda address, reason: logger.warning("Refused connection from %s: %s", address, reason))
+
+    def handleSession(self, receiver: FileTransferReceiver) -> None:
+        receiver.setParent(self)
+        receiver.downloadPath = self.downloadPath
+        receiver.openDownloadPath = False
+        self.sessions[receiver] = receiver.peerAddress()
+        receiver.fileMetadataReady.connect(
+            lambda files, totalSize, deviceName, code, r=receiver:
+            self.sessionFileMetadataReady(r, files, totalSize, deviceName))
+        receiver.statsSummaryReady.connect(lambda stats, r=receiver: self.sessionStatsReady(r, stats))
+        receiver.errorOccurred.connect(lambda msg, r=receiver: self.sessionErrorOccurred(r, msg))
+        receiver.ended.connect(lambda r=receiver: self.sessionEnded(r))
+        receiver.start()
+
+    def peerName(self, receiver: FileTransferReceiver) -> str:
+        if receiver.manifest.deviceName:
+            return "%s (%s)" % (receiver.manifest.deviceName, self.sessions.get(receiver, ""))
+        return self.sessions.get(receiver, "")
+
+    def sessionFileMetadataReady(self, receiver: FileTransferReceiver,
+                                 files: List[FileTransferSession.FileMetadata], totalSize: int,
+                                 deviceName: str) -> None:
+        reason = self.policy.rejectReason(self.sessions[receiver], files, totalSize, deviceName,
+                                          self.downloadPath)
+        if reason:
+            logger.warning("Rejected %d file(s), %s, from %s: %s", len(files), formatSize(totalSize),
+                           self.peerName(receiver), reason)
+        else:
+            logger.info("Receiving %d file(s), %s, from %s", len(files), formatSize(totalSize),
+                        self.peerName(receiver))
+        receiver.respond(not reason)
+
+    def sessionStatsReady(self, receiver: FileTransferReceiver, stats: SessionStats) -> None:
+        # Failed sessions report their statistics too; they are logged by
+        # sessionErrorOccurred().
+        if receiver.state != State.FINISHED or receiver.writer.hasFailed():
+            return
+        elapsed = stats.transferTime()
+        rate = " (%s/s)" % formatSize(receiver.totalSize / elapsed) if elapsed > 0 else ""
+        logger.info("Received %d file(s), %s, from %s in %.1fs%s over %d stream(s)", len(receiver.transferQ),
+                    formatSize(receiver.totalSize), self.peerName(receiver), elapsed, rate,
+                    len(receiver.streams))
+        logger.debug("Statistics of %s: %s", self.peerName(receiver), vars(stats))
+
+    def sessionErrorOccurred(self, receiver: FileTransferReceiver, msg: str) -> None:
+        # Only the first error of a session is worth logging.
+        if receiver not in self.sessions:
+            return
+        if receiver.transferQ:
+            logger.error("Transfer from %s failed after %s of %s: %s", self.peerName(receiver),
+                         formatSize(receiver.transferredSize), formatSize(receiver.totalSize), msg)
+        else:
+            logger.warning("Session with %s failed: %s", self.peerName(receiver), msg)
+        self.sessionEnded(receiver)
+
+    def sessionEnded(self, receiver: FileTransferReceiver) -> None:
+        if self.sessions.pop(receiver, None) is not None:
+            receiver.deleteLater()
+            logger.debug("%s", formatAdmissionStats(self.admissionStats()))
+
+
+def formatAdmissionStats(stats: AdmissionStats) -> str:
+    return ("Sessions: %d running (peak %d), %d queued (peak %d), %d admitted, %d after waiting %.1fs on "
+            "average and %.1fs at most; refused %d for a full queue, %d for per-peer limits, %d for waiting too "
+            "long; %d handshake timeouts") % (
+        stats.activeSessions, stats.peakActiveSessions, stats.queuedConnections, stats.peakQueuedConnections,
+        stats.admitted, stats.admittedFromQueue, stats.averageWaitTime(), stats.maxWaitTime,
+        stats.rejectedQueueFull, stats.rejectedPerPeer, stats.queueTimeouts, stats.handshakeTimeouts)
+
+
+def run(downloadPath: str, port: int, policy: AcceptPolicy, cryptoThreads: int, diskThreads: int,
+        discoverable: bool, limits: Dict[str, Union[int, float]]) -> int:
+    # downloadPath "", thread counts of -1 and admission limits left out
+    # fall back to the settings shared with the GUI.
+    app = QCoreApplication(sys.argv[:1])
+    app.setOrganizationName("LANDrop")
+    app.setOrganizationDomain("landrop.app")
+    app.setApplicationName("LANDrop")
+    app.setApplicationVersion("0.4.0")
+
+    # The pools are sized before the first session can create them.
+    CryptoPool.instance(cryptoThreads if cryptoThreads >= 0 else Settings.cryptoThreads())
+    DiskPool.instance(diskThreads if diskThreads > 0 else Settings.diskThreads())
+
+    daemon = ReceiverDaemon(None, downloadPath or Settings.downloadPath(), policy)
+    if limits:
+        daemon.limits = dataclasses.replace(Settings.admissionLimits(), **limits)
+    try:
+        daemon.start(port)
+    except RuntimeError as e:
+        logger.error("%s", e)
+        return 1
+    discovery = DiscoveryService()
+    if discoverable:
+        discovery.bindFailed.connect(lambda msg: logger.warning("%s", msg.replace("\n", " ")))
+        discovery.start(daemon.port())
+    logger.info("Receiving into %s on port %d as %s", daemon.downloadPath, daemon.port(), Settings.deviceName())
+
+    # Python only handles signals while it runs, so the event loop hands
+    # control back now and then.
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: app.quit())
+    timer = QTimer()
+    timer.timeout.connect(lambda: None)
+    timer.start(500)
+
+    app.exec()
+    logger.info("%s", formatAdmissionStats(daemon.admissionStats()))
+    if daemon.sessions:
+        logger.warning("Stopped with %d session(s) still running", len(daemon.sessions))
+    else:
+        logger.info("Stopped")
+    return 0
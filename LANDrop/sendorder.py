@@ -0,0 +1,144 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import fnmatch
+import os
+import struct
+from collections import deque
+from typing import Deque, Iterable, Iterator, List, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The order files of a transfer are sent in. The manifest lists the files
+# in that order, so receivers create and fill them in it as well.
+ORDER_ADDED = "added"
+# Smallest files first, so most files complete early.
+ORDER_SMALLEST = "smallest"
+# In the order their data lies on disk, so spinning disks read without
+# seeking between files.
+ORDER_DISK = "disk"
+# Files matching earlier priority patterns first.
+ORDER_PRIORITY = "priority"
+# Takes turns between a few files at a time, so a large file doesn't hold
+# up the ones behind it. Peers without records get the files in turn.
+ORDER_ROUND_ROBIN = "round-robin"
+SEND_ORDERS = (ORDER_ADDED, ORDER_SMALLEST, ORDER_DISK, ORDER_PRIORITY, ORDER_ROUND_ROBIN)
+DEFAULT_SEND_ORDER = ORDER_ADDED
+
+# Files round-robin sends at the same time, and the bytes of one file it
+# sends before moving on to the next.
+ROUND_ROBIN_FILES = 4
+ROUND_ROBIN_QUANTA = 8 << 20
+
+# Linux's FS_IOC_FIEMAP and its request for the first extent of a file.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+
+def priorityOf(filename: str, patterns: List[str]) -> int:
+    # Index of the first pattern filename matches; files matching none come
+    # after all others.
+    for index, pattern in enumerate(patterns):
+        if fnmatch.fnmatch(filename, pattern):
+            return index
+    return len(patterns)
+
+
+def physicalOffset(fd: int) -> int:
+    # Where the first extent of the file lies on its device, or 0 where
+    # that can't be queried.
+    if fcntl is None:
+        return 0
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return 0
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        return 0
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def diskPosition(path: str) -> Tuple[int, int, int]:
+    # Device, physical offset and inode number. Where offsets are unknown,
+    # files are in inode order, which most file systems allocate in.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return 0, 0, 0
+    try:
+        st = os.fstat(fd)
+        return st.st_dev, physicalOffset(fd), st.st_ino
+    finally:
+        os.close(fd)
+
+
+def orderFiles(order: str, paths: List[str], sizes: List[int], patterns: List[str]) -> List[int]:
+    # Indexes of the files in the order they are sent. Files the policy
+    # doesn't tell apart keep the order they were added in.
+    if order == ORDER_SMALLEST:
+        keys = sizes
+    elif order == ORDER_DISK:
+        keys = [diskPosition(path) for path in paths]
+    elif order == ORDER_PRIORITY:
+        keys = [priorityOf(os.path.basename(path), patterns) for path in paths]
+    else:
+        return list(range(len(paths)))
+    return sorted(range(len(paths)), key=keys.__getitem__)
+
+
+def interleave(sources: Iterable[Iterator[Tuple[bytes, int]]], width: int = ROUND_ROBIN_FILES,
+               quanta: int = ROUND_ROBIN_QUANTA) -> Iterator[Tuple[bytes, int]]:
+    # Records of up to width sources at a time, taking turns after quanta
+    # bytes of each. A source is started when another one runs out.
+    sources = iter(sources)
+    active: Deque[Iterator[Tuple[bytes, int]]] = deque()
+    while True:
+        while len(active) < width:
+            source = next(sources, None)
+            if source is None:
+                break
+            active.append(source)
+        if not active:
+            return
+        source = active.popleft()
+        covered = 0
+        while covered < quanta:
+            record = next(source, None)
+            if record is None:
+                break
+            yield record
+            covered += record[1]
+        else:
+            active.append(source)
@@ -0,0 +1,97 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class SessionStats:
+    sendWindow: int = 0
+    bytesInFlight: int = 0
+    peakBytesInFlight: int = 0
+    # Receiving: bytes read from the sockets but not yet handled, and bytes
+    # queued for the disk.
+    bufferedBytes: int = 0
+    peakBufferedBytes: int = 0
+    writeQueueBytes: int = 0
+    peakWriteQueueBytes: int = 0
+    # time.monotonic() when the session started, began transferring and
+    # ended; 0 until then.
+    startTime: float = 0.0
+    transferStartTime: float = 0.0
+    endTime: float = 0.0
+    # Bytes written to and read from the sockets, including frame headers
+    # and cipher overhead, and the plaintext payloads of those frames.
+    wireBytesSent: int = 0
+    wireBytesReceived: int = 0
+    payloadBytesSent: int = 0
+    payloadBytesReceived: int = 0
+    # Seconds spent in each stage, summed over the threads doing it.
+    compressTime: float = 0.0
+    encryptTime: float = 0.0
+    decryptTime: float = 0.0
+    diskReadTime: float = 0.0
+    diskWriteTime: float = 0.0
+    # Seconds the sender waited for the sockets to drain its send window.
+    socketStallTime: float = 0.0
+    stallStartTime: float = 0.0
+
+    def handshakeTime(self) -> float:
+        # Includes the time the receiving user took to accept.
+        if not self.transferStartTime:
+            return 0.0
+        return self.transferStartTime - self.startTime
+
+    def transferTime(self) -> float:
+        if not self.transferStartTime:
+            return 0.0
+        return (self.endTime or time.monotonic()) - self.transferStartTime
+
+    def stallStarted(self) -> None:
+        if not self.stallStartTime:
+            self.stallStartTime = time.monotonic()
+
+    def stallEnded(self) -> None:
+        if self.stallStartTime:
+            self.socketStallTime += time.monotonic() - self.stallStartTime
+            self.stallStartTime = 0.0
+
+    def updateBytesInFlight(self, bytesInFlight: int) -> None:
+        self.bytesInFlight = bytesInFlight
+        self.peakBytesInFlight = max(self.peakBytesInFlight, bytesInFlight)
+
+    def updateBufferedBytes(self, bufferedBytes: int) -> None:
+        self.bufferedBytes = bufferedBytes
+        self.peakBufferedBytes = max(self.peakBufferedBytes, bufferedBytes)
+
+    def updateWriteQueueBytes(self, writeQueueBytes: int) -> None:
+        self.writeQueueBytes = writeQueueBytes
+        self.peakWriteQueueBytes = max(self.peakWriteQueueBytes, writeQueueBytes)
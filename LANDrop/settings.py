@@ -29,9 +29,23 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+from typing import List
+
 from PyQt5.QtCore import QSettings, QStandardPaths, QDir
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtNetwork import QHostInfo
+from LANDrop.framing import DEFAULT_WIDE_FRAME_SIZE, clampWideFrameSize
+from LANDrop.cryptopool import CryptoPool
+from LANDrop.capabilities import MAX_STREAMS
+from LANDrop.filewriter import DEFAULT_DURABILITY, DURABILITY_POLICIES, DiskPool
+from LANDrop.sendorder import DEFAULT_SEND_ORDER, SEND_ORDERS
+from LANDrop.admission import (AdmissionLimits, DEFAULT_HANDSHAKE_TIMEOUT, DEFAULT_MAX_PER_PEER, DEFAULT_MAX_QUEUED,
+                               DEFAULT_MAX_SESSIONS, DEFAULT_QUEUE_TIMEOUT)
+
+DEFAULT_TRANSFER_STREAMS = 4
+DEFAULT_SEND_WINDOW = 8 << 20
+MIN_SEND_WINDOW = 64 << 10
+MAX_SEND_WINDOW = 256 << 20
 
 
 class Settings:
@@ -58,6 +72,110 @@ class Settings:
     def serverPort() -> int:
         return QSettings().value("serverPort", 0)
 
+    @staticmethod
+    def maxFrameSize() -> int:
+        return clampWideFrameSize(int(QSettings().value("maxFrameSize", DEFAULT_WIDE_FRAME_SIZE)))
+
+    @staticmethod
+    def sendWindow() -> int:
+        value = int(QSettings().value("sendWindow", DEFAULT_SEND_WINDOW))
+        return max(MIN_SEND_WINDOW, min(MAX_SEND_WINDOW, value))
+
+    @staticmethod
+    def cryptoThreads() -> int:
+        return int(QSettings().value("cryptoThreads", CryptoPool.defaultThreads()))
+
+    @staticmethod
+    def diskThreads() -> int:
+        return int(QSettings().value("diskThreads", DiskPool.defaultThreads()))
+
+    @staticmethod
+    def transferStreams(peer: str = "") -> int:
+        # A per-peer value, keyed by address, overrides the global one.
+        settings = QSettings()
+        value = settings.value("transferStreams", DEFAULT_TRANSFER_STREAMS)
+        if peer:
+            value = settings.value("peerTransferStreams/" + peer, value)
+        return max(1, min(MAX_STREAMS, int(value)))
+
+    @staticmethod
+    def admissionLimits() -> AdmissionLimits:
+        settings = QSettings()
+        return AdmissionLimits(int(settings.value("maxSessions", DEFAULT_MAX_SESSIONS)),
+                               int(settings.value("maxQueuedConnections", DEFAULT_MAX_QUEUED)),
+                               int(settings.value("maxSessionsPerPeer", DEFAULT_MAX_PER_PEER)),
+                               float(settings.value("handshakeTimeout", DEFAULT_HANDSHAKE_TIMEOUT)),
+                               float(settings.value("queueTimeout", DEFAULT_QUEUE_TIMEOUT)))
+
+    @staticmethod
+    def peerPriority(peer: str) -> int:
+        # Queued connections from peers with a higher priority start first.
+        return int(QSettings().value("peerPriority/" + peer, 0))
+
+    @staticmethod
+    def rateLimit() -> int:
+        # Bytes per second all sessions together may send, and receive;
+        # 0 for no limit.
+        return max(0, int(QSettings().value("rateLimit", 0)))
+
+    @staticmethod
+    def sessionRateLimit() -> int:
+        return max(0, int(QSettings().value("sessionRateLimit", 0)))
+
+    @staticmethod
+    def peerRateLimit(peer: str) -> int:
+        # Shared by all sessions with the peer at this address.
+        return max(0, int(QSettings().value("peerRateLimit/" + peer, 0)))
+
+    @staticmethod
+    def dedup() -> bool:
+        value = QSettings().value("dedup", True)
+        if isinstance(value, str):
+            return value == "true"
+        else:
+            return value
+
+    @staticmethod
+    def durability() -> str:
+        # One of DURABILITY_POLICIES.
+        value = QSettings().value("durability", DEFAULT_DURABILITY)
+        return value if value in DURABILITY_POLICIES else DEFAULT_DURABILITY
+
+    @staticmethod
+    def sendOrder() -> str:
+        # One of SEND_ORDERS.
+        value = QSettings().value("sendOrder", DEFAULT_SEND_ORDER)
+        return value if value in SEND_ORDERS else DEFAULT_SEND_ORDER
+
+    @staticmethod
+    def sendPriorities() -> List[str]:
+        # File name patterns for ORDER_PRIORITY, most urgent first.
+        value = QSettings().value("sendPriorities", [])
+        if isinstance(value, str):
+            return [value]
+        return [str(pattern) for pattern in value or []]
+
+    @staticmethod
+    def compression() -> bool:
+        value = QSettings().value("compression", True)
+        if isinstance(value, str):
+            return value == "true"
+        else:
+            return value
+
+    @staticmethod
+    def delta() -> bool:
+        value = QSettings().value("delta", True)
+        if isinstance(value, str):
+            return value == "true"
+        else:
+            return value
+
+    @staticmethod
+    def digestCachePath() -> str:
+        d = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+        return d + QDir.separator() + "digests.json"
+
     @staticmethod
     def setDeviceName(deviceName: str) -> None:
         QSettings().setValue("deviceName", deviceName)
@@ -73,3 +191,75 @@ class Settings:
     @staticmethod
     def setServerPort(serverPort: int) -> None:
         QSettings().setValue("serverPort", serverPort)
+
+    @staticmethod
+    def setMaxFrameSize(maxFrameSize: int) -> None:
+        QSettings().setValue("maxFrameSize", maxFrameSize)
+
+    @staticmethod
+    def setSendWindow(sendWindow: int) -> None:
+        QSettings().setValue("sendWindow", sendWindow)
+
+    @staticmethod
+    def setCryptoThreads(cryptoThreads: int) -> None:
+        QSettings().setValue("cryptoThreads", cryptoThreads)
+
+    @staticmethod
+    def setDiskThreads(diskThreads: int) -> None:
+        QSettings().setValue("diskThreads", diskThreads)
+
+    @staticmethod
+    def setTransferStreams(transferStreams: int, peer: str = "") -> None:
+        if peer:
+            QSettings().setValue("peerTransferStreams/" + peer, transferStreams)
+        else:
+            QSettings().setValue("transferStreams", transferStreams)
+
+    @staticmethod
+    def setAdmissionLimits(limits: AdmissionLimits) -> None:
+        settings = QSettings()
+        settings.setValue("maxSessions", limits.maxSessions)
+        settings.setValue("maxQueuedConnections", limits.maxQueued)
+        settings.setValue("maxSessionsPerPeer", limits.maxPerPeer)
+        settings.setValue("handshakeTimeout", limits.handshakeTimeout)
+        settings.setValue("queueTimeout", limits.queueTimeout)
+
+    @staticmethod
+    def setPeerPriority(peer: str, priority: int) -> None:
+        QSettings().setValue("peerPriority/" + peer, priority)
+
+    @staticmethod
+    def setRateLimit(rateLimit: int) -> None:
+        QSettings().setValue("rateLimit", rateLimit)
+
+    @staticmethod
+    def setSessionRateLimit(rateLimit: int) -> None:
+        QSettings().setValue("sessionRateLimit", rateLimit)
+
+    @staticmethod
+    def setPeerRateLimit(peer: str, rateLimit: int) -> None:
+        QSettings().setValue("peerRateLimit/" + peer, rateLimit)
+
+    @staticmethod
+    def setDedup(dedup: bool) -> None:
+        QSettings().setValue("dedup", dedup)
+
+    @staticmethod
+    def setDurability(durability: str) -> None:
+        QSettings().setValue("durability", durability)
+
+    @staticmethod
+    def setSendOrder(sendOrder: str) -> None:
+        QSettings().setValue("sendOrder", sendOrder)
+
+    @staticmethod
+    def setSendPriorities(patterns: List[str]) -> None:
+        QSettings().setValue("sendPriorities", patterns)
+
+    @staticmethod
+    def setCompression(compression: bool) -> None:
+        QSettings().setValue("compression", compression)
+
+    @staticmethod
+    def setDelta(delta: bool) -> None:
+        QSettings().setValue("delta", delta)
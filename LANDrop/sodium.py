@@ -2,11 +2,33 @@ from nacl.bindings.randombytes import randombytes
 from nacl.bindings.crypto_scalarmult import crypto_scalarmult_SCALARBYTES, crypto_scalarmult_base, crypto_scalarmult
 from nacl.bindings.crypto_aead import crypto_aead_chacha20poly1305_ietf_KEYBYTES, \
     crypto_aead_chacha20poly1305_ietf_encrypt, crypto_aead_chacha20poly1305_ietf_decrypt, \
-    crypto_aead_chacha20poly1305_ietf_NPUBBYTES
+    crypto_aead_chacha20poly1305_ietf_NPUBBYTES, crypto_aead_chacha20poly1305_ietf_ABYTES
 from nacl.bindings.crypto_generichash import crypto_generichash_BYTES, crypto_generichash_BYTES_MIN, \
     crypto_generichash_BYTES_MAX, crypto_generichash_KEYBYTES_MAX
 from nacl.bindings.crypto_generichash import generichash_blake2b_init, generichash_blake2b_update, \
     generichash_blake2b_final
+from nacl.exceptions import CryptoError
+
+try:
+    from nacl.bindings.crypto_aead import crypto_aead_aes256gcm_encrypt, crypto_aead_aes256gcm_decrypt, \
+        crypto_aead_aes256gcm_NPUBBYTES, crypto_aead_aes256gcm_ABYTES
+    from nacl._sodium import lib as _lib
+
+    def crypto_aead_aes256gcm_is_available() -> bool:
+        return _lib.crypto_aead_aes256gcm_is_available() == 1
+except ImportError:
+    crypto_aead_aes256gcm_encrypt = crypto_aead_aes256gcm_decrypt = None
+    crypto_aead_aes256gcm_NPUBBYTES = crypto_aead_aes256gcm_ABYTES = 0
+
+    def crypto_aead_aes256gcm_is_available() -> bool:
+        return False
+
+try:
+    from nacl.bindings.crypto_aead import crypto_aead_aegis256_encrypt, crypto_aead_aegis256_decrypt, \
+        crypto_aead_aegis256_NPUBBYTES, crypto_aead_aegis256_ABYTES
+except ImportError:
+    crypto_aead_aegis256_encrypt = crypto_aead_aegis256_decrypt = None
+    crypto_aead_aegis256_NPUBBYTES = crypto_aead_aegis256_ABYTES = 0
 
 
 def generichash_blake2b(data: bytes,
@@ -38,6 +60,17 @@ __all__ = [
     "crypto_generichash_BYTES_MAX",
     "crypto_generichash_KEYBYTES_MAX",
     "crypto_aead_chacha20poly1305_ietf_NPUBBYTES",
+    "crypto_aead_chacha20poly1305_ietf_ABYTES",
+    "crypto_aead_aes256gcm_is_available",
+    "crypto_aead_aes256gcm_encrypt",
+    "crypto_aead_aes256gcm_decrypt",
+    "crypto_aead_aes256gcm_NPUBBYTES",
+    "crypto_aead_aes256gcm_ABYTES",
+    "crypto_aead_aegis256_encrypt",
+    "crypto_aead_aegis256_decrypt",
+    "crypto_aead_aegis256_NPUBBYTES",
+    "crypto_aead_aegis256_ABYTES",
+    "CryptoError",
 ]
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import errno
+import os
+from typing import Iterator, Tuple
+
+# Smaller files are not checked for holes; opening them twice would cost
+# more than their holes could save.
+SPARSE_MIN_SIZE = 1 << 20
+
+
+def dataSegments(path: str, offset: int, end: int) -> Iterator[Tuple[int, int, bool]]:
+    # Splits [offset, end) of a file into (start, end, isData) segments,
+    # where the segments that aren't data are holes of a sparse file. Where
+    # holes can't be queried the whole range is data.
+    if not hasattr(os, "SEEK_DATA"):
+        yield offset, end, True
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        yield offset, end, True
+        return
+    try:
+        pos = offset
+        while pos < end:
+            try:
+                data = min(os.lseek(fd, pos, os.SEEK_DATA), end)
+            except OSError as e:
+                # ENXIO: nothing but a hole from pos to the end of the file.
+                data = end if e.errno == errno.ENXIO else pos
+            if data > pos:
+                yield pos, data, False
+                pos = data
+                continue
+            try:
+                hole = min(os.lseek(fd, pos, os.SEEK_HOLE), end)
+            except OSError:
+                hole = end
+            if hole <= pos:
+                hole = end
+            yield pos, hole, True
+            pos = hole
+    finally:
+        os.close(fd)
+
+
+def hasHoles(path: str, size: int) -> bool:
+    if not hasattr(os, "SEEK_HOLE"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return os.lseek(fd, 0, os.SEEK_HOLE) < size
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def isZero(data) -> bool:
+    return len(data) > 0 and data[0] == 0 and data[-1] == 0 and data.count(0) == len(data)
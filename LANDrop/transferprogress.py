@@ -0,0 +1,155 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import math
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+# Milliseconds between progress reports while a transfer runs.
+REPORT_INTERVAL = 100
+# Seconds over which the average throughput follows the instant one.
+SMOOTHING_TIME = 3.0
+
+
+@dataclass(frozen=True)
+class TransferProgress:
+    transferredSize: int
+    totalSize: int
+    # Bytes per second over the last report interval, and smoothed.
+    throughput: float
+    averageThroughput: float
+    # Seconds until the transfer is done, or -1 while unknown.
+    eta: float
+    currentFile: str
+
+    def fraction(self) -> float:
+        if self.totalSize <= 0:
+            return 1.0
+        return self.transferredSize / self.totalSize
+
+
+def formatDuration(seconds: float) -> str:
+    seconds = int(math.ceil(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
+
+class ProgressMeter:
+    # Turns the byte counts of a transfer into TransferProgress samples. It
+    # doesn't depend on an event loop; callers sample it at their own pace.
+
+    def __init__(self) -> None:
+        self.totalSize = 0
+        self.transferredSize = 0
+        self.currentFile = ""
+        self.lastSize = 0
+        self.lastTime = 0.0
+        self.averageThroughput = -1.0
+
+    def start(self, totalSize: int, transferredSize: int) -> None:
+        # Bytes done before the start, such as skipped files, don't count
+        # towards the throughput.
+        self.totalSize = totalSize
+        self.transferredSize = transferredSize
+        self.lastSize = transferredSize
+        self.lastTime = time.monotonic()
+
+    def update(self, transferredSize: int) -> None:
+        self.transferredSize = transferredSize
+
+    def setCurrentFile(self, filename: str) -> None:
+        self.currentFile = filename
+
+    def sample(self) -> Optional[TransferProgress]:
+        now = time.monotonic()
+        elapsed = now - self.lastTime
+        if elapsed <= 0:
+            return None
+        throughput = (self.transferredSize - self.lastSize) / elapsed
+        if self.averageThroughput < 0:
+            self.averageThroughput = throughput
+        else:
+            weight = 1 - math.exp(-elapsed / SMOOTHING_TIME)
+            self.averageThroughput += weight * (throughput - self.averageThroughput)
+        self.lastSize = self.transferredSize
+        self.lastTime = now
+
+        remaining = max(self.totalSize - self.transferredSize, 0)
+        if remaining == 0:
+            eta = 0.0
+        elif self.averageThroughput > 0:
+            eta = remaining / self.averageThroughput
+        else:
+            eta = -1.0
+        return TransferProgress(self.transferredSize, self.totalSize, throughput,
+                                self.averageThroughput, eta, self.currentFile)
+
+
+class ProgressReporter(QObject):
+    # Sessions record their progress here for every chunk, which is cheap;
+    # it is only reported at a fixed rate, so a fast transfer doesn't flood
+    # the UI with signals and repaints.
+    reported = pyqtSignal(object)
+
+    def __init__(self, parent: Optional[QObject]) -> None:
+        super().__init__(parent)
+        self.meter = ProgressMeter()
+        self.timer = QTimer(self)
+        self.timer.setInterval(REPORT_INTERVAL)
+        self.timer.timeout.connect(self.report)
+
+    def start(self, totalSize: int, transferredSize: int) -> None:
+        self.meter.start(totalSize, transferredSize)
+        self.timer.start()
+
+    def update(self, transferredSize: int) -> None:
+        self.meter.transferredSize = transferredSize
+
+    def setCurrentFile(self, filename: str) -> None:
+        self.meter.currentFile = filename
+
+    def stop(self) -> None:
+        self.timer.stop()
+
+    def finish(self) -> None:
+        # Reports the final state right away.
+        if self.timer.isActive():
+            self.timer.stop()
+            self.report()
+
+    def report(self) -> None:
+        progress = self.meter.sample()
+        if progress is not None:
+            self.reported.emit(progress)
@@ -0,0 +1,328 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from LANDrop.capabilities import Capabilities
+from LANDrop.filedigest import decodeBitmap, encodeBitmap
+from LANDrop.framing import TRANSFER_QUANTA, FrameFormat
+from LANDrop.manifest import FileMetadata, fileFromJson, fileFromPageEntry
+from LANDrop.partfile import PartFile
+from LANDrop.sparse import SPARSE_MIN_SIZE, isZero
+from LANDrop.transferrecord import COPY_BODY, RECORD_HEADER_SIZE, ZERO_QUANTA, RecordType, TransferRecord, encodeRecord
+
+# The rules of the transfer protocol, without any I/O: what the messages
+# hold, which records may be sent and accepted, and what is left of each
+# file. The Qt sessions and the asyncio engine both drive these, so they
+# can differ in how they move bytes but not in what they send.
+
+
+class ManifestReader:
+    # Collects the file list a sender announces: the handshake message and,
+    # for long lists, the pages after it.
+
+    def __init__(self) -> None:
+        self.deviceName = ""
+        # The sender's capabilities; None from senders that predate
+        # negotiation.
+        self.offer: Optional[Capabilities] = None
+        self.files: List[FileMetadata] = []
+        self.totalSize = 0
+        self.headerRead = False
+        # Files of a paged list that are still to come.
+        self.pendingFiles = 0
+        # Names of the listed files so far, to refuse duplicates.
+        self.names: Set[str] = set()
+
+    def isComplete(self) -> bool:
+        return self.headerRead and self.pendingFiles == 0
+
+    def read(self, obj) -> bool:
+        # Takes the next message; False if it is malformed.
+        if not isinstance(obj, dict):
+            return False
+        if self.headerRead:
+            return self.readPage(obj)
+        deviceName = obj.get("device_name")
+        files = obj.get("files")
+        fileCount = obj.get("file_count", 0)
+        if (not isinstance(deviceName, str) or not isinstance(files, list) or not isinstance(fileCount, int)
+                or fileCount < 0 or (fileCount > 0 and files) or (not files and fileCount == 0)):
+            return False
+        if "capabilities" in obj:
+            self.offer = Capabilities.fromJson(obj["capabilities"])
+            if self.offer is None:
+                return False
+        if not all(self.addFile(fileFromJson(entry, self.names)) for entry in files):
+            return False
+        self.deviceName = deviceName
+        self.pendingFiles = fileCount
+        self.headerRead = True
+        return True
+
+    def readPage(self, obj: dict) -> bool:
+        # A page of [filename, size, mtime, blake2b] entries, with a trailing
+        # 1 for sparse files.
+        files = obj.get("files")
+        if not isinstance(files, list) or not files or len(files) > self.pendingFiles:
+            return False
+        if not all(self.addFile(fileFromPageEntry(entry, self.names)) for entry in files):
+            return False
+        self.pendingFiles -= len(files)
+        return True
+
+    def addFile(self, metadata: Optional[FileMetadata]) -> bool:
+        if metadata is None:
+            return False
+        self.totalSize += metadata.size
+        self.files.append(metadata)
+        return True
+
+
+@dataclass
+class TransferResponse:
+    # The receiver's answer to a file list.
+    accepted: bool
+    # None when either side predates capability negotiation.
+    capabilities: Optional[Capabilities] = None
+    # Files the receiver already has, those it holds the first bytes of,
+    # and those it has an older version of and sends signatures for.
+    haveFiles: Set[int] = field(default_factory=set)
+    resumeOffsets: Dict[int, int] = field(default_factory=dict)
+    deltaFiles: Set[int] = field(default_factory=set)
+    # For extra streams to join the session with.
+    streamToken: str = ""
+
+    def toJson(self, fileCount: int) -> dict:
+        obj = {"response": int(self.accepted)}
+        capabilities = self.capabilities
+        if not self.accepted or capabilities is None:
+            return obj
+        obj["capabilities"] = capabilities.toJson()
+        if self.streamToken:
+            obj["stream_token"] = self.streamToken
+        if capabilities.dedup:
+            obj["have"] = encodeBitmap(self.haveFiles, fileCount)
+        if capabilities.resume:
+            obj["resume_offsets"] = [[index, offset] for index, offset in self.resumeOffsets.items()]
+        if capabilities.delta:
+            obj["delta"] = encodeBitmap(self.deltaFiles, fileCount)
+        return obj
+
+    @staticmethod
+    def fromJson(obj, offered: Capabilities, files: List[FileMetadata]) -> Optional['TransferResponse']:
+        # The response to offered capabilities and files, or None if it is
+        # malformed or asks for something that wasn't offered.
+        if not isinstance(obj, dict) or not isinstance(obj.get("response"), (float, int)):
+            return None
+        response = TransferResponse(int(obj["response"]) != 0)
+        if not response.accepted:
+            return response
+        if "capabilities" in obj:
+            response.capabilities = Capabilities.fromJson(obj["capabilities"])
+            if response.capabilities is None or not response.capabilities.acceptable(offered):
+                return None
+        capabilities = response.capabilities or Capabilities()
+
+        if capabilities.dedup:
+            have = obj.get("have", "")
+            haveFiles = decodeBitmap(have, len(files)) if isinstance(have, str) else None
+            if haveFiles is None:
+                return None
+            response.haveFiles = haveFiles
+        if capabilities.resume:
+            offsets = obj.get("resume_offsets", [])
+            if not isinstance(offsets, list):
+                return None
+            for entry in offsets:
+                if not isinstance(entry, list) or len(entry) != 2:
+                    return None
+                index, offset = entry
+                if (not isinstance(index, int) or not 0 <= index < len(files)
+                        or not isinstance(offset, int) or not 0 <= offset <= files[index].size):
+                    return None
+                if index not in response.haveFiles:
+                    response.resumeOffsets[index] = offset
+        if capabilities.delta:
+            delta = obj.get("delta", "")
+            deltaFiles = decodeBitmap(delta, len(files)) if isinstance(delta, str) else None
+            if deltaFiles is None or deltaFiles & (response.haveFiles | set(response.resumeOffsets)):
+                return None
+            response.deltaFiles = deltaFiles
+        token = obj.get("stream_token", "")
+        response.streamToken = token if isinstance(token, str) else ""
+        return response
+
+
+def matchingFiles(files: List[FileMetadata], digests: List[Optional[str]]) -> Set[int]:
+    # Files whose digest matches that of the local copy at the same index.
+    return {index for index, digest in enumerate(digests) if digest and digest == files[index].digest}
+
+
+def findResumeOffsets(files: List[FileMetadata], filePath: Callable[[int], str],
+                      haveFiles: Set[int]) -> Dict[int, int]:
+    # The leading bytes of files that earlier sessions left behind.
+    offsets = {}
+    for index, metadata in enumerate(files):
+        if metadata.size == 0 or index in haveFiles:
+            continue
+        offset = PartFile(filePath(index), metadata.size, metadata.mtime).resumeOffset()
+        if offset > 0:
+            offsets[index] = offset
+    return offsets
+
+
+def rawQuanta(frameFormat: FrameFormat, maxPayloadSize: int) -> int:
+    # File data per frame of the original data phase.
+    return maxPayloadSize if frameFormat == FrameFormat.WIDE else TRANSFER_QUANTA
+
+
+def recordQuanta(maxPayloadSize: int) -> int:
+    # File data per DATA record that fills a frame.
+    return maxPayloadSize - RECORD_HEADER_SIZE
+
+
+def sendsHoles(capabilities: Capabilities, metadata: FileMetadata) -> bool:
+    # Whether to look for holes in a file; for smaller files opening them
+    # twice would cost more than their holes could save.
+    return capabilities.sparse and metadata.size >= SPARSE_MIN_SIZE
+
+
+def dataRecord(capabilities: Capabilities, index: int, offset: int, data) -> Tuple[bytes, int]:
+    # Data read from a file, as a ZERO record where that can be sent.
+    if capabilities.sparse and isZero(data):
+        return encodeRecord(RecordType.ZERO, index, offset, len(data)), len(data)
+    return encodeRecord(RecordType.DATA, index, offset, len(data), data), len(data)
+
+
+def zeroRecords(index: int, start: int, stop: int) -> Iterator[Tuple[bytes, int]]:
+    # A hole of a sparse file only takes headers.
+    while start < stop:
+        size = min(ZERO_QUANTA, stop - start)
+        yield encodeRecord(RecordType.ZERO, index, start, size), size
+        start += size
+
+
+class RecordBatch:
+    # Packs consecutive records into shared frames as long as they fit, so a
+    # run of small files costs a few frames rather than one each. The record
+    # headers serve as the index of a frame.
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.parts: List[bytes] = []
+        self.size = 0
+        self.covered = 0
+
+    def add(self, data: bytes, covered: int) -> Optional[Tuple[bytes, int]]:
+        # Returns the frame that is complete because data doesn't fit in it.
+        frame = self.take() if self.parts and self.size + len(data) > self.limit else None
+        self.parts.append(data)
+        self.size += len(data)
+        self.covered += covered
+        return frame
+
+    def take(self) -> Optional[Tuple[bytes, int]]:
+        # The frame so far, and the file bytes it covers.
+        if not self.parts:
+            return None
+        frame = b"".join(self.parts), self.covered
+        self.parts, self.size, self.covered = [], 0, 0
+        return frame
+
+
+def validRecord(record: TransferRecord, capabilities: Capabilities, nested: bool = False) -> bool:
+    # Whether a receiver may act on a record under the negotiated
+    # capabilities; nested records came out of COMPRESSED_RECORDS.
+    if record.type == RecordType.DATA:
+        return len(record.body) == record.length
+    if record.type == RecordType.COMPRESSED_RECORDS:
+        return not nested and bool(capabilities.compressionMethod())
+    if record.type == RecordType.COMPRESSED:
+        return bool(capabilities.compressionMethod())
+    if record.type == RecordType.ZERO:
+        return not record.body and capabilities.sparse
+    if record.type == RecordType.COPY:
+        return capabilities.delta and len(record.body) == COPY_BODY.size
+    return False
+
+
+class ReceiveLedger:
+    # What is left to receive of every file of a transfer.
+
+    def __init__(self, files: List[FileMetadata], haveFiles: Set[int], resumeOffsets: Dict[int, int]) -> None:
+        self.files = files
+        self.remaining = [metadata.size for metadata in files]
+        # Bytes already in place before any data arrived.
+        self.initialSize = 0
+        self.completedFiles = 0
+        self.nextRawFile = 0
+        for index in haveFiles:
+            self.remaining[index] = 0
+            self.initialSize += files[index].size
+        for index, offset in resumeOffsets.items():
+            self.remaining[index] -= offset
+            self.initialSize += offset
+        # Files with nothing left to receive that still have to be created
+        # or renamed into place.
+        self.completeFiles = [index for index, remaining in enumerate(self.remaining)
+                              if remaining == 0 and index not in haveFiles]
+        self.completedFiles = self.remaining.count(0)
+
+    def isComplete(self) -> bool:
+        return self.completedFiles == len(self.files)
+
+    def claim(self, index: int, offset: int, length: int) -> bool:
+        # Counts length bytes at offset of a file as received; False if
+        # they lie outside of what is left of it. Empty claims don't
+        # complete a file twice.
+        if (not 0 <= index < len(self.remaining) or length > self.remaining[index]
+                or (length == 0 and self.remaining[index] == 0)
+                or offset + length > self.files[index].size):
+            return False
+        self.remaining[index] -= length
+        if self.remaining[index] == 0:
+            self.completedFiles += 1
+        return True
+
+    def isFileComplete(self, index: int) -> bool:
+        return self.remaining[index] == 0
+
+    def nextRawChunk(self, size: int) -> Optional[Tuple[int, int, int]]:
+        # In the original data phase file contents follow each other in
+        # order. Returns the file, offset and length the next size bytes
+        # start with, or None if no file has anything left.
+        while self.nextRawFile < len(self.remaining) and self.remaining[self.nextRawFile] == 0:
+            self.nextRawFile += 1
+        if self.nextRawFile == len(self.remaining):
+            return None
+        index = self.nextRawFile
+        return index, self.files[index].size - self.remaining[index], min(self.remaining[index], size)
@@ -0,0 +1,91 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Iterator, Union
+
+# type, file index, offset in the file, bytes of the file covered, body size
+RECORD_HEADER = struct.Struct(">BIQII")
+RECORD_HEADER_SIZE = RECORD_HEADER.size
+
+
+# Body of a COPY record: where the data is found in the receiver's old copy.
+COPY_BODY = struct.Struct(">Q")
+# Longest run of zeros a single ZERO record covers.
+ZERO_QUANTA = 1 << 30
+
+
+class RecordType(IntEnum):
+    DATA = 1
+    # Data the receiver copies from its existing version of the file.
+    COPY = 2
+    # Receiver to sender: block signatures of its existing version of a
+    # file, starting at block number offset. length is the size of that
+    # version; 0 means it has none after all.
+    SIGNATURES = 3
+    # DATA compressed with the negotiated method; length is its size
+    # uncompressed.
+    COMPRESSED = 4
+    # length bytes of zeros, without a body. The receiver leaves a hole.
+    ZERO = 5
+    # Several records compressed together with the negotiated method;
+    # length is their size uncompressed. Used for frames of small files.
+    COMPRESSED_RECORDS = 6
+
+
+@dataclass
+class TransferRecord:
+    type: int
+    fileIndex: int
+    offset: int
+    length: int
+    body: memoryview
+
+
+def encodeRecord(recordType: int, fileIndex: int, offset: int, length: int,
+                 body: Union[bytes, memoryview] = b"") -> bytes:
+    return RECORD_HEADER.pack(recordType, fileIndex, offset, length, len(body)) + body
+
+
+def decodeRecords(data: Union[bytes, memoryview]) -> Iterator[TransferRecord]:
+    # A frame holds one or more records back to back.
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        if len(view) - pos < RECORD_HEADER_SIZE:
+            raise ValueError("truncated record header")
+        recordType, fileIndex, offset, length, bodySize = RECORD_HEADER.unpack_from(view, pos)
+        pos += RECORD_HEADER_SIZE
+        if len(view) - pos < bodySize:
+            raise ValueError("truncated record body")
+        yield TransferRecord(recordType, fileIndex, offset, length, view[pos:pos + bodySize])
+        pos += bodySize
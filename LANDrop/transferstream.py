@@ -0,0 +1,231 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import TYPE_CHECKING, Callable, Optional
+
+from PyQt5.QtCore import QObject
+from PyQt5.QtNetwork import QTcpSocket, QAbstractSocket
+
+from LANDrop.framing import openFrame, sealFrame
+from LANDrop.receivebuffer import ReceiveBuffer
+from LANDrop.cryptopool import CryptoPool, FrameSequencer
+
+if TYPE_CHECKING:
+    from LANDrop.filetransfersession import FileTransferSession
+
+
+# Bytes Qt may buffer from the socket before it leaves the rest to TCP flow
+# control; at least one frame more is buffered by the stream itself.
+SOCKET_READ_BUFFER_SIZE = 1 << 20
+# Bytes of received frames waiting for the crypto pool at which the stream
+# stops reading.
+DECRYPT_BACKLOG_LIMIT = 32 << 20
+
+
+class TransferStream(QObject):
+    # One TCP connection of a session: its receive buffer, frame parsing and
+    # the ordering of frames through the crypto pool. Framing, keys and the
+    # protocol state live on the session, which can change when a stream
+    # joins another session.
+
+    def __init__(self, session: 'FileTransferSession', socket: QTcpSocket, pool: Optional[CryptoPool]) -> None:
+        super().__init__(session)
+        self.session = session
+        self.socket = socket
+        self.readBuffer = ReceiveBuffer()
+        self.encryptSequencer = None
+        self.decryptSequencer = None
+        self.pendingEncryptBytes = 0
+        self.pendingDecryptBytes = 0
+        self.remoteClosed = False
+        self.disconnectPending = False
+
+        if pool:
+            self.encryptSequencer = FrameSequencer(self, pool, self.encryptedFramesReady)
+            self.decryptSequencer = FrameSequencer(self, pool, self.decryptedFramesReady)
+
+        self.socket.setParent(self)
+        self.socket.setSocketOption(QAbstractSocket.LowDelayOption, 1)
+        self.socket.setReadBufferSize(SOCKET_READ_BUFFER_SIZE)
+        self.socket.readyRead.connect(self.socketReadyRead)
+        self.socket.error.connect(self.socketErrorOccurred)
+        self.socket.bytesWritten.connect(self.socketBytesWritten)
+
+    def moveToSession(self, session: 'FileTransferSession') -> None:
+        self.session = session
+        self.setParent(session)
+
+    def bytesInFlight(self) -> int:
+        return self.socket.bytesToWrite() + self.pendingEncryptBytes
+
+    def bufferedBytes(self) -> int:
+        return len(self.readBuffer) + self.socket.bytesAvailable() + self.pendingDecryptBytes
+
+    def readingPaused(self) -> bool:
+        return self.pendingDecryptBytes >= DECRYPT_BACKLOG_LIMIT or self.session.readingPaused()
+
+    def isIdle(self) -> bool:
+        pendingDecrypts = len(self.decryptSequencer) if self.decryptSequencer is not None else 0
+        return pendingDecrypts == 0 and len(self.readBuffer) == 0 and self.socket.bytesAvailable() == 0
+
+    def encryptAndSend(self, data: bytes, prepare: Optional[Callable[[bytes], bytes]] = None) -> bool:
+        # prepare, if given, transforms data right before encryption without
+        # ever making it larger, e.g. to compress it.
+        session = self.session
+        size = len(data) + session.crypto.overhead()
+        if size > session.maxFrameSize:
+            session.errorOccurred.emit(session.tr("Frame too large."))
+            return False
+        session.stats.payloadBytesSent += len(data)
+        if self.encryptSequencer is None:
+            self.writeFrame(*sealFrame(session.crypto, session.crypto.cipher, session.frameFormat, data, prepare))
+            return True
+
+        # Frames are encrypted on the pool and written in submission order
+        # by encryptedFramesReady().
+        estimate = session.frameFormat.headerSize() + size
+        self.pendingEncryptBytes += estimate
+        self.encryptSequencer.submit(estimate, sealFrame, session.crypto, session.crypto.cipher,
+                                     session.frameFormat, data, prepare)
+        return True
+
+    def encryptedFramesReady(self) -> None:
+        try:
+            for estimate, sealed in self.encryptSequencer.takeReady():
+                self.pendingEncryptBytes -= estimate
+                self.writeFrame(*sealed)
+        except RuntimeError as e:
+            self.encryptSequencer.clear()
+            self.session.errorOccurred.emit(str(e))
+            return
+        if self.disconnectPending and len(self.encryptSequencer) == 0:
+            self.socket.disconnectFromHost()
+        self.session.socketBytesWritten()
+
+    def writeFrame(self, header: bytes, sendData: bytes, compressTime: float, encryptTime: float) -> None:
+        stats = self.session.stats
+        stats.wireBytesSent += len(header) + len(sendData)
+        stats.compressTime += compressTime
+        stats.encryptTime += encryptTime
+        self.socket.write(header)
+        self.socket.write(sendData)
+
+    def decryptedFramesReady(self) -> None:
+        paused = self.readingPaused()
+        try:
+            for size, (data, decryptTime) in self.decryptSequencer.takeReady():
+                self.pendingDecryptBytes -= size
+                self.session.stats.decryptTime += decryptTime
+                self.session.stats.payloadBytesReceived += len(data)
+                self.session.processReceivedData(data)
+        except RuntimeError as e:
+            self.decryptSequencer.clear()
+            self.session.errorOccurred.emit(str(e))
+            return
+        if paused and not self.readingPaused():
+            self.socketReadyRead()
+        self.session.updateReceiveStats()
+        self.session.checkRemoteClosed()
+
+    def socketReadyRead(self) -> None:
+        # While paused, data is left in the socket; once Qt's buffer is
+        # full TCP flow control throttles the sender.
+        if self.readingPaused():
+            return
+        received = self.socket.readAll()
+        self.session.stats.wireBytesReceived += len(received)
+        if self.session.receiveLimit is not None:
+            self.session.receiveLimit.consume(len(received))
+        self.readBuffer.append(received)
+
+        if self.session.expectsPublicKey():
+            # The public key may arrive split across several segments; wait
+            # until all of it has been buffered.
+            keySize = self.session.crypto.publicKeySize()
+            if len(self.readBuffer) < keySize:
+                return
+            if not self.session.publicKeyReceived(self.readBuffer.take(keySize)):
+                return
+
+        # The frame format and even the owning session can change while
+        # processing a frame, so both are looked up again for every frame.
+        while len(self.readBuffer) >= self.session.frameFormat.headerSize():
+            session = self.session
+            headerSize = session.frameFormat.headerSize()
+            size = session.frameFormat.decodeHeader(self.readBuffer.peek(headerSize))
+            if size > session.maxFrameSize:
+                session.errorOccurred.emit(session.tr("Frame too large."))
+                return
+            if len(self.readBuffer) < size + headerSize or self.readingPaused():
+                break
+
+            frame = self.readBuffer.peek(size + headerSize)[headerSize:]
+            if self.decryptSequencer is not None and session.isTransferring():
+                # Only bulk data is decrypted on the pool. Handshake messages
+                # may change the frame format, so they are handled in line.
+                self.decryptSequencer.submit(size, openFrame, session.crypto, session.crypto.cipher, bytes(frame))
+                self.pendingDecryptBytes += size
+                frame.release()
+                self.readBuffer.consume(size + headerSize)
+                continue
+
+            try:
+                data, decryptTime = openFrame(session.crypto, session.crypto.cipher, frame)
+            except RuntimeError as e:
+                session.errorOccurred.emit(str(e))
+                return
+            finally:
+                frame.release()
+            self.readBuffer.consume(size + headerSize)
+            session.stats.decryptTime += decryptTime
+            session.stats.payloadBytesReceived += len(data)
+
+            session.processReceivedData(data)
+
+        self.session.updateReceiveStats()
+
+    def socketBytesWritten(self) -> None:
+        self.session.socketBytesWritten()
+
+    def socketErrorOccurred(self) -> None:
+        if self.socket.error() == QAbstractSocket.RemoteHostClosedError:
+            # The peer may close right after its last frame; whatever is
+            # still buffered or being decrypted can complete the transfer.
+            self.remoteClosed = True
+            self.session.checkRemoteClosed()
+            return
+        self.session.streamErrorOccurred(self, self.socket.errorString())
+
+    def disconnectFromHost(self) -> None:
+        # Frames still in the crypto pool are written before closing.
+        if self.encryptSequencer is not None and len(self.encryptSequencer) > 0:
+            self.disconnectPending = True
+            return
+        self.socket.disconnectFromHost()
@@ -30,7 +30,7 @@
 from typing import Optional
 
 from PyQt5.QtCore import QObject, QSysInfo, QTimer, QDir, QUrl, Qt
-from PyQt5.QtWidgets import QApplication, QSystemTrayIcon, QMenu
+from PyQt5.QtWidgets import QApplication, QSystemTrayIcon, QMenu, QMessageBox
 from PyQt5.QtGui import QIcon, QDesktopServices
 from PyQt5.QtNetwork import QNetworkProxy
 from LANDrop.settings import Settings
@@ -90,6 +90,8 @@ class TrayIcon(QSystemTrayIcon):
         self._server.start()
         addrPortAction.setText(self.tr("Port: ") + str(self._server.port()))
 
+        self._discoveryService.bindFailed.connect(
+            lambda msg: QMessageBox.warning(None, QApplication.applicationName(), msg))
         self._discoveryService.start(self._server.port())
 
         QTimer.singleShot(0,
@@ -0,0 +1,106 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import random
+from typing import List, Tuple
+
+# Bytes written per call while generating files.
+WRITE_SIZE = 1 << 20
+
+# Sizes at scale 1.0.
+HUGE_SIZE = 256 << 20
+TINY_COUNT = 2000
+TINY_SIZE = 4 << 10
+MIXED_SIZE = 128 << 20
+
+
+def hugeSizes(scale: float) -> List[int]:
+    return [max(1, int(HUGE_SIZE * scale))]
+
+
+def tinySizes(scale: float) -> List[int]:
+    return [TINY_SIZE] * max(1, int(TINY_COUNT * scale))
+
+
+def mixedSizes(scale: float) -> List[int]:
+    # Log-normal like a typical folder: many small files, a few large ones.
+    rng = random.Random(1)
+    total = int(MIXED_SIZE * scale)
+    sizes = []
+    while sum(sizes) < total:
+        sizes.append(min(int(rng.lognormvariate(11, 2.5)), total))
+    return sizes
+
+
+DATASETS = {
+    "huge": hugeSizes,
+    "tiny": tinySizes,
+    "mixed": mixedSizes,
+}
+
+TEXT_LINE = b"2021-01-01 00:00:00 INFO transfer of file %08d finished with status ok\n"
+
+
+def fileContents(size: int, content: str, rng: random.Random):
+    # Random data doesn't compress, like photos and videos; text does.
+    written = 0
+    counter = 0
+    while written < size:
+        length = min(WRITE_SIZE, size - written)
+        if content == "text":
+            lines = []
+            lineSize = 0
+            while lineSize < length:
+                line = TEXT_LINE % counter
+                counter += rng.randrange(1, 100)
+                lines.append(line)
+                lineSize += len(line)
+            chunk = b"".join(lines)[:length]
+        else:
+            chunk = os.urandom(length)
+        yield chunk
+        written += length
+
+
+def generateDataset(name: str, path: str, scale: float, content: str) -> Tuple[int, int]:
+    # Creates the files of a dataset in path unless they are there already,
+    # returning the file count and total size.
+    sizes = DATASETS[name](scale)
+    rng = random.Random(2)
+    os.makedirs(path, exist_ok=True)
+    for index, size in enumerate(sizes):
+        filePath = os.path.join(path, f"{name}{index:06}.bin")
+        if os.path.exists(filePath) and os.path.getsize(filePath) == size:
+            continue
+        with open(filePath, "wb") as file:
+            for chunk in fileContents(size, content, rng):
+                file.write(chunk)
+    return len(sizes), sum(sizes)
@@ -0,0 +1,362 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Runs FileTransferSender against FileTransferReceiver over loopback without
+# any UI and reports the results as JSON:
+#
+#     python -m benchmarks.loopback --datasets huge,mixed --frame-sizes 1M,4M
+#
+# With --profiles the connections go through benchmarks.netem, emulating
+# wired and wireless networks.
+#
+# Every configuration runs in a process of its own so CPU time and peak RSS
+# belong to that run alone.
+
+import argparse
+import dataclasses
+import hashlib
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.datasets import DATASETS, generateDataset
+from benchmarks.netem import PROFILES
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds after which a run counts as failed.
+DEFAULT_TIMEOUT = 600
+
+
+def parseSize(text: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parseList(text: str, parse) -> List[Any]:
+    return [parse(item) for item in text.split(",") if item.strip()]
+
+
+def parseBool(text: str) -> bool:
+    return text.strip().lower() in ("1", "on", "true", "yes")
+
+
+def resourceUsage() -> Dict[str, Optional[float]]:
+    if resource is None:
+        return {"cpuSeconds": time.process_time(), "peakRssBytes": None}
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peakRss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return {"cpuSeconds": usage.ru_utime + usage.ru_stime, "peakRssBytes": peakRss}
+
+
+def fileDigest(path: str) -> bytes:
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def mismatchedFiles(source: str, destination: str, names: List[str]) -> List[str]:
+    # Names of the files that didn't arrive as they were sent.
+    mismatched = []
+    for name in names:
+        received = os.path.join(destination, name)
+        if not os.path.isfile(received) or fileDigest(received) != fileDigest(os.path.join(source, name)):
+            mismatched.append(name)
+    return mismatched
+
+
+def runTransfer(config: Dict[str, Any]) -> Dict[str, Any]:
+    # Performs one transfer in this process. Qt and LANDrop are only
+    # imported here, after the platform plugin has been chosen.
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    from PyQt5.QtCore import QFile, QIODevice, QObject, QSettings, QStandardPaths, QTimer, QUrl, pyqtSlot
+    from PyQt5.QtGui import QDesktopServices
+    from PyQt5.QtNetwork import QHostAddress, QTcpServer, QTcpSocket
+    from PyQt5.QtWidgets import QApplication
+    from LANDrop.filetransferreceiver import FileTransferReceiver
+    from LANDrop.filetransfersender import FileTransferSender
+    from LANDrop.settings import Settings
+
+    class UrlSink(QObject):
+        # Keeps the receiver from opening a file manager when it is done.
+        @pyqtSlot(QUrl)
+        def openUrl(self, url: QUrl) -> None:
+            pass
+
+    app = QApplication([])
+    app.setOrganizationName("LANDrop")
+    app.setApplicationName("LANDropBenchmark")
+    QStandardPaths.setTestModeEnabled(True)
+    QSettings.setDefaultFormat(QSettings.IniFormat)
+    QSettings.setPath(QSettings.IniFormat, QSettings.UserScope, config["settingsPath"])
+    sink = UrlSink()
+    QDesktopServices.setUrlHandler("file", sink, "openUrl")
+
+    Settings.setDownloadPath(config["destination"])
+    Settings.setMaxFrameSize(config["frameSize"])
+    Settings.setCryptoThreads(config["cryptoThreads"])
+    Settings.setCompression(config["compression"])
+    Settings.setTransferStreams(config["streams"])
+    Settings.setDedup(False)
+
+    names = sorted(os.listdir(config["source"]))
+    files = []
+    for name in names:
+        file = QFile(os.path.join(config["source"], name))
+        if not file.open(QIODevice.ReadOnly):
+            raise RuntimeError("unable to open " + name)
+        files.append(file)
+
+    result: Dict[str, Any] = {"error": None}
+    sessions: List[Any] = []
+
+    def fail(message: str) -> None:
+        if result["error"] is None:
+            result["error"] = message
+        app.quit()
+
+    def receiverDone(stats) -> None:
+        if result["error"] is None:
+            result["end"] = time.perf_counter()
+            result["receiverStats"] = stats
+        app.quit()
+
+    def newConnection() -> None:
+        while server.hasPendingConnections():
+            receiver = FileTransferReceiver(None, server.nextPendingConnection())
+            # Extra streams join the first session and end their own.
+            if not sessions:
+                receiver.errorOccurred.connect(fail)
+                receiver.statsSummaryReady.connect(receiverDone)
+            receiver.fileMetadataReady.connect(lambda *args, receiver=receiver: receiver.respond(True))
+            sessions.append(receiver)
+            receiver.start()
+
+    server = QTcpServer()
+    if not server.listen(QHostAddress.LocalHost, 0):
+        raise RuntimeError("unable to listen on loopback")
+    server.newConnection.connect(newConnection)
+    port = server.serverPort()
+
+    # The proxy runs in a process of its own so its CPU time isn't ours.
+    proxy = None
+    if config["profile"] != "loopback":
+        proxy = subprocess.Popen([sys.executable, "-m", "benchmarks.netem", "--profile", config["profile"],
+                                  "--target", "127.0.0.1:%d" % port], cwd=ROOT, stdout=subprocess.PIPE)
+        port = int(proxy.stdout.readline().decode().rpartition(":")[2])
+
+    socket = QTcpSocket()
+    sender: List[FileTransferSender] = []
+
+    def connected() -> None:
+        session = FileTransferSender(None, socket, files)
+        session.errorOccurred.connect(fail)
+        session.statsSummaryReady.connect(lambda stats: result.__setitem__("senderStats", stats))
+        sender.append(session)
+        result["start"] = time.perf_counter()
+        session.start()
+
+    socket.connected.connect(connected)
+    socket.connectToHost(QHostAddress.LocalHost, port)
+    QTimer.singleShot(int(config["timeout"] * 1000), lambda: fail("timeout"))
+    usageBefore = resourceUsage()
+    app.exec()
+    usageAfter = resourceUsage()
+    if proxy is not None:
+        proxy.terminate()
+        proxy.wait()
+
+    if result["error"] is not None:
+        return {"error": result["error"]}
+    # A fast transfer only counts if it delivered the right bytes.
+    mismatched = mismatchedFiles(config["source"], config["destination"], names)
+    if mismatched:
+        return {"error": "%d file(s) received differ from the source, e.g. %s"
+                % (len(mismatched), ", ".join(mismatched[:5]))}
+    senderStats = sender[0].statsSnapshot() if "senderStats" not in result else result["senderStats"]
+    receiverStats = result["receiverStats"]
+    seconds = result["end"] - result["start"]
+    size = sum(os.path.getsize(os.path.join(config["source"], name)) for name in names)
+    cpuSeconds = usageAfter["cpuSeconds"] - usageBefore["cpuSeconds"]
+    return {
+        "error": None,
+        "files": len(names),
+        "bytes": size,
+        "seconds": seconds,
+        "mbPerSecond": size / seconds / 1e6,
+        "cpuSecondsPerGb": cpuSeconds / (size / 1e9) if size else 0.0,
+        "peakRssBytes": usageAfter["peakRssBytes"],
+        "cipher": sender[0].crypto.cipher.name,
+        "openStreams": len(sender[0].streams),
+        "senderStats": statsToJson(senderStats),
+        "receiverStats": statsToJson(receiverStats),
+    }
+
+
+def statsToJson(stats) -> Dict[str, Any]:
+    data = dataclasses.asdict(stats)
+    data["handshakeTime"] = stats.handshakeTime()
+    data["transferTime"] = stats.transferTime()
+    return data
+
+
+def runChild(config: Dict[str, Any]) -> Dict[str, Any]:
+    # Runs one configuration in a fresh interpreter.
+    process = subprocess.run([sys.executable, "-m", "benchmarks.loopback", "--child", json.dumps(config)],
+                             cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             timeout=config["timeout"] + 60)
+    lines = process.stdout.decode("utf-8", "replace").strip().splitlines()
+    if process.returncode != 0 or not lines:
+        return {"error": process.stderr.decode("utf-8", "replace").strip()[-2000:] or "exit code %d"
+                % process.returncode}
+    return json.loads(lines[-1])
+
+
+def environment() -> Dict[str, Any]:
+    from LANDrop.crypto import availableCiphers
+    from LANDrop.compressor import availableCompression
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpuCount": os.cpu_count(),
+        "ciphers": availableCiphers(),
+        "compression": availableCompression(),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loopback",
+                                     description="LANDrop loopback throughput benchmark")
+    parser.add_argument("--datasets", default=",".join(DATASETS),
+                        help="comma separated datasets: " + ", ".join(DATASETS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the dataset sizes")
+    parser.add_argument("--content", choices=("random", "text"), default="random",
+                        help="incompressible or compressible file contents")
+    parser.add_argument("--frame-sizes", default="1M,4M,16M", help="comma separated frame sizes, 1M to 16M")
+    parser.add_argument("--crypto-threads", default="0,%d" % (os.cpu_count() or 1),
+                        help="comma separated crypto pool sizes, 0 for none")
+    parser.add_argument("--compression", default="off,on", help="comma separated on/off values")
+    parser.add_argument("--streams", default="4", help="comma separated stream counts")
+    parser.add_argument("--profiles", default="loopback",
+                        help="comma separated network profiles: " + ", ".join(PROFILES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds per run")
+    parser.add_argument("--workdir", help="where datasets are kept between invocations")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(runTransfer(json.loads(args.child))))
+        return 0
+
+    datasets = parseList(args.datasets, str.strip)
+    for name in datasets:
+        if name not in DATASETS:
+            parser.error("unknown dataset " + name)
+    from LANDrop.framing import MAX_WIDE_FRAME_SIZE, MIN_WIDE_FRAME_SIZE, clampWideFrameSize
+    frameSizes = parseList(args.frame_sizes, parseSize)
+    for size in frameSizes:
+        # Settings would silently clamp the size, labelling the run wrongly.
+        if clampWideFrameSize(size) != size:
+            parser.error("frame size %d is outside %d to %d" % (size, MIN_WIDE_FRAME_SIZE, MAX_WIDE_FRAME_SIZE))
+    cryptoThreads = parseList(args.crypto_threads, int)
+    compression = parseList(args.compression, parseBool)
+    streams = parseList(args.streams, int)
+    profiles = parseList(args.profiles, str.strip)
+    for name in profiles:
+        if name not in PROFILES:
+            parser.error("unknown network profile " + name)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="landrop-benchmark-")
+    scratch = tempfile.mkdtemp(prefix="landrop-benchmark-run-")
+    results = []
+    try:
+        for dataset in datasets:
+            source = os.path.join(workdir, f"{dataset}-{args.content}-{args.scale:g}")
+            generateDataset(dataset, source, args.scale, args.content)
+            for profile, frameSize, threads, compress, streamCount, run in itertools.product(
+                    profiles, frameSizes, cryptoThreads, compression, streams, range(args.repeat)):
+                destination = os.path.join(scratch, "destination")
+                shutil.rmtree(destination, ignore_errors=True)
+                config = {
+                    "dataset": dataset,
+                    "profile": profile,
+                    "frameSize": frameSize,
+                    "cryptoThreads": threads,
+                    "compression": compress,
+                    "streams": streamCount,
+                    "run": run,
+                    "source": source,
+                    "destination": destination,
+                    "settingsPath": os.path.join(scratch, "settings"),
+                    "timeout": args.timeout,
+                }
+                result = runChild(config)
+                for key in ("source", "destination", "settingsPath", "timeout"):
+                    del config[key]
+                results.append({"config": config, **result})
+                summary = "error: " + result["error"] if result["error"] else "%.1f MB/s" % result["mbPerSecond"]
+                print(json.dumps(config), summary, file=sys.stderr)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps({"environment": environment(), "content": args.content, "scale": args.scale,
+                         "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+    return 1 if any(result["error"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
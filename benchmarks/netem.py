@@ -0,0 +1,275 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A TCP or UDP proxy that makes a link behave like a slower network:
+#
+#     python -m benchmarks.netem --profile hotspot --listen 0.0.0.0:5000 --target 192.168.1.2:52638
+#
+# Put it in front of a FileTransferServer port, or with --udp in front of a
+# DiscoveryService, and send to the proxy instead. Every direction of every
+# connection gets the profile's bandwidth, latency and jitter; TCP data is
+# delayed in order, as reordered segments look to the application.
+
+import argparse
+import asyncio
+import random
+import sys
+from dataclasses import dataclass, replace
+from typing import Dict, Optional, Tuple
+
+# Bytes read from a connection at once.
+READ_SIZE = 64 << 10
+# Chunks queued per direction when the profile has no bandwidth limit.
+DEFAULT_QUEUE_CHUNKS = 64
+# Queued after the last chunk a connection may forward.
+DROP = "drop"
+
+
+@dataclass(frozen=True)
+class NetworkProfile:
+    name: str
+    # One-way delay in seconds, and the most random delay added to it.
+    latency: float = 0.0
+    jitter: float = 0.0
+    # Bytes per second in each direction; 0 for no limit.
+    bandwidth: int = 0
+    # Share of UDP datagrams lost.
+    loss: float = 0.0
+    # TCP connections are cut after forwarding this many bytes; 0 for never.
+    dropAfter: int = 0
+
+
+PROFILES = {
+    "loopback": NetworkProfile("loopback"),
+    "gigabit-wired": NetworkProfile("gigabit-wired", latency=0.0002, jitter=0.0001, bandwidth=117_000_000),
+    "wifi-5ghz": NetworkProfile("wifi-5ghz", latency=0.002, jitter=0.002, bandwidth=50_000_000, loss=0.001),
+    "wifi-5ghz-congested": NetworkProfile("wifi-5ghz-congested", latency=0.005, jitter=0.015,
+                                          bandwidth=6_000_000, loss=0.02),
+    "hotspot": NetworkProfile("hotspot", latency=0.03, jitter=0.02, bandwidth=2_500_000, loss=0.01),
+}
+
+
+class Link:
+    # One direction of a connection. Data leaves at the profile's bandwidth
+    # and arrives latency plus jitter later, never before data sent ahead.
+
+    def __init__(self, profile: NetworkProfile, rng: random.Random) -> None:
+        self.profile = profile
+        self.rng = rng
+        self.nextSend = 0.0
+        self.lastDelivery = 0.0
+
+    def deliveryTime(self, size: int, now: float) -> float:
+        start = max(now, self.nextSend)
+        self.nextSend = start + (size / self.profile.bandwidth if self.profile.bandwidth else 0.0)
+        delivery = self.nextSend + self.profile.latency + self.rng.uniform(0.0, self.profile.jitter)
+        self.lastDelivery = max(delivery, self.lastDelivery)
+        return self.lastDelivery
+
+    def queueChunks(self) -> int:
+        # Enough to keep the link busy for a round trip; anything more is
+        # left to TCP flow control.
+        if not self.profile.bandwidth:
+            return DEFAULT_QUEUE_CHUNKS
+        inFlight = self.profile.bandwidth * 2 * (self.profile.latency + self.profile.jitter)
+        return max(4, int(inFlight // READ_SIZE) + 1)
+
+
+class TcpProxy:
+    def __init__(self, profile: NetworkProfile, target: Tuple[str, int], seed: int = 0) -> None:
+        self.profile = profile
+        self.target = target
+        self.rng = random.Random(seed)
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str, port: int) -> int:
+        self.server = await asyncio.start_server(self.connectionMade, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def connectionMade(self, clientReader: asyncio.StreamReader, clientWriter: asyncio.StreamWriter) -> None:
+        try:
+            targetReader, targetWriter = await asyncio.open_connection(*self.target)
+        except OSError:
+            clientWriter.transport.abort()
+            return
+        connection = {"forwarded": 0, "writers": (clientWriter, targetWriter)}
+        await asyncio.gather(self.forward(clientReader, targetWriter, connection),
+                             self.forward(targetReader, clientWriter, connection))
+        for writer in connection["writers"]:
+            writer.close()
+
+    async def forward(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: Dict) -> None:
+        loop = asyncio.get_event_loop()
+        link = Link(self.profile, self.rng)
+        queue: asyncio.Queue = asyncio.Queue(link.queueChunks())
+
+        async def deliver() -> None:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                if item == DROP:
+                    for connectionWriter in connection["writers"]:
+                        connectionWriter.transport.abort()
+                    return
+                deliveryTime, data = item
+                delay = deliveryTime - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.ensure_future(deliver())
+        end = None
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                connection["forwarded"] += len(data)
+                excess = connection["forwarded"] - self.profile.dropAfter
+                if self.profile.dropAfter and excess > 0:
+                    # Whatever fits below the limit still arrives first.
+                    data = data[:len(data) - excess]
+                    end = DROP
+                if data:
+                    await queue.put((link.deliveryTime(len(data), loop.time()), data))
+                if end is not None:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        await queue.put(end)
+        try:
+            await delivery
+        except (ConnectionError, OSError):
+            pass
+
+
+class UdpProxy:
+    # Forwards datagrams to the target and its replies back to the sender,
+    # losing some of them on the way.
+
+    def __init__(self, profile: NetworkProfile, target: Tuple[str, int], seed: int = 0) -> None:
+        self.profile = profile
+        self.target = target
+        self.rng = random.Random(seed)
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.upstreams: Dict[Tuple, asyncio.DatagramTransport] = {}
+        self.links: Dict[Tuple, Link] = {}
+
+    async def start(self, host: str, port: int) -> int:
+        loop = asyncio.get_event_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramHandler(self.fromClient), local_addr=(host, port))
+        return self.transport.get_extra_info("sockname")[1]
+
+    def send(self, key: Tuple, transport: asyncio.DatagramTransport, data: bytes, address=None) -> None:
+        if self.rng.random() < self.profile.loss:
+            return
+        link = self.links.setdefault(key, Link(self.profile, self.rng))
+        loop = asyncio.get_event_loop()
+        loop.call_at(link.deliveryTime(len(data), loop.time()), transport.sendto, data, address)
+
+    def fromClient(self, data: bytes, address: Tuple) -> None:
+        asyncio.ensure_future(self.forwardFromClient(data, address))
+
+    async def forwardFromClient(self, data: bytes, address: Tuple) -> None:
+        upstream = self.upstreams.get(address)
+        if upstream is None:
+            loop = asyncio.get_event_loop()
+            upstream, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramHandler(lambda reply, _: self.send((address, "in"), self.transport, reply, address)),
+                remote_addr=self.target)
+            self.upstreams[address] = upstream
+        self.send((address, "out"), upstream, data)
+
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    def __init__(self, callback) -> None:
+        self.callback = callback
+
+    def datagram_received(self, data: bytes, address: Tuple) -> None:
+        self.callback(data, address)
+
+
+def parseAddress(text: str) -> Tuple[str, int]:
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def parseRate(text: str) -> int:
+    # Bytes per second, with an optional K, M or G suffix.
+    units = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.netem",
+                                     description="Proxy that emulates network conditions")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="loopback")
+    parser.add_argument("--listen", default="127.0.0.1:0", help="host:port to listen on")
+    parser.add_argument("--target", required=True, help="host:port to forward to")
+    parser.add_argument("--udp", action="store_true", help="forward datagrams instead of TCP connections")
+    parser.add_argument("--latency", type=float, help="one-way delay in milliseconds")
+    parser.add_argument("--jitter", type=float, help="most extra random delay in milliseconds")
+    parser.add_argument("--bandwidth", type=parseRate, help="bytes per second in each direction")
+    parser.add_argument("--loss", type=float, help="share of datagrams lost")
+    parser.add_argument("--drop-after", type=parseRate, help="cut TCP connections after this many bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    profile = PROFILES[args.profile]
+    overrides = {"latency": args.latency / 1000 if args.latency is not None else None,
+                 "jitter": args.jitter / 1000 if args.jitter is not None else None,
+                 "bandwidth": args.bandwidth, "loss": args.loss, "dropAfter": args.drop_after}
+    profile = replace(profile, **{key: value for key, value in overrides.items() if value is not None})
+
+    proxyClass = UdpProxy if args.udp else TcpProxy
+    proxy = proxyClass(profile, parseAddress(args.target), args.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    host, port = parseAddress(args.listen)
+    port = loop.run_until_complete(proxy.start(host, port))
+    # Whoever started us reads the port from the first line.
+    print(f"{host}:{port}", flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
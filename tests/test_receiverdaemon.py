@@ -0,0 +1,143 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, LANDrop
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from LANDrop.asynctransfer import AsyncFileSender, TransferError, TransferOptions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 60
+
+
+class ReceiverDaemonTest(unittest.TestCase):
+    # Runs the daemon and the command line sender as they are run in
+    # practice, in processes of their own.
+
+    def setUp(self) -> None:
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        # Settings of the test stay out of the user's.
+        self.env = dict(os.environ, HOME=self.workdir.name, XDG_CONFIG_HOME=os.path.join(self.workdir.name, "config"),
+                        QT_QPA_PLATFORM="offscreen", PYTHONPATH=ROOT)
+        self.source = os.path.join(self.workdir.name, "source")
+        self.destination = os.path.join(self.workdir.name, "destination")
+        os.makedirs(self.source)
+
+    def startDaemon(self) -> int:
+        daemon = subprocess.Popen([sys.executable, "-m", "LANDrop", "daemon", "--dir", self.destination,
+                                   "--port", "0", "--no-discovery"],
+                                  cwd=ROOT, env=self.env, stderr=subprocess.PIPE, universal_newlines=True)
+        self.addCleanup(daemon.wait, TIMEOUT)
+        self.addCleanup(daemon.terminate)
+        self.daemon = daemon
+        for line in daemon.stderr:
+            match = re.search(r"on port (\d+)", line)
+            if match:
+                return int(match.group(1))
+        self.fail("The daemon exited with code %s before listening." % daemon.wait(TIMEOUT))
+
+    def send(self, port: int, names) -> subprocess.CompletedProcess:
+        paths = [os.path.join(self.source, name) for name in names]
+        return subprocess.run([sys.executable, "-m", "LANDrop", "send", "--to", "127.0.0.1:%d" % port,
+                               "--name", "tester", "-q"] + paths,
+                              cwd=ROOT, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, timeout=TIMEOUT)
+
+    def sendRaw(self, port: int, messages) -> None:
+        # A peer that completes the key exchange and then sends messages of
+        # its own, waiting for the daemon to hang up.
+        async def session() -> None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            sender = AsyncFileSender(reader, writer, [], TransferOptions(dedup=False))
+            try:
+                await sender.exchangeKeys()
+                for message in messages:
+                    await sender.sendFrame(message)
+                await sender.receiveFrame()
+            except (TransferError, OSError):
+                pass
+            finally:
+                await sender.close()
+
+        asyncio.run(asyncio.wait_for(session(), TIMEOUT))
+
+    def writeFile(self, name: str, data: bytes) -> None:
+        with open(os.path.join(self.source, name), "wb") as f:
+            f.write(data)
+
+    def readReceived(self, name: str) -> bytes:
+        with open(os.path.join(self.destination, name), "rb") as f:
+            return f.read()
+
+    def testReceivesFiles(self) -> None:
+        files = {"a.bin": os.urandom(3 << 20), "b.txt": b"hello\n" * 1000, "empty": b""}
+        for name, data in files.items():
+            self.writeFile(name, data)
+        port = self.startDaemon()
+
+        for attempt in range(2):
+            result = self.send(port, sorted(files))
+            self.assertEqual(result.returncode, 0, result.stderr)
+            for name, data in files.items():
+                self.assertEqual(self.readReceived(name), data)
+            # The second session finds every file in place already.
+            self.assertIsNone(self.daemon.poll(), "The daemon exited during session %d." % (attempt + 1))
+
+    def testRefusesDuplicateNames(self) -> None:
+        self.writeFile("ok.bin", b"data")
+        port = self.startDaemon()
+
+        result = self.send(port, ["ok.bin", "ok.bin"])
+        self.assertNotEqual(result.returncode, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.destination, "ok.bin")))
+        # Refusing a transfer doesn't stop the daemon from taking the next.
+        result = self.send(port, ["ok.bin"])
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(self.readReceived("ok.bin"), b"data")
+
+    def testSurvivesMalformedHandshakes(self) -> None:
+        self.writeFile("ok.bin", b"data")
+        port = self.startDaemon()
+
+        for message in (b"5", b"[]", b'"join"', b"\xff"):
+            self.sendRaw(port, [message])
+            self.assertIsNone(self.daemon.poll(), "The daemon exited after %r." % message)
+        result = self.send(port, ["ok.bin"])
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()